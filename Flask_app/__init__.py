@@ -1,12 +1,14 @@
 # flask_app/__init__.py
 
+import logging
 import os
 import time
+import click
 from flask import Flask
 from flask_pymongo import PyMongo
 from flask_login import LoginManager
-from bson.objectid import ObjectId
-from bson.errors import InvalidId
+
+log = logging.getLogger(__name__)
 
 # Initialize extensions globally
 mongo = PyMongo()
@@ -15,9 +17,21 @@ login_manager.login_view = 'auth.login' # Route to redirect to if login is requi
 
 DEFAULT_OLLAMA_MODEL = "llama3:latest" # Use a common default like llama3
 
+def running_cli_command():
+    """
+    True when the app is created for a `flask <command>` other than `flask run` (run-csv,
+    compact, import, ...). Those processes exit when the command does, so they don't start
+    the background workers that serving processes run.
+    """
+    ctx = click.get_current_context(silent=True)
+    return ctx is not None and ctx.info_name != 'run'
+
 def create_app():
+    from .instrumentation import configure_logging, register_mongo_listener, init_app as init_instrumentation
+    configure_logging()
+    register_mongo_listener() # Must precede mongo.init_app, which creates the MongoClient
     app = Flask(__name__)
-    print("--- Creating Flask App ---")
+    log.info("Creating Flask app")
 
     # --- Configuration from Environment Variables ---
     # Load directly into app.config for simpler access later if needed,
@@ -39,14 +53,14 @@ def create_app():
     # --- >>> END OF ADDED LINE <<< ---
 
     # Print loaded config for debugging during startup
-    print(f"DEBUG [__init__]: SECRET_KEY loaded: {'Yes' if app.config['SECRET_KEY'] != 'fallback-insecure-secret-key-change-me' else 'No (Using Default)'}")
-    print(f"DEBUG [__init__]: MONGO_URI = {app.config['MONGO_URI']}")
-    print(f"DEBUG [__init__]: IMAGE_API_URL = {app.config['IMAGE_API_URL']}")
-    print(f"DEBUG [__init__]: OLLAMA_ENDPOINT = {app.config['OLLAMA_ENDPOINT']}")
-    print(f"DEBUG [__init__]: OLLAMA_MODEL = {app.config['OLLAMA_MODEL']}")
-    print(f"DEBUG [__init__]: XTTS_API_URL = {app.config['XTTS_API_URL']}")
+    log.debug(f"SECRET_KEY loaded: {'Yes' if app.config['SECRET_KEY'] != 'fallback-insecure-secret-key-change-me' else 'No (Using Default)'}")
+    log.debug(f"MONGO_URI = {app.config['MONGO_URI']}")
+    log.debug(f"IMAGE_API_URL = {app.config['IMAGE_API_URL']}")
+    log.debug(f"OLLAMA_ENDPOINT = {app.config['OLLAMA_ENDPOINT']}")
+    log.debug(f"OLLAMA_MODEL = {app.config['OLLAMA_MODEL']}")
+    log.debug(f"XTTS_API_URL = {app.config['XTTS_API_URL']}")
     # --- >>> ADD VIDEO_API_URL DEBUG PRINT <<< ---
-    print(f"DEBUG [__init__]: VIDEO_API_URL = {app.config['VIDEO_API_URL']}")
+    log.debug(f"VIDEO_API_URL = {app.config['VIDEO_API_URL']}")
     # --- >>> END OF ADDED LINE <<< ---
     # --- End Configuration ---
 
@@ -56,76 +70,120 @@ def create_app():
 
     for attempt in range(max_retries):
         try:
-            print(f"Attempting to initialize MongoDB (attempt {attempt + 1}/{max_retries})...")
+            log.info(f"Attempting to initialize MongoDB (attempt {attempt + 1}/{max_retries})...")
             mongo.init_app(app)
             # Test the connection using a simple command
             mongo.db.command('ping')
-            print("MongoDB initialized and connection verified.")
+            log.info("MongoDB initialized and connection verified.")
             break # Exit loop on success
         except Exception as e:
-            print(f"WARN: MongoDB connection attempt {attempt + 1} failed: {e}")
+            log.warning(f"MongoDB connection attempt {attempt + 1} failed: {e}")
             if attempt == max_retries - 1:
-                print(f"!!! FATAL: Error initializing MongoDB after {max_retries} attempts. The application might not function correctly without a database.")
+                log.critical(f"Error initializing MongoDB after {max_retries} attempts. The application might not function correctly without a database.")
                 # Decide if you want to raise the exception or allow the app to continue without DB
                 # raise ConnectionError(f"Failed to connect to MongoDB after {max_retries} attempts: {e}") from e
             else:
-                print(f"Retrying MongoDB initialization in {retry_delay} seconds...")
+                log.info(f"Retrying MongoDB initialization in {retry_delay} seconds...")
                 time.sleep(retry_delay)
 
     login_manager.init_app(app)
-    print("LoginManager initialized.")
+    log.info("LoginManager initialized.")
+    init_instrumentation(app) # Route latency metrics
+    from .scheduling import init_app as init_scheduling
+    init_scheduling(app) # Attributes backend calls to the logged-in user for fair sharing
 
     # --- Register Blueprints ---
     try:
         from .views import views
         from .auth import auth
+        from .jobs import jobs
+        from .media import media
+        from .conversations import conversations
+        from .video_tracker import videos
+        from .pipelines import pipelines
+        from .speech import speech
+        from .audio_delivery import audio
+        from .speaker_library import speaker_library
+        from .instrumentation import metrics
         app.register_blueprint(views, url_prefix='/')
         app.register_blueprint(auth, url_prefix='/')
-        print("Blueprints registered successfully.")
+        app.register_blueprint(jobs, url_prefix='/')
+        app.register_blueprint(media, url_prefix='/')
+        app.register_blueprint(conversations, url_prefix='/')
+        app.register_blueprint(videos, url_prefix='/')
+        app.register_blueprint(pipelines, url_prefix='/')
+        app.register_blueprint(speech, url_prefix='/')
+        app.register_blueprint(audio, url_prefix='/')
+        app.register_blueprint(speaker_library, url_prefix='/')
+        app.register_blueprint(metrics, url_prefix='/')
+        log.info("Blueprints registered successfully.")
     except ImportError as e:
-        print(f"!!! Error importing or registering blueprints: {e}")
+        log.error(f"Error importing or registering blueprints: {e}")
         # This is likely a critical error, consider raising it
         raise ImportError(f"Failed to import blueprints: {e}") from e
     # --- End Blueprint Registration ---
 
+    # --- Collection Indexes ---
+    try:
+        if mongo.db is not None:
+            from .jobs import ensure_job_indexes
+            from .conversations import ensure_conversation_indexes
+            from .video_tracker import ensure_video_indexes
+            from .pipelines import ensure_pipeline_indexes
+            from .speech import ensure_audio_stream_indexes
+            from .speaker_library import ensure_speaker_indexes
+            ensure_job_indexes()
+            ensure_conversation_indexes()
+            ensure_video_indexes()
+            ensure_pipeline_indexes()
+            ensure_audio_stream_indexes()
+            ensure_speaker_indexes()
+            log.info("MongoDB indexes ensured.")
+    except Exception as e:
+        log.warning(f"Could not create MongoDB indexes: {e}")
+
+    # --- Workflow Templates (parsed and validated once; broken templates are reported here) ---
+    from .workflows import workflow_registry
+    workflow_registry.load_all()
+
+    # --- Background Refreshers (serving processes only) ---
+    if running_cli_command():
+        log.info("Running a CLI command, background workers not started.")
+    else:
+        start_background_workers(app)
+
+    from .models import User
     @login_manager.user_loader
     def load_user(user_id):
-        """Loads user object from MongoDB based on session user_id."""
-        print(f"User Loader: Attempting to load user with id: {user_id}")
+        """Loads the session user, from the in-process user cache when possible (see models.py)."""
         if not user_id: return None
         try:
-            # Validate and convert user_id to ObjectId
-            user_obj_id = ObjectId(user_id)
-            # Ensure mongo.db is available (check after init_app attempts)
-            if mongo.db is None:
-                 print("User Loader: mongo.db is None, cannot query database.")
-                 return None
-
-            user_data = mongo.db.users.find_one({"_id": user_obj_id})
-            # print(f"User Loader: User data from DB: {user_data}") # Debug: can be verbose
-
-            if user_data:
-                # Dynamically import User model here to avoid circular imports
-                # Ensure your User model can be initialized like this
-                try:
-                    from .models import User # Assuming models.py exists with User class
-                    print("User Loader: User data found, creating User object.")
-                    return User(user_data=user_data)
-                except ImportError:
-                     print("!!! User Loader: Failed to import User model from .models")
-                     return None
-            else:
-                print("User Loader: User ID not found in database.")
-                return None
-        except InvalidId:
-            print(f"User Loader: Invalid ObjectId format in session: {user_id}")
-            return None
+            return User.load_cached(user_id)
         except Exception as e:
-            print(f"!!! User Loader: Error loading user {user_id}: {e}")
-            # Log the full traceback in production environments for better debugging
-            # import traceback
-            # print(traceback.format_exc())
+            log.error(f"User Loader: Error loading user {user_id}: {e}")
             return None
 
-    print("Flask app creation completed.")
-    return app
\ No newline at end of file
+    log.info("Flask app creation completed.")
+    return app
+
+def start_background_workers(app):
+    """Health probes, cache refreshers, warmers, the video tracker and the pipeline engine."""
+    from .clients import start_backend_health_probes
+    start_backend_health_probes() # Marks backend nodes up/down for the load balancer
+    if os.environ.get('XTTS_API_URL'): # Views read service URLs from the environment, not app.config
+        from .speakers import speaker_cache
+        speaker_cache.start_background_refresh()
+        from .speaker_library import start_priming, SPEAKER_WARMUP
+        if SPEAKER_WARMUP and mongo.db is not None: start_priming() # XTTS computes each library speaker's latents before users ask
+    from .audio_delivery import xtts_output_compactor
+    if xtts_output_compactor.directory and xtts_output_compactor.interval > 0:
+        xtts_output_compactor.start() # Re-encodes and expires the XTTS server's per-request WAVs
+    if os.environ.get('OLLAMA_ENDPOINT'):
+        from .ollama_models import ollama_warmer, OLLAMA_WARMUP
+        if OLLAMA_WARMUP: ollama_warmer.start() # Loads models before the first chat pays for it
+    if os.environ.get('VIDEO_API_URL') and mongo.db is not None:
+        from .video_tracker import video_tracker
+        video_tracker.start(app)
+    if mongo.db is not None: # Picks up queued runs, and runs whose engine stopped (see the lease in pipelines.py)
+        from .pipelines import pipeline_engine
+        pipeline_engine.start(app)
@@ -0,0 +1,126 @@
+# flask_app/audio_cache.py
+
+# Content-addressed cache for XTTS synthesis results.
+# Each (text, language, speaker) triple hashes to a WAV file under AUDIO_CACHE_DIR; a SQLite
+# index next to the blobs tracks size and last access so the least recently used entries are
+# evicted once AUDIO_CACHE_MAX_BYTES or AUDIO_CACHE_MAX_ENTRIES is exceeded. SQLite (rather
+# than Mongo) is used because the blobs live on this host's disk, so the index must too.
+# If the XTTS speaker folder is mounted here (SPEAKER_LIBRARY_DIR), the reference clip's
+# mtime and size are part of the key, so replacing a speaker's clip stops serving old audio.
+
+import logging
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from contextlib import closing
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+AUDIO_CACHE_DIR = os.environ.get('AUDIO_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'audio_cache'))
+AUDIO_CACHE_MAX_BYTES = int(os.environ.get('AUDIO_CACHE_MAX_BYTES', 512 * 1024 * 1024)) # 512 MB
+AUDIO_CACHE_MAX_ENTRIES = int(os.environ.get('AUDIO_CACHE_MAX_ENTRIES', 5000))
+AUDIO_CACHE_ENABLED = os.environ.get('AUDIO_CACHE_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+SPEAKER_LIBRARY_DIR = os.environ.get('SPEAKER_LIBRARY_DIR')
+# Bump to invalidate every entry, e.g. after switching the XTTS model
+AUDIO_CACHE_KEY_VERSION = 1
+
+
+def speaker_version(speaker_id):
+    """mtime and size of the speaker's reference clip, or None if the speaker folder isn't mounted here."""
+    if not SPEAKER_LIBRARY_DIR: return None
+    try: stat = os.stat(os.path.join(SPEAKER_LIBRARY_DIR, f"{speaker_id}.wav"))
+    except OSError: return None
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+
+class AudioCache:
+    """
+    WAV blobs on disk + SQLite LRU index, with process-local hit/miss counters.
+    Blob reads and writes run unlocked (blobs are replaced atomically); the lock only
+    serializes this process's index updates.
+    """
+
+    def __init__(self, cache_dir, max_bytes, max_entries):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._initialized = False
+
+    @staticmethod
+    def make_key(text, language_code, speaker_id):
+        raw = json.dumps([AUDIO_CACHE_KEY_VERSION, text, language_code, speaker_id, speaker_version(speaker_id)], ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _blob_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.wav")
+
+    def _connect(self):
+        """A new connection to the index; use as `with closing(self._connect()) as conn, conn:` to commit and close."""
+        if not self._initialized:
+            with self._lock:
+                if not self._initialized:
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    with closing(sqlite3.connect(os.path.join(self.cache_dir, 'index.sqlite'), timeout=10)) as conn, conn:
+                        conn.execute("PRAGMA journal_mode=WAL") # Lookups don't wait for index writes
+                        conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)")
+                        conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+                    self._initialized = True
+        return sqlite3.connect(os.path.join(self.cache_dir, 'index.sqlite'), timeout=10)
+
+    def get(self, key):
+        """Returns the cached WAV bytes, or None on a miss."""
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchall() # fetchall: releases the read lock
+            if rows:
+                try:
+                    with open(self._blob_path(key), 'rb') as f: wav_bytes = f.read()
+                except FileNotFoundError:
+                    wav_bytes = None
+                with self._lock, conn:
+                    if wav_bytes is None: conn.execute("DELETE FROM entries WHERE key = ?", (key,)) # Blob removed externally
+                    else: conn.execute("UPDATE entries SET last_access = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+                    if wav_bytes is not None: self.hits += 1
+                if wav_bytes is not None: return wav_bytes
+        self.misses += 1
+        return None
+
+    def put(self, key, wav_bytes):
+        """Stores a WAV blob (atomically) and evicts LRU entries beyond the size/entry limits."""
+        path = self._blob_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f: f.write(wav_bytes)
+        os.replace(tmp_path, path)
+        now = time.time()
+        with closing(self._connect()) as conn, self._lock, conn:
+            conn.execute("INSERT OR REPLACE INTO entries (key, size, created_at, last_access, hits) VALUES (?, ?, ?, ?, 0)", (key, len(wav_bytes), now, now))
+            self._evict(conn)
+
+    def _evict(self, conn):
+        total_bytes, total_entries = conn.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM entries").fetchone()
+        if total_bytes <= self.max_bytes and total_entries <= self.max_entries: return
+        evicted = 0
+        for key, size in conn.execute("SELECT key, size FROM entries ORDER BY last_access ASC").fetchall():
+            if total_bytes <= self.max_bytes and total_entries <= self.max_entries: break
+            try: os.remove(self._blob_path(key))
+            except FileNotFoundError: pass
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total_bytes -= size; total_entries -= 1; evicted += 1
+        log.info(f"Audio cache evicted {evicted} entr{'y' if evicted == 1 else 'ies'} ({total_entries} left, {total_bytes} bytes).")
+
+    def stats(self):
+        with closing(self._connect()) as conn:
+            total_bytes, total_entries = conn.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM entries").fetchone()
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+                "entries": total_entries, "bytes": total_bytes, "max_entries": self.max_entries, "max_bytes": self.max_bytes}
+
+
+audio_cache = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES, AUDIO_CACHE_MAX_ENTRIES)
@@ -0,0 +1,204 @@
+# flask_app/audio_delivery.py
+
+# Compressed audio delivery.
+# XTTS answers with 16-bit PCM WAV (about 2.8 MB per minute at 24 kHz), which the dashboard
+# used to inline as base64 into the page, and into every hidden form field that carried it,
+# on each re-render. Synthesized speech is now transcoded with a local ffmpeg, stored in the
+# media store (media.py) and referenced by id, so the browser fetches it once from
+# /media/<id> with ETag and long-lived caching. Encodings are cached in mongo.db.audio_encodings
+# by (WAV hash, format, bitrate), so replaying cached speech doesn't re-encode it. Without
+# ffmpeg the WAV is stored as-is (still served by URL, just not smaller).
+# The XTTS server also keeps a timestamped WAV of every request in its output_audio directory;
+# `flask audio compact` (and, if XTTS_OUTPUT_COMPACT_INTERVAL is set, a background thread)
+# re-encodes older ones and deletes them after the retention period.
+#   AUDIO_DELIVERY_FORMAT        opus (Ogg), mp3, aac (ADTS) or wav (opus); mp3 for old Safari
+#   AUDIO_DELIVERY_BITRATE       encoder bitrate, e.g. 48k (per-format default below)
+#   FFMPEG_BIN                   ffmpeg executable (ffmpeg)
+#   XTTS_OUTPUT_DIR              the XTTS server's output_audio directory, as mounted here
+#   XTTS_OUTPUT_COMPACT_DAYS     re-encode WAVs older than this many days (1)
+#   XTTS_OUTPUT_RETENTION_DAYS   delete files older than this many days (30)
+#   XTTS_OUTPUT_COMPACT_INTERVAL seconds between background compactions (0 = only via the CLI)
+
+import logging
+import os
+import time
+import shutil
+import hashlib
+import subprocess
+from datetime import datetime
+from threading import Lock, Thread
+import click
+from flask import Blueprint
+from . import mongo
+from .caching import LRUCache
+from .media import store_media
+
+log = logging.getLogger(__name__)
+
+audio = Blueprint('audio', __name__)
+
+# --- Encodings ---
+# format -> (content type, file extension, default bitrate, ffmpeg output arguments)
+AUDIO_ENCODINGS = {
+    "opus": ("audio/ogg", "ogg", "32k", ["-c:a", "libopus", "-application", "voip", "-f", "ogg"]),
+    "mp3": ("audio/mpeg", "mp3", "64k", ["-c:a", "libmp3lame", "-f", "mp3"]),
+    "aac": ("audio/aac", "aac", "64k", ["-c:a", "aac", "-f", "adts"]), # ADTS: MP4 can't be written to a pipe without fragmenting
+    "wav": ("audio/wav", "wav", None, None),
+}
+AUDIO_FILE_EXTENSIONS = {content_type: extension for content_type, extension, _, _ in AUDIO_ENCODINGS.values()}
+AUDIO_DELIVERY_FORMAT = os.environ.get('AUDIO_DELIVERY_FORMAT', 'opus').lower()
+if AUDIO_DELIVERY_FORMAT not in AUDIO_ENCODINGS:
+    log.warning(f"Unknown AUDIO_DELIVERY_FORMAT '{AUDIO_DELIVERY_FORMAT}', using opus.")
+    AUDIO_DELIVERY_FORMAT = "opus"
+AUDIO_DELIVERY_BITRATE = os.environ.get('AUDIO_DELIVERY_BITRATE') or AUDIO_ENCODINGS[AUDIO_DELIVERY_FORMAT][2]
+FFMPEG_BIN = os.environ.get('FFMPEG_BIN', 'ffmpeg')
+FFMPEG_TIMEOUT = 120 # seconds; encoding runs far faster than real time
+
+XTTS_OUTPUT_DIR = os.environ.get('XTTS_OUTPUT_DIR')
+XTTS_OUTPUT_COMPACT_DAYS = float(os.environ.get('XTTS_OUTPUT_COMPACT_DAYS', 1))
+XTTS_OUTPUT_RETENTION_DAYS = float(os.environ.get('XTTS_OUTPUT_RETENTION_DAYS', 30))
+XTTS_OUTPUT_COMPACT_INTERVAL = float(os.environ.get('XTTS_OUTPUT_COMPACT_INTERVAL', 0))
+XTTS_OUTPUT_MIN_AGE = 300 # seconds; never touch a file XTTS may still be writing
+
+encoding_cache = LRUCache(max_entries=4096) # encoding key -> (media id, content type)
+
+
+# --- Transcoding ---
+_ffmpeg_path = None
+_ffmpeg_lock = Lock()
+
+def ffmpeg_available():
+    global _ffmpeg_path
+    with _ffmpeg_lock:
+        if _ffmpeg_path is None:
+            _ffmpeg_path = shutil.which(FFMPEG_BIN) or ""
+            if not _ffmpeg_path: log.warning(f"ffmpeg ('{FFMPEG_BIN}') not found; audio will be delivered as WAV.")
+        return bool(_ffmpeg_path)
+
+def ffmpeg_command(*args):
+    """The ffmpeg argument list for `args`. Raises ValueError if ffmpeg isn't installed."""
+    if not ffmpeg_available(): raise ValueError("ffmpeg is not available.")
+    return [_ffmpeg_path, "-hide_banner", "-loglevel", "error", *args]
+
+def transcode_wav(wav_bytes, audio_format=AUDIO_DELIVERY_FORMAT, bitrate=AUDIO_DELIVERY_BITRATE):
+    """Encodes WAV bytes with ffmpeg. Raises ValueError if ffmpeg is missing or fails."""
+    output_args = AUDIO_ENCODINGS[audio_format][3]
+    if output_args is None: return wav_bytes
+    command = ffmpeg_command("-f", "wav", "-i", "pipe:0", "-vn", "-b:a", bitrate, *output_args, "pipe:1")
+    try:
+        result = subprocess.run(command, input=wav_bytes, capture_output=True, timeout=FFMPEG_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        raise ValueError(f"ffmpeg timed out after {FFMPEG_TIMEOUT}s encoding {audio_format}.")
+    if result.returncode != 0 or not result.stdout:
+        raise ValueError(f"ffmpeg failed encoding {audio_format}: {result.stderr.decode('utf-8', 'replace').strip()[-300:]}")
+    return result.stdout
+
+def deliver_audio(wav_bytes, user_id_obj=None):
+    """
+    Stores synthesized speech in the delivery format and returns (media id, content type).
+    The same WAV is encoded once; if encoding fails the WAV itself is stored.
+    """
+    audio_format, bitrate = AUDIO_DELIVERY_FORMAT, AUDIO_DELIVERY_BITRATE
+    encoding_key = f"{hashlib.sha256(wav_bytes).hexdigest()}:{audio_format}:{bitrate}"
+    cached = encoding_cache.get(encoding_key)
+    if cached: return cached
+    encoding_doc = mongo.db.audio_encodings.find_one({"_id": encoding_key})
+    if encoding_doc:
+        delivered = (encoding_doc['media_id'], encoding_doc['content_type'])
+        encoding_cache.set(encoding_key, delivered)
+        return delivered
+
+    try:
+        started = time.monotonic()
+        encoded = transcode_wav(wav_bytes, audio_format, bitrate)
+        content_type = AUDIO_ENCODINGS[audio_format][0]
+        log.debug(f"Encoded {len(wav_bytes)} bytes of WAV as {audio_format} {bitrate}: {len(encoded)} bytes in {time.monotonic() - started:.2f}s.")
+    except ValueError as e:
+        if ffmpeg_available(): log.warning(f"Delivering audio as WAV: {e}") # A missing ffmpeg was already reported once
+        return store_media(wav_bytes, 'audio/wav', user_id_obj), 'audio/wav' # Not cached, so a later call retries the encode
+    delivered = (store_media(encoded, content_type, user_id_obj), content_type)
+    mongo.db.audio_encodings.update_one({"_id": encoding_key}, {"$setOnInsert": {"media_id": delivered[0], "content_type": content_type, "created_at": datetime.utcnow()}}, upsert=True)
+    encoding_cache.set(encoding_key, delivered)
+    return delivered
+
+def audio_filename(stem, content_type):
+    return f"{stem}.{AUDIO_FILE_EXTENSIONS.get(content_type, 'wav')}"
+
+
+# --- XTTS Output Retention ---
+def compact_xtts_output(directory, compact_after_days=XTTS_OUTPUT_COMPACT_DAYS, retention_days=XTTS_OUTPUT_RETENTION_DAYS, dry_run=False):
+    """
+    Deletes files in the XTTS output directory older than `retention_days` and re-encodes WAVs
+    older than `compact_after_days` in the delivery format (keeping their timestamps, so
+    retention still counts from when XTTS wrote them). Returns counts and bytes freed.
+    """
+    stats = {"deleted": 0, "compacted": 0, "failed": 0, "bytes_freed": 0}
+    audio_format = AUDIO_DELIVERY_FORMAT if AUDIO_DELIVERY_FORMAT != "wav" else "opus"
+    extension = AUDIO_ENCODINGS[audio_format][1]
+    can_encode = compact_after_days < retention_days and ffmpeg_available()
+    now = time.time()
+    for entry in os.scandir(directory):
+        if not entry.is_file() or not entry.name.endswith(('.wav', f".{extension}")): continue
+        stat = entry.stat()
+        age = now - stat.st_mtime
+        if age < XTTS_OUTPUT_MIN_AGE: continue
+        if age > retention_days * 86400:
+            if not dry_run: os.remove(entry.path)
+            stats["deleted"] += 1; stats["bytes_freed"] += stat.st_size
+        elif can_encode and entry.name.endswith('.wav') and age > compact_after_days * 86400:
+            target = f"{entry.path[:-4]}.{extension}"
+            try:
+                if not dry_run:
+                    with open(entry.path, 'rb') as f: encoded = transcode_wav(f.read(), audio_format, AUDIO_ENCODINGS[audio_format][2])
+                    tmp_path = f"{target}.{os.getpid()}.tmp"
+                    with open(tmp_path, 'wb') as f: f.write(encoded)
+                    os.utime(tmp_path, (stat.st_atime, stat.st_mtime))
+                    os.replace(tmp_path, target)
+                    os.remove(entry.path)
+                    stats["bytes_freed"] += stat.st_size - len(encoded)
+                stats["compacted"] += 1
+            except (ValueError, OSError) as e:
+                log.warning(f"Could not compact {entry.path}: {e}")
+                stats["failed"] += 1
+    log.info(f"XTTS output compaction{' (dry run)' if dry_run else ''} in {directory}: {stats}")
+    return stats
+
+
+class OutputCompactor:
+    """Runs compact_xtts_output on XTTS_OUTPUT_DIR every `interval` seconds."""
+
+    def __init__(self, directory, interval_seconds):
+        self.directory = directory
+        self.interval = interval_seconds
+        self._thread = None
+        self._lock = Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None: return
+            self._thread = Thread(target=self._loop, name="xtts-output-compactor", daemon=True)
+            self._thread.start()
+        log.info(f"XTTS output compactor started for {self.directory} (every {self.interval:.0f}s).")
+
+    def _loop(self):
+        while True:
+            try: compact_xtts_output(self.directory)
+            except Exception as e: log.exception(f"XTTS output compaction failed: {type(e).__name__} - {e}")
+            time.sleep(self.interval)
+
+
+xtts_output_compactor = OutputCompactor(XTTS_OUTPUT_DIR, XTTS_OUTPUT_COMPACT_INTERVAL)
+
+
+# --- CLI ---
+@audio.cli.command('compact')
+@click.option('--dir', 'directory', default=XTTS_OUTPUT_DIR, type=click.Path(exists=True, file_okay=False), help='XTTS output directory (XTTS_OUTPUT_DIR).')
+@click.option('--compact-after-days', default=XTTS_OUTPUT_COMPACT_DAYS, type=float, show_default=True, help='Re-encode WAVs older than this.')
+@click.option('--retention-days', default=XTTS_OUTPUT_RETENTION_DAYS, type=float, show_default=True, help='Delete files older than this.')
+@click.option('--dry-run', is_flag=True, help='Report what would change without touching any file.')
+def compact_command(directory, compact_after_days, retention_days, dry_run):
+    """Re-encodes and expires the WAVs the XTTS server keeps of every request."""
+    if not directory: raise click.ClickException("Set XTTS_OUTPUT_DIR or pass --dir.")
+    stats = compact_xtts_output(directory, compact_after_days, retention_days, dry_run)
+    if dry_run: click.echo(f"Would compact {stats['compacted']} and delete {stats['deleted']} file(s) ({stats['bytes_freed'] / 1024 / 1024:.1f} MB).")
+    else: click.echo(f"Compacted {stats['compacted']} and deleted {stats['deleted']} file(s), freed {stats['bytes_freed'] / 1024 / 1024:.1f} MB ({stats['failed']} failed).")
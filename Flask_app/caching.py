@@ -0,0 +1,70 @@
+# flask_app/caching.py
+
+# Small in-process caching primitives shared by the app's caches.
+
+import time
+from collections import OrderedDict
+from threading import Lock
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache bounded by entry count and, optionally, by total size
+    (as measured by `sizeof`, e.g. len for strings/bytes) and entry age (`ttl` seconds).
+    """
+
+    def __init__(self, max_entries, max_bytes=None, ttl=None, sizeof=len):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._sizeof = sizeof
+        self._entries = OrderedDict() # key -> (value, size, stored_at)
+        self._bytes = 0
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING and self.ttl is not None and time.monotonic() - entry[2] > self.ttl:
+                self._remove(key)
+                entry = _MISSING
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        size = self._sizeof(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes: return # Would evict everything else
+        with self._lock:
+            if key in self._entries: self._remove(key)
+            self._entries[key] = (value, size, time.monotonic())
+            self._bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def pop(self, key):
+        with self._lock:
+            if key in self._entries: self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear(); self._bytes = 0
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self._entries), "bytes": self._bytes, "hits": self.hits, "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else None}
@@ -0,0 +1,140 @@
+# flask_app/chat_context.py
+
+# Builds the Ollama /api/chat message list for a conversation within a token budget.
+# The prompt is [system prompt, summary of older turns, recent turns, new message]. The
+# system prompt is a constant and the summary only changes when turns are folded into it,
+# so consecutive requests share a byte-identical prefix and Ollama can reuse its KV cache
+# instead of re-running prefill over the whole history.
+# When the unsummarized turns grow past CHAT_FOLD_RATIO of the budget, the oldest ones are
+# summarized in the background and the summary is stored on the conversation (see
+# conversations.save_conversation_summary). Until it lands, turns that don't fit are dropped
+# oldest first. Tokens are estimated from characters; the served model's tokenizer isn't
+# available in this process.
+#   CHAT_CONTEXT_TOKENS      prompt budget in tokens (3072)
+# Summaries use the "summary" request class (see ollama_models.py).
+
+import logging
+import os
+import math
+import requests
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from .clients import get_client
+from .ollama_models import ollama_payload
+from .conversations import get_message_range, save_conversation_summary
+
+log = logging.getLogger(__name__)
+
+# --- Constants ---
+CHAT_CONTEXT_TOKENS = int(os.environ.get('CHAT_CONTEXT_TOKENS', 3072))
+CHAT_FOLD_RATIO = 0.75 # Fold once unsummarized turns use this share of the budget
+CHAT_KEEP_RATIO = 0.4 # ...keeping about this share verbatim, so folds are infrequent
+CHAT_HISTORY_MAX_MESSAGES = 200 # Upper bound on unsummarized messages read per request
+CHARS_PER_TOKEN = 4 # Rough average for English text with Llama-family tokenizers
+MESSAGE_OVERHEAD_TOKENS = 4 # Role and template tokens per message
+SUMMARY_MAX_TOKENS = 300
+
+# --- System Prompts ---
+MARKETING_SYSTEM_PROMPT = """
+You are MarketMind, an AI marketing assistant for small business owners.
+Your goal is to help entrepreneurs promote their businesses effectively.
+Always provide practical marketing advice, content ideas, and growth strategies.
+Focus on cost-effective solutions that work well for small businesses with limited resources.
+Frame all your responses with marketing and business promotion in mind.
+"""
+# Built once: the prompt prefix must not vary between requests
+SYSTEM_MESSAGE = {"role": "system", "content": MARKETING_SYSTEM_PROMPT.strip()}
+SUMMARY_SYSTEM_PROMPT = """
+You maintain a running summary of a conversation between a small business owner and a marketing assistant.
+Merge the existing summary (if any) with the new messages into one updated summary of at most 200 words.
+Keep the business details, products, audience, tone preferences, decisions made and drafts agreed on.
+Write plain prose in the third person. Output only the summary.
+"""
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN) + MESSAGE_OVERHEAD_TOKENS
+
+def summary_message(summary):
+    return {"role": "system", "content": f"Summary of the earlier conversation:\n{summary['text']}"}
+
+
+def build_chat_messages(conversation_object_id, summary, history, user_input_topic):
+    """
+    Builds the message list for the next turn and, if the history has outgrown the budget,
+    schedules a background fold of the oldest turns into the summary.
+    `summary` and `history` come from load_or_create_conversation.
+    """
+    messages = [SYSTEM_MESSAGE]
+    if summary: messages.append(summary_message(summary))
+    history = [m for m in history if m.get('role') and m.get('content')]
+    history_tokens = [estimate_tokens(m['content']) for m in history]
+    available = CHAT_CONTEXT_TOKENS - sum(estimate_tokens(m['content']) for m in messages) - estimate_tokens(user_input_topic)
+
+    # Newest turns first until the budget is spent; normally everything since the last fold fits
+    kept, used = 0, 0
+    for tokens in reversed(history_tokens):
+        if used + tokens > available: break
+        kept, used = kept + 1, used + tokens
+    if kept < len(history): log.debug(f"Context budget dropped {len(history) - kept} of {len(history)} unsummarized message(s) of {conversation_object_id}.")
+    messages.extend({"role": m['role'], "content": m['content']} for m in history[len(history) - kept:])
+    messages.append({"role": "user", "content": user_input_topic})
+
+    if sum(history_tokens) > CHAT_FOLD_RATIO * available:
+        fold_end = _fold_boundary(history, history_tokens, CHAT_KEEP_RATIO * available)
+        if fold_end is not None: schedule_fold(conversation_object_id, summary, fold_end)
+    return messages
+
+def _fold_boundary(history, history_tokens, keep_tokens):
+    """
+    Position of the first message to keep verbatim: a user turn with ~keep_tokens after it,
+    or past the end (fold everything) if even the latest turn is over that. None if fewer
+    than two messages would be folded.
+    """
+    used, index = 0, len(history)
+    while index > 0 and used + history_tokens[index - 1] <= keep_tokens:
+        index -= 1; used += history_tokens[index]
+    while index < len(history) and history[index]['role'] != 'user': index += 1 # Don't split a turn
+    if index < 2: return None
+    return history[index]['n'] if index < len(history) else history[-1]['n'] + 1
+
+
+# --- Background Summaries ---
+_summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-summary")
+_pending_folds = set()
+_pending_lock = Lock()
+
+def schedule_fold(conversation_object_id, summary, fold_end):
+    """Queues one fold per conversation at a time; extra requests while one runs are dropped."""
+    with _pending_lock:
+        if conversation_object_id in _pending_folds: return
+        _pending_folds.add(conversation_object_id)
+    _summary_executor.submit(_fold, current_app._get_current_object(), conversation_object_id, summary, fold_end)
+
+def _fold(app, conversation_object_id, summary, fold_end):
+    previous_through = summary['through'] if summary else 0
+    try:
+        with app.app_context():
+            folded = get_message_range(conversation_object_id, previous_through, fold_end)
+            if not folded: return
+            text = summarize(summary['text'] if summary else None, folded)
+            if save_conversation_summary(conversation_object_id, text, fold_end, previous_through):
+                log.info(f"Folded messages {previous_through}-{fold_end - 1} of conversation {conversation_object_id} into its summary.")
+    except (requests.exceptions.RequestException, ValueError) as e:
+        log.warning(f"Could not summarize conversation {conversation_object_id}: {e}")
+    except Exception as e:
+        log.exception(f"Unexpected error summarizing conversation {conversation_object_id}: {type(e).__name__} - {e}")
+    finally:
+        with _pending_lock: _pending_folds.discard(conversation_object_id)
+
+def summarize(previous_summary, messages):
+    """Asks Ollama to merge `messages` into `previous_summary`. Raises ValueError on an empty answer."""
+    transcript = "\n\n".join(f"{m['role'].title()}: {m['content']}" for m in messages if m.get('content'))
+    prompt = f"Existing summary:\n{previous_summary or '(none)'}\n\nNew messages:\n{transcript}"
+    payload = ollama_payload("summary", stream=False, options={"num_predict": SUMMARY_MAX_TOKENS, "temperature": 0.2},
+                             messages=[{"role": "system", "content": SUMMARY_SYSTEM_PROMPT.strip()}, {"role": "user", "content": prompt}])
+    response = get_client('ollama').post("/api/chat", json=payload); response.raise_for_status()
+    text = response.json().get('message', {}).get('content', '').strip()
+    if not text: raise ValueError("Ollama returned an empty summary.")
+    return text
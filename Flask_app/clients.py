@@ -0,0 +1,181 @@
+# flask_app/clients.py
+
+# Pooled HTTP clients for the backend services (Ollama, A1111, XTTS, ComfyUI).
+# One requests.Session per backend keeps TCP connections alive between calls, and this
+# module is the single place to tune pool sizes, timeouts and retries:
+#   HTTP_POOL_SIZE            default connection pool size for every backend (10)
+#   <BACKEND>_POOL_SIZE       per-backend override, e.g. OLLAMA_POOL_SIZE=20
+#   <BACKEND>_TIMEOUT         per-backend read timeout in seconds, e.g. A1111_TIMEOUT=300
+#   HTTP_CONNECT_TIMEOUT      connect timeout in seconds for every backend (10)
+#   HTTP_MAX_RETRIES          retries for idempotent calls (GET/HEAD/OPTIONS) (3)
+# A backend's URL variable may list several nodes, comma-separated
+# (e.g. IMAGE_API_URL=http://gpu1:7860,http://gpu2:7860); routing.py picks one per call.
+# Calls made on behalf of a user first wait for a fair-share slot (see scheduling.py).
+
+import logging
+import os
+from threading import Lock
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .routing import EndpointRouter, start_health_probes
+from .instrumentation import span, operation_name
+from .scheduling import get_backend_gate, current_tenant
+
+log = logging.getLogger(__name__)
+
+# --- Backend Definitions ---
+# name -> (env var holding the base URL, default read timeout in seconds)
+BACKENDS = {
+    "ollama": ("OLLAMA_ENDPOINT", 90),
+    "a1111": ("IMAGE_API_URL", 180),
+    "xtts": ("XTTS_API_URL", 180),
+    "comfyui": ("VIDEO_API_URL", 60),
+}
+DEFAULT_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 10))
+MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 3))
+RETRY_BACKOFF_FACTOR = 0.5 # 0.5s, 1s, 2s between retries
+RETRY_STATUS_CODES = (502, 503, 504)
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+
+# --- Helper Function to get Config ---
+def get_config_or_raise(config_key, default=None):
+    value = os.environ.get(config_key)
+    if not value:
+        if default is not None: return default
+        error_msg = f"Config Error: Required env var '{config_key}' missing."
+        log.error(error_msg)
+        # In a real app, you might want to raise a more specific exception
+        # or handle this more gracefully depending on the context.
+        # For now, raising ValueError to make it obvious during development.
+        raise ValueError(error_msg)
+    return value
+
+
+class BackendClient:
+    """A keep-alive session for one backend, with its base URL, timeouts and retry policy."""
+
+    def __init__(self, name, url_config_key, read_timeout, pool_size):
+        self.name = name
+        self.url_config_key = url_config_key
+        self.timeout = (CONNECT_TIMEOUT, read_timeout)
+        # Connection errors are retried for every method (nothing was sent yet); read errors
+        # and 502/503/504 responses only for idempotent methods, so a POST never runs twice.
+        retry = Retry(total=MAX_RETRIES, connect=MAX_RETRIES, read=MAX_RETRIES, status=MAX_RETRIES,
+                      backoff_factor=RETRY_BACKOFF_FACTOR, status_forcelist=RETRY_STATUS_CODES,
+                      allowed_methods=IDEMPOTENT_METHODS, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._router = None
+        self._router_urls = None
+        self._router_lock = Lock()
+
+    @property
+    def router(self):
+        """The node router, rebuilt if the URL variable changes (e.g. set after import)."""
+        urls = [u.strip() for u in get_config_or_raise(self.url_config_key).split(',') if u.strip()]
+        if self._router is None or self._router_urls != urls:
+            with self._router_lock:
+                if self._router is None or self._router_urls != urls:
+                    self._router, self._router_urls = EndpointRouter(self.name, urls), urls
+        return self._router
+
+    @property
+    def base_url(self):
+        """The first configured node; used in log messages."""
+        return self.router.endpoints[0].url
+
+    def url(self, path):
+        return f"{self.base_url}{path}"
+
+    def request(self, method, path, affinity=None, endpoint_url=None, cost=1, **kwargs):
+        """
+        Sends the call to one node and returns the response, with the node's base URL in
+        `response.endpoint_url`. `affinity` keeps calls with the same key on the same node;
+        `endpoint_url` pins the call to a node. Unpinned calls that fail to connect are
+        retried on another node (any method for connect timeouts, idempotent ones otherwise).
+        `cost` is the call's weight in the fair-share queue (e.g. images in an A1111 batch).
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        tenant = current_tenant()
+        gate = get_backend_gate(self.name, len(self.router.endpoints)) if tenant is not None else None
+        if gate is not None: gate.acquire(tenant, cost)
+        try:
+            with span(self.name, operation_name(path)) as call:
+                response = self._send(method, path, affinity, endpoint_url, kwargs)
+                if response.status_code >= 500: call.fail(f"http_{response.status_code}")
+        except BaseException:
+            if gate is not None: gate.release()
+            raise
+        if gate is not None:
+            if kwargs.get('stream') and is_streaming(response): _release_on_close(response, gate.release)
+            else: gate.release()
+        return response
+
+    def _send(self, method, path, affinity, endpoint_url, kwargs):
+        router, tried = self.router, []
+        while True:
+            endpoint = router.acquire(affinity=affinity, endpoint_url=endpoint_url, exclude=tried)
+            try:
+                response = self.session.request(method, f"{endpoint.url}{path}", **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                router.release(endpoint, success=False)
+                tried.append(endpoint.url)
+                can_fail_over = isinstance(e, requests.exceptions.ConnectTimeout) or method.upper() in IDEMPOTENT_METHODS
+                if endpoint_url or not can_fail_over or len(tried) >= len(router.endpoints): raise
+                log.warning(f"{self.name} endpoint {endpoint.url} unreachable ({type(e).__name__}), trying another node.")
+                continue
+            except requests.exceptions.RequestException:
+                router.release(endpoint, success=False)
+                raise
+            response.endpoint_url = endpoint.url
+            success = response.status_code < 500
+            if kwargs.get('stream') and is_streaming(response):
+                # The node stays busy until the caller has consumed and closed the stream.
+                # Error responses are released now: callers raise on them, often without closing.
+                _release_on_close(response, lambda: router.release(endpoint, success))
+            else:
+                router.release(endpoint, success)
+            return response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+def is_streaming(response):
+    """True for a 2xx response to a stream=True call, whose body the caller goes on to read."""
+    return 200 <= response.status_code < 300
+
+def _release_on_close(response, release):
+    """Calls `release` once, when the streamed response is closed."""
+    close, released = response.close, []
+    def _close_and_release():
+        close()
+        if not released: released.append(True); release()
+    response.close = _close_and_release
+
+_clients = {}
+_clients_lock = Lock()
+
+def get_client(name):
+    """Returns the process-wide client for a backend ('ollama', 'a1111', 'xtts', 'comfyui')."""
+    with _clients_lock:
+        if name not in _clients:
+            url_config_key, default_timeout = BACKENDS[name]
+            read_timeout = float(os.environ.get(f"{name.upper()}_TIMEOUT", default_timeout))
+            pool_size = int(os.environ.get(f"{name.upper()}_POOL_SIZE", DEFAULT_POOL_SIZE))
+            _clients[name] = BackendClient(name, url_config_key, read_timeout, pool_size)
+        return _clients[name]
+
+def configured_routers():
+    """The current router of every backend whose URL variable is set."""
+    return [get_client(name).router for name, (url_config_key, _) in BACKENDS.items() if os.environ.get(url_config_key)]
+
+def start_backend_health_probes():
+    """Starts health probes for every backend whose URL variable is set (looked up again on each round)."""
+    if configured_routers(): start_health_probes(configured_routers)
@@ -0,0 +1,254 @@
+# flask_app/conversations.py
+
+# Conversation repository: every read/write of mongo.db.conversations goes through here.
+# The sidebar list uses a title-only projection with keyset pagination on
+# (last_updated, _id), so rendering the dashboard costs the same whether a user has 5 chats
+# or 500.
+#
+# Messages live in mongo.db.messages, in buckets of MESSAGE_BUCKET_SIZE per conversation
+# ({conversation_id, seq, messages: [...]}), and every message carries its position `n`.
+# The conversation document only keeps `message_count`, so appending a turn touches one
+# counter and one bucket, and reading the last N messages touches at most two buckets,
+# however long the chat gets. Conversations that still embed a `messages` array are moved
+# into buckets on first access, or all at once with `flask conversations migrate-messages`.
+#
+# Older turns of long chats are folded into `summary` ({text, through, updated_at}: a
+# summary of messages with n < through) by chat_context.py; chat reads skip those messages.
+
+import logging
+import os
+import click
+from datetime import datetime, timedelta
+from flask import Blueprint, request, jsonify
+from flask_login import login_required, current_user
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from . import mongo
+
+log = logging.getLogger(__name__)
+
+conversations = Blueprint('conversations', __name__)
+
+# --- Constants ---
+CONVERSATION_TITLE_LENGTH = 40
+CONVERSATION_PAGE_SIZE = int(os.environ.get('CONVERSATION_PAGE_SIZE', 30)) # Sidebar entries per page
+MESSAGE_PAGE_SIZE = int(os.environ.get('MESSAGE_PAGE_SIZE', 50)) # Chat messages per page
+# Fixed once data exists: positions map to buckets as n // MESSAGE_BUCKET_SIZE
+MESSAGE_BUCKET_SIZE = int(os.environ.get('MESSAGE_BUCKET_SIZE', 50))
+CONVERSATION_LIST_PROJECTION = {"title": 1, "last_updated": 1}
+_EPOCH = datetime(1970, 1, 1)
+
+
+def ensure_conversation_indexes():
+    # Serves the sidebar query (filter on user_id, sort on last_updated/_id) without an in-memory sort
+    mongo.db.conversations.create_index([("user_id", 1), ("last_updated", -1), ("_id", -1)])
+    mongo.db.messages.create_index([("conversation_id", 1), ("seq", 1)], unique=True)
+
+
+# --- Pagination Cursors ---
+# A cursor is "<last_updated in ms>-<_id>" of the last entry on the previous page. Mongo stores
+# datetimes with millisecond precision, so the round trip is exact.
+def encode_cursor(conversation_doc):
+    millis = (conversation_doc['last_updated'] - _EPOCH) // timedelta(milliseconds=1)
+    return f"{millis}-{conversation_doc['_id']}"
+
+def decode_cursor(cursor):
+    """Returns (last_updated, ObjectId). Raises ValueError for malformed cursors."""
+    millis, _, oid = (cursor or '').partition('-')
+    if not millis.isdigit() or not ObjectId.is_valid(oid): raise ValueError(f"Invalid cursor: {cursor}")
+    return _EPOCH + timedelta(milliseconds=int(millis)), ObjectId(oid)
+
+
+# --- Reads ---
+def list_conversations(user_id_obj, cursor=None, limit=CONVERSATION_PAGE_SIZE):
+    """
+    One sidebar page, newest first, with only _id/title/last_updated loaded.
+    Returns (conversations, next_cursor); next_cursor is None on the last page.
+    """
+    query = {"user_id": user_id_obj}
+    if cursor:
+        last_updated, oid = decode_cursor(cursor)
+        query["$or"] = [{"last_updated": {"$lt": last_updated}}, {"last_updated": last_updated, "_id": {"$lt": oid}}]
+    docs = list(mongo.db.conversations.find(query, CONVERSATION_LIST_PROJECTION)
+                .sort([("last_updated", -1), ("_id", -1)]).limit(limit + 1))
+    if len(docs) <= limit: return docs, None
+    return docs[:limit], encode_cursor(docs[limit - 1])
+
+def get_conversation_page(user_id_obj, conversation_object_id, offset=0, limit=MESSAGE_PAGE_SIZE):
+    """
+    Loads a conversation with one page of messages, counted back from the newest:
+    offset=0 is the latest `limit` messages, offset=limit the page before that, etc.
+    Returns the document with `messages` and `message_count`, or None if not found.
+    """
+    conv = _find_conversation(user_id_obj, conversation_object_id, {"title": 1, "last_updated": 1})
+    if not conv: return None
+    end = max(conv['message_count'] - offset, 0)
+    conv['messages'] = _read_message_range(conversation_object_id, max(end - limit, 0), end)
+    return conv
+
+def get_recent_messages(user_id_obj, conversation_object_id, limit):
+    """
+    The conversation's summary (or None) and its last `limit` messages not covered by the
+    summary, as (summary, messages); None if the conversation doesn't exist for this user.
+    """
+    conv = _find_conversation(user_id_obj, conversation_object_id, {"summary": 1})
+    if not conv: return None
+    summary = conv.get('summary')
+    start = max(conv['message_count'] - limit, summary['through'] if summary else 0)
+    return summary, _read_message_range(conversation_object_id, start, conv['message_count'])
+
+def get_message_range(conversation_object_id, start, end):
+    """Messages with positions start <= n < end, oldest first."""
+    return _read_message_range(conversation_object_id, start, end)
+
+def _find_conversation(user_id_obj, conversation_object_id, projection=None):
+    """Conversation header with `message_count`, migrating embedded messages first if needed."""
+    conv = mongo.db.conversations.find_one({"_id": conversation_object_id, "user_id": user_id_obj},
+                                           {**(projection or {}), "message_count": 1})
+    if conv and 'message_count' not in conv:
+        conv['message_count'] = migrate_embedded_messages(conversation_object_id)
+    return conv
+
+def _read_message_range(conversation_object_id, start, end):
+    """Messages with positions start <= n < end, oldest first. Reads only the buckets involved."""
+    if end <= start: return []
+    buckets = mongo.db.messages.find({"conversation_id": conversation_object_id,
+                                      "seq": {"$gte": start // MESSAGE_BUCKET_SIZE, "$lte": (end - 1) // MESSAGE_BUCKET_SIZE}},
+                                     {"messages": 1})
+    messages = [m for bucket in buckets for m in bucket['messages'] if start <= m['n'] < end]
+    messages.sort(key=lambda m: m['n'])
+    return messages
+
+
+# --- Writes ---
+def load_or_create_conversation(user_id_obj, conversation_id_str, user_input_topic, history_limit):
+    """
+    Returns (conversation_object_id, summary, history, found), where history holds at most
+    `history_limit` recent messages not folded into the summary. A new conversation titled
+    after the topic is created when the given id is missing or does not belong to the user.
+    """
+    if conversation_id_str and ObjectId.is_valid(conversation_id_str):
+        recent = get_recent_messages(user_id_obj, ObjectId(conversation_id_str), history_limit)
+        if recent is not None:
+            log.debug(f"Found existing conversation: {conversation_id_str}")
+            return (ObjectId(conversation_id_str), *recent, True)
+        log.warning(f"Conversation ID {conversation_id_str} not found for user {user_id_obj}, creating new.")
+    else:
+        log.debug("No valid conversation ID provided, creating new.")
+
+    title = user_input_topic[:CONVERSATION_TITLE_LENGTH] + ('...' if len(user_input_topic) > CONVERSATION_TITLE_LENGTH else '')
+    new_convo_doc = {"user_id": user_id_obj, "title": title, "created_at": datetime.utcnow(), "last_updated": datetime.utcnow(), "message_count": 0}
+    insert_result = mongo.db.conversations.insert_one(new_convo_doc)
+    log.debug(f"Created new conversation: {insert_result.inserted_id}")
+    return insert_result.inserted_id, None, [], False
+
+def save_chat_turn(conversation_object_id, user_input_topic, assistant_response):
+    """Appends the user message (and the assistant reply, if any) to the conversation."""
+    messages_to_save = [{"role": "user", "content": user_input_topic, "timestamp": datetime.utcnow()}]
+    if assistant_response: messages_to_save.append({"role": "assistant", "content": assistant_response, "timestamp": datetime.utcnow()})
+    append_messages(conversation_object_id, messages_to_save)
+    log.debug(f"Saved messages to conversation {conversation_object_id}")
+
+def append_messages(conversation_object_id, messages):
+    """
+    Reserves positions by incrementing message_count, then pushes each message into the
+    bucket for its position. Concurrent appends get disjoint positions, so reads stay
+    ordered even if their bucket writes interleave.
+    """
+    if mongo.db.conversations.count_documents({"_id": conversation_object_id, "messages": {"$exists": True}}, limit=1):
+        migrate_embedded_messages(conversation_object_id)
+    conv = mongo.db.conversations.find_one_and_update({"_id": conversation_object_id},
+                                                      {"$inc": {"message_count": len(messages)}, "$set": {"last_updated": datetime.utcnow()}},
+                                                      projection={"message_count": 1}, return_document=ReturnDocument.AFTER)
+    if not conv: raise ValueError(f"Conversation {conversation_object_id} no longer exists.")
+    first = conv['message_count'] - len(messages)
+    by_bucket = {}
+    for n, message in enumerate(messages, start=first):
+        by_bucket.setdefault(n // MESSAGE_BUCKET_SIZE, []).append({**message, "n": n})
+    for seq, bucket_messages in by_bucket.items():
+        update = {"$push": {"messages": {"$each": bucket_messages}}, "$set": {"updated_at": datetime.utcnow()}}
+        try:
+            mongo.db.messages.update_one({"conversation_id": conversation_object_id, "seq": seq}, update, upsert=True)
+        except DuplicateKeyError: # Lost an upsert race for a new bucket; it exists now
+            mongo.db.messages.update_one({"conversation_id": conversation_object_id, "seq": seq}, update)
+
+def save_conversation_summary(conversation_object_id, text, through, previous_through):
+    """
+    Stores a summary of messages n < through, unless another summary was saved since
+    `previous_through` was read. Returns True if this one was stored.
+    """
+    result = mongo.db.conversations.update_one({"_id": conversation_object_id, "summary.through": previous_through or None},
+                                               {"$set": {"summary": {"text": text, "through": through, "updated_at": datetime.utcnow()}}})
+    return result.modified_count == 1
+
+def migrate_embedded_messages(conversation_object_id):
+    """
+    Moves a legacy embedded `messages` array into buckets. Buckets are written first (as
+    whole-document replaces, so reruns are harmless) and the array is only dropped afterwards,
+    so an interrupted migration loses nothing. Returns the conversation's message_count.
+    """
+    conv = mongo.db.conversations.find_one({"_id": conversation_object_id, "messages": {"$exists": True}}, {"messages": 1})
+    if not conv: # Already bucketed (the common case): nothing but the filter is evaluated
+        conv = mongo.db.conversations.find_one({"_id": conversation_object_id}, {"message_count": 1})
+        return conv.get('message_count', 0) if conv else 0
+    legacy_messages = conv['messages'] or []
+    for seq in range((len(legacy_messages) + MESSAGE_BUCKET_SIZE - 1) // MESSAGE_BUCKET_SIZE):
+        chunk = legacy_messages[seq * MESSAGE_BUCKET_SIZE:(seq + 1) * MESSAGE_BUCKET_SIZE]
+        bucket_doc = {"conversation_id": conversation_object_id, "seq": seq, "updated_at": datetime.utcnow(),
+                      "messages": [{**m, "n": seq * MESSAGE_BUCKET_SIZE + i} for i, m in enumerate(chunk)]}
+        mongo.db.messages.replace_one({"conversation_id": conversation_object_id, "seq": seq}, bucket_doc, upsert=True)
+    # Only drop the array if it is still the one we copied
+    mongo.db.conversations.update_one({"_id": conversation_object_id, "messages": {"$size": len(legacy_messages)}},
+                                      {"$set": {"message_count": len(legacy_messages)}, "$unset": {"messages": ""}})
+    log.info(f"Migrated {len(legacy_messages)} embedded message(s) of conversation {conversation_object_id} into buckets.")
+    return len(legacy_messages)
+
+
+# --- CLI ---
+@conversations.cli.command('migrate-messages')
+@click.option('--limit', type=int, default=0, help='Migrate at most this many conversations (0 = all).')
+def migrate_messages_command(limit):
+    """Moves embedded conversation messages into the bucketed messages collection."""
+    ensure_conversation_indexes()
+    migrated = 0
+    cursor = mongo.db.conversations.find({"messages": {"$exists": True}}, {"_id": 1}, no_cursor_timeout=True)
+    try:
+        for conv in cursor:
+            migrate_embedded_messages(conv['_id'])
+            migrated += 1
+            if limit and migrated >= limit: break
+    finally:
+        cursor.close()
+    remaining = mongo.db.conversations.count_documents({"messages": {"$exists": True}})
+    click.echo(f"Migrated {migrated} conversation(s); {remaining} still embed messages.")
+
+
+# --- Routes (incremental loading for the dashboard) ---
+def _serialize_message(message):
+    timestamp = message.get('timestamp')
+    return {"role": message.get('role'), "content": message.get('content', ''),
+            "timestamp": timestamp.isoformat() + "Z" if timestamp else None}
+
+@conversations.route('/conversations', methods=['GET'])
+@login_required
+def list_conversations_page():
+    """Next sidebar page: ?cursor=<next_cursor from the previous page>."""
+    try:
+        docs, next_cursor = list_conversations(ObjectId(current_user.id), request.args.get('cursor'))
+    except ValueError as e: return jsonify({"error": str(e)}), 400
+    return jsonify({"conversations": [{"id": str(d['_id']), "title": d.get('title') or 'Untitled Chat'} for d in docs],
+                    "next_cursor": next_cursor})
+
+@conversations.route('/conversations/<conversation_id>/messages', methods=['GET'])
+@login_required
+def conversation_messages(conversation_id):
+    """Older messages: ?offset=<messages already shown>, returned oldest first."""
+    if not ObjectId.is_valid(conversation_id): return jsonify({"error": "Invalid conversation id."}), 404
+    offset = request.args.get('offset', '0')
+    if not offset.isdigit(): return jsonify({"error": "offset must be a non-negative integer."}), 400
+    conv = get_conversation_page(ObjectId(current_user.id), ObjectId(conversation_id), int(offset))
+    if not conv: return jsonify({"error": "Conversation not found."}), 404
+    next_offset = int(offset) + len(conv['messages'])
+    return jsonify({"messages": [_serialize_message(m) for m in conv['messages']],
+                    "next_offset": next_offset, "has_more": next_offset < conv['message_count']})
@@ -0,0 +1,364 @@
+# flask_app/generation.py
+
+# Backend calls for the GPU-backed generators (A1111 images, XTTS audio, ComfyUI video).
+# Shared by the synchronous dashboard routes in views.py and the background job workers
+# in jobs.py, so nothing in here touches request, session or flash. Failures are raised
+# (requests exceptions for transport errors, ValueError for unusable responses) and the
+# caller decides how to report them.
+
+import logging
+import os
+import requests
+import json
+import sqlite3
+import hashlib
+import contextvars
+import traceback # For more detailed error logging
+from concurrent.futures import ThreadPoolExecutor
+from .audio_cache import audio_cache, AUDIO_CACHE_ENABLED
+from .caching import LRUCache
+from .clients import get_client
+from .routing import AFFINITY_TTL_SECONDS
+from .workflows import workflow_registry, WorkflowError
+from .ollama_models import model_for, ollama_payload
+
+log = logging.getLogger(__name__)
+
+# --- SVD workflow template ---
+# Name of the template in WORKFLOW_TEMPLATES_DIR (file name without .json), see workflows.py
+SVD_WORKFLOW_NAME = os.environ.get('SVD_WORKFLOW_NAME', 'workflow_animated')
+
+# --- System Prompts ---
+IMAGE_PROMPT_REFINEMENT_SYSTEM_PROMPT = """
+You are an expert prompt engineer specializing in creating effective prompts for text-to-image models like Stable Diffusion.
+Take the following text, which might be a marketing idea, a description, or a simple user request, and transform it into a concise, descriptive, and visually rich prompt suitable for generating an image.
+Focus on keywords, objects, actions, environment, artistic style (e.g., photorealistic, illustration, watercolor, pixel art), composition (e.g., wide shot, close-up), and mood/lighting.
+Do not include conversational text, explanations, or apologies in your output. Only output the refined image prompt itself.
+"""
+
+IMAGE_PROMPT_VARIANTS_SYSTEM_PROMPT = """
+You are an expert prompt engineer specializing in creating effective prompts for text-to-image models like Stable Diffusion.
+Take the following text, which might be a marketing idea, a description, or a simple user request, and write {count} distinct, visually rich prompts for it.
+Vary the composition, setting, artistic style and mood between prompts while keeping the same subject and message.
+Respond only with JSON of the form {{"prompts": ["...", "..."]}} containing exactly {count} prompts.
+"""
+
+IMAGE_NEGATIVE_PROMPT = "ugly, deformed, blurry, text, watermark, signature, low quality"
+
+# --- Batch Image Generation Limits ---
+IMAGE_MAX_VARIANTS = int(os.environ.get('IMAGE_MAX_VARIANTS', 4)) # Prompt variants per batch request
+IMAGE_MAX_PER_VARIANT = int(os.environ.get('IMAGE_MAX_PER_VARIANT', 4)) # Images per prompt variant
+A1111_MAX_BATCH_SIZE = int(os.environ.get('A1111_MAX_BATCH_SIZE', 4)) # Images per A1111 pass (VRAM bound); more become n_iter
+A1111_BATCH_PARALLELISM = int(os.environ.get('A1111_BATCH_PARALLELISM', 1)) # Concurrent A1111 requests from one batch
+
+# --- Image Generation Caches ---
+# Tier 1: Ollama prompt refinements by (model, raw prompt)
+refinement_cache = LRUCache(max_entries=int(os.environ.get('REFINEMENT_CACHE_MAX_ENTRIES', 1024)))
+# Tier 2: A1111 outputs (base64) by full payload hash, only for pinned seeds
+image_cache = LRUCache(max_entries=int(os.environ.get('IMAGE_CACHE_MAX_ENTRIES', 256)),
+                       max_bytes=int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024)))
+# ComfyUI input images by (node url, content hash) -> filename on that node. Kept no longer
+# than the affinity binding that routes the same image back to the node.
+comfy_uploads = LRUCache(max_entries=1024, ttl=AFFINITY_TTL_SECONDS)
+
+# --- Helper Function to Fetch Speakers ---
+def fetch_speakers():
+    """
+    Fetches and normalizes the XTTS speaker list. Raises on transport/parse errors so
+    callers (the speaker cache) can tell a failed fetch from an empty list.
+    """
+    if not os.environ.get('XTTS_API_URL'):
+        log.warning("XTTS_API_URL not configured, cannot fetch speakers.")
+        return []
+    xtts_client = get_client('xtts')
+    # Assume common endpoint, verify with your specific XTTS API server docs
+    log.debug(f"Fetching speakers from {xtts_client.url('/speakers_list')}")
+    # Shorter read timeout than synthesis; GET is retried with backoff by the client
+    response = xtts_client.get("/speakers_list", timeout=(xtts_client.timeout[0], 15))
+    response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
+
+    available_speakers = []
+    speaker_data = response.json()
+    # Handle different potential response formats gracefully
+    if isinstance(speaker_data, list):
+        cleaned_speakers = [str(s).replace('.wav', '') for s in speaker_data if isinstance(s, str)]
+        available_speakers.extend(cleaned_speakers)
+    elif isinstance(speaker_data, dict):
+         # Common case: {"speakers": ["speaker1.wav", ...]}
+         if "speakers" in speaker_data and isinstance(speaker_data["speakers"], list):
+             cleaned_speakers = [str(s).replace('.wav', '') for s in speaker_data["speakers"] if isinstance(s, str)]
+             available_speakers.extend(cleaned_speakers)
+         # Another possible case: {"speaker1": {...}, "speaker2": {...}}
+         else:
+              available_speakers.extend([k for k in speaker_data.keys() if isinstance(k, str)])
+    # Filter out any empty strings that might have resulted
+    available_speakers = sorted([s for s in available_speakers if s]) # Sort for consistency
+    if not available_speakers:
+        log.warning("No speakers returned by XTTS or response format unexpected.")
+        log.debug("XTTS speakers_list response: %s", speaker_data)
+    else:
+        log.debug("Found speakers: %s", available_speakers)
+    return available_speakers
+
+
+# --- === ComfyUI SVD Payload Function === ---
+def upload_comfy_image(comfy_client, image_bytes, content_type):
+    """
+    Uploads an input image to a ComfyUI node unless that node already has it, and returns
+    (uploaded filename, node url). Images are named after their content hash, so a re-upload
+    overwrites the same file instead of adding another one to the node's input folder.
+    """
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    affinity = f"comfy-image:{digest}" # Same image, same node, so the upload is reused
+    endpoint_url = comfy_client.router.bound_endpoint(affinity)
+    uploaded_filename = comfy_uploads.get((endpoint_url, digest)) if endpoint_url and comfy_client.router.is_up(endpoint_url) else None
+    if uploaded_filename:
+        log.info(f"Reusing initial image '{uploaded_filename}' already uploaded to {endpoint_url}.")
+        return uploaded_filename, endpoint_url
+
+    extension = {"image/jpeg": "jpg", "image/webp": "webp"}.get(content_type, "png")
+    files = {'image': (f"init_svd_{digest[:16]}.{extension}", image_bytes, content_type)}
+    log.info(f"Uploading initial image ({len(image_bytes)} bytes) to ComfyUI: {comfy_client.url('/upload/image')}")
+    upload_response = comfy_client.post("/upload/image", files=files, data={"overwrite": "true"}, timeout=(comfy_client.timeout[0], 45), affinity=affinity)
+    upload_response.raise_for_status()
+    upload_data = upload_response.json()
+    uploaded_filename = upload_data.get("name")
+    if not uploaded_filename: raise ValueError(f"ComfyUI image upload failed. Response: {upload_data}")
+    log.info(f"Image uploaded successfully as: {uploaded_filename}")
+    comfy_uploads.set((upload_response.endpoint_url, digest), uploaded_filename)
+    return uploaded_filename, upload_response.endpoint_url
+
+def create_svd_payload_from_api_json(image_bytes, content_type="image/png"):
+    """
+    Creates the ComfyUI API payload from the preloaded SVD workflow template,
+    uploads the initial image (raw bytes), and injects the filename.
+    Returns (payload, node url); the prompt must be queued on the node that holds the image.
+    Raises WorkflowError (a ValueError) if the template is missing or invalid.
+    """
+    log.info(f"Creating SVD payload. Image Provided: {'Yes' if image_bytes else 'No'}")
+    if not image_bytes:
+        log.error("An initial image is required for the SVD workflow.")
+        return None, None
+
+    # Validated at startup; nodes are located by class_type, not by fixed ids
+    workflow = workflow_registry.get(SVD_WORKFLOW_NAME).instantiate()
+    if "load_image" not in workflow.template.roles: raise WorkflowError(f"Workflow '{SVD_WORKFLOW_NAME}' has no LoadImage node for the input image.")
+
+    try:
+        # 1. Upload Initial Image to ComfyUI (skipped if the node already has it)
+        uploaded_filename, endpoint_url = upload_comfy_image(get_client('comfyui'), image_bytes, content_type)
+
+        # 2. Inject uploaded filename into the LoadImage node
+        workflow.set_input("load_image", "image", uploaded_filename)
+        # 3. Set filename prefix on the save node (if it has one)
+        if "filename_prefix" in workflow.template.nodes.get(workflow.template.roles.get("video_output"), {}).get("inputs", {}):
+            workflow.set_input("video_output", "filename_prefix", "marketmind_SVD_output")
+        else:
+            log.warning(f"No save node with a filename_prefix found in workflow '{SVD_WORKFLOW_NAME}'.")
+
+        return {"prompt": workflow.to_prompt()}, endpoint_url
+
+    except requests.exceptions.RequestException as e: log.error(f"Failed to upload image to ComfyUI: {e}"); return None, None
+    except WorkflowError: raise
+    except Exception as e: log.error(f"Unexpected error in create_svd_payload: {type(e).__name__} - {e}\n{traceback.format_exc()}"); return None, None
+
+
+# --- Image Generation (Ollama refinement + A1111) ---
+def refine_image_prompt(user_input_prompt):
+    """
+    Asks Ollama to turn a marketing idea into a Stable Diffusion prompt. Falls back to the raw prompt.
+    Refinements are memoized per (model, prompt) in refinement_cache.
+    """
+    ollama_model = model_for("refine")
+    cache_key = (ollama_model, user_input_prompt)
+    refined_prompt = refinement_cache.get(cache_key)
+    if refined_prompt:
+        log.debug(f"Refinement cache hit for: '{user_input_prompt[:60]}'")
+        return refined_prompt
+
+    log.debug(f"Refining image prompt: '{user_input_prompt}'")
+    refinement_payload = ollama_payload("refine", messages=[{"role": "system", "content": IMAGE_PROMPT_REFINEMENT_SYSTEM_PROMPT.strip()}, {"role": "user", "content": user_input_prompt}], stream=False)
+    ollama_client = get_client('ollama')
+    refine_response = ollama_client.post("/api/chat", json=refinement_payload, timeout=(ollama_client.timeout[0], 60)); refine_response.raise_for_status()
+    refined_prompt = refine_response.json().get('message', {}).get('content', '').strip()
+    if not refined_prompt: return user_input_prompt # Don't memoize the fallback
+    refinement_cache.set(cache_key, refined_prompt)
+    log.debug(f"Refined prompt: '{refined_prompt}'")
+    return refined_prompt
+
+def parse_seed(seed_value):
+    """Form value -> A1111 seed. Empty/invalid means random (-1)."""
+    try:
+        seed = int(str(seed_value).strip())
+        return seed if seed >= 0 else -1
+    except (TypeError, ValueError):
+        return -1
+
+def build_a1111_payload(refined_prompt, init_image_b64=None, seed=-1):
+    """Returns (endpoint_path, payload) for img2img when an init image is given, txt2img otherwise."""
+    if init_image_b64: # Img2Img
+        payload = {"init_images": [init_image_b64], "prompt": refined_prompt, "negative_prompt": IMAGE_NEGATIVE_PROMPT, "steps": 30, "cfg_scale": 7, "sampler_index": "Euler a", "denoising_strength": 0.7, "seed": seed, "width": 512, "height": 512}
+        return "/sdapi/v1/img2img", payload
+    # Text2Img
+    payload = {"prompt": refined_prompt, "negative_prompt": IMAGE_NEGATIVE_PROMPT, "steps": 25, "cfg_scale": 7, "sampler_index": "Euler a", "seed": seed, "width": 512, "height": 512}
+    return "/sdapi/v1/txt2img", payload
+
+def image_cache_key(endpoint_path, payload):
+    """Hash of the full A1111 request. Only meaningful when the seed is pinned."""
+    return hashlib.sha256(json.dumps([endpoint_path, payload], sort_keys=True).encode('utf-8')).hexdigest()
+
+def generate_image_base64(refined_prompt, init_image_b64=None, seed=-1):
+    """
+    Runs one A1111 txt2img/img2img call and returns the first image as base64.
+    With a pinned seed the output is deterministic, so it is served from image_cache when possible.
+    """
+    a1111_client = get_client('a1111')
+    endpoint_path, payload = build_a1111_payload(refined_prompt, init_image_b64, seed)
+    cache_key = image_cache_key(endpoint_path, payload) if seed >= 0 else None
+    if cache_key:
+        cached_image = image_cache.get(cache_key)
+        if cached_image:
+            log.debug(f"Image cache hit {cache_key[:12]} (seed={seed})")
+            return cached_image
+
+    log.debug(f"Calling A1111 {'img2img' if init_image_b64 else 'txt2img'}: {a1111_client.url(endpoint_path)}")
+    img_response = a1111_client.post(endpoint_path, json=payload); img_response.raise_for_status()
+    response_data = img_response.json()
+    images = response_data.get('images')
+    if not images or not images[0]:
+        raise ValueError(f"A1111 API returned no image data. Response: {response_data.get('info', response_data)}")
+    log.debug("Image generated successfully.")
+    if cache_key: image_cache.set(cache_key, images[0])
+    return images[0]
+
+# --- Batched Image Variants ---
+def refine_image_prompt_variants(user_input_prompt, count):
+    """
+    Asks Ollama for `count` different Stable Diffusion prompts in a single call.
+    Short or unparseable answers are padded with the single-prompt refinement.
+    """
+    if count <= 1: return [refine_image_prompt(user_input_prompt)]
+    ollama_model = model_for("refine")
+    cache_key = (ollama_model, user_input_prompt, count)
+    variants = refinement_cache.get(cache_key)
+    if variants:
+        log.debug(f"Refinement cache hit for {count} variants of: '{user_input_prompt[:60]}'")
+        return list(variants)
+
+    log.debug(f"Refining {count} image prompt variants: '{user_input_prompt}'")
+    system_prompt = IMAGE_PROMPT_VARIANTS_SYSTEM_PROMPT.format(count=count).strip()
+    payload = ollama_payload("refine", messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_input_prompt}], format="json", stream=False)
+    ollama_client = get_client('ollama')
+    response = ollama_client.post("/api/chat", json=payload, timeout=(ollama_client.timeout[0], 90)); response.raise_for_status()
+    try:
+        prompts = json.loads(response.json().get('message', {}).get('content', '') or '{}').get('prompts', [])
+        variants = [p.strip() for p in prompts if isinstance(p, str) and p.strip()][:count]
+    except (json.JSONDecodeError, AttributeError) as e:
+        log.warning(f"Could not parse prompt variants from Ollama: {e}")
+        variants = []
+    if len(variants) == count: refinement_cache.set(cache_key, tuple(variants))
+    while len(variants) < count: variants.append(refine_image_prompt(user_input_prompt))
+    log.debug("Refined prompt variants: %s", variants)
+    return variants
+
+def plan_a1111_batches(requests_to_run):
+    """
+    Groups (endpoint_path, payload, image_count) requests whose payloads are identical, then
+    splits each group into A1111 calls of at most A1111_MAX_BATCH_SIZE images per pass
+    (batch_size) and as many passes as needed (n_iter). Returns [(endpoint_path, payload, image_count)].
+    """
+    groups = {}
+    for endpoint_path, payload, image_count in requests_to_run:
+        key = image_cache_key(endpoint_path, payload)
+        if key in groups: groups[key][2] += image_count
+        else: groups[key] = [endpoint_path, payload, image_count]
+    calls = []
+    for endpoint_path, payload, image_count in groups.values():
+        batch_size = min(image_count, A1111_MAX_BATCH_SIZE)
+        n_iter = -(-image_count // batch_size)
+        calls.append((endpoint_path, {**payload, "batch_size": batch_size, "n_iter": n_iter,
+                                      # Without this A1111 prepends a grid image for multi-image results
+                                      "override_settings": {"return_grid": False}, "override_settings_restore_afterwards": True},
+                       image_count))
+    return calls
+
+def _run_a1111_call(endpoint_path, payload, image_count):
+    a1111_client = get_client('a1111')
+    log.debug(f"Calling A1111 {endpoint_path} with batch_size={payload['batch_size']}, n_iter={payload['n_iter']}")
+    response = a1111_client.post(endpoint_path, json=payload, cost=image_count); response.raise_for_status()
+    images = [img for img in (response.json().get('images') or []) if img]
+    if not images: raise ValueError("A1111 API returned no image data for a batch.")
+    return images[-image_count:] # Drop a grid image if the server still added one
+
+def generate_image_variants(user_input_prompt, variant_count, images_per_variant, init_image_b64=None, seed=-1):
+    """
+    Generates `images_per_variant` images for each of `variant_count` refined prompts.
+    Returns [{"prompt", "image_base64"}], grouped by variant. Identical payloads are merged
+    into one batched A1111 call, and at most A1111_BATCH_PARALLELISM calls run at once.
+    """
+    variant_count = max(1, min(variant_count, IMAGE_MAX_VARIANTS))
+    images_per_variant = max(1, min(images_per_variant, IMAGE_MAX_PER_VARIANT))
+    variants = refine_image_prompt_variants(user_input_prompt, variant_count)
+    calls = plan_a1111_batches([(*build_a1111_payload(prompt, init_image_b64, seed), images_per_variant) for prompt in variants])
+    with ThreadPoolExecutor(max_workers=max(1, A1111_BATCH_PARALLELISM), thread_name_prefix="a1111-batch") as executor:
+        # Each call runs in a copy of this thread's context, so it is queued for the same user (see scheduling.py)
+        contexts = [contextvars.copy_context() for _ in calls]
+        call_results = list(executor.map(lambda context, call: context.run(_run_a1111_call, *call), contexts, calls))
+    gallery = []
+    for (endpoint_path, payload, image_count), images in zip(calls, call_results):
+        gallery.extend({"prompt": payload['prompt'], "image_base64": img} for img in images)
+    log.info(f"Generated {len(gallery)} image(s) for {len(variants)} variant(s) in {len(calls)} A1111 call(s).")
+    return gallery
+
+# --- Audio Generation (XTTS) ---
+def synthesize_speech(text_to_speak, language_code, speaker_id, use_cache=AUDIO_CACHE_ENABLED):
+    """Returns WAV bytes for the text, from the audio cache when possible, else via XTTS /tts_to_audio."""
+    cache_key = audio_cache.make_key(text_to_speak, language_code, speaker_id)
+    if use_cache:
+        try:
+            cached_wav = audio_cache.get(cache_key)
+            if cached_wav:
+                log.debug(f"Audio cache hit {cache_key[:12]} (lang={language_code}, speaker={speaker_id})")
+                return cached_wav
+        except (OSError, sqlite3.Error) as e:
+            log.warning(f"Audio cache lookup failed, synthesizing instead: {e}")
+
+    xtts_client = get_client('xtts')
+    xtts_api_endpoint = xtts_client.url("/tts_to_audio")
+    payload = {"text": text_to_speak, "language": language_code, "speaker_wav": speaker_id, "options": {}}
+    headers = {'Content-Type': 'application/json', 'Accept': 'audio/wav'}
+    log.debug(f"Calling XTTS: {xtts_api_endpoint} with lang={language_code}, speaker={speaker_id}")
+    tts_response = xtts_client.post("/tts_to_audio", json=payload, headers=headers); tts_response.raise_for_status()
+
+    if 'audio/wav' in tts_response.headers.get('Content-Type', '').lower() and tts_response.content:
+        log.debug("Audio generated successfully.")
+        if use_cache:
+            try: audio_cache.put(cache_key, tts_response.content)
+            except (OSError, sqlite3.Error) as e: log.warning(f"Could not store audio in cache: {e}")
+        return tts_response.content
+    log.warning(f"XTTS API did not return WAV audio. Status: {tts_response.status_code}, Content-Type: {tts_response.headers.get('Content-Type')}, Response text: {tts_response.text[:200]}")
+    raise ValueError(f"XTTS API error (Status {tts_response.status_code}) or unexpected response type.")
+
+# --- Video Generation (ComfyUI) ---
+def queue_svd_video(init_image_bytes, content_type="image/png"):
+    """
+    Uploads the init image (see image_prep.prepare_image), queues the SVD workflow on one
+    ComfyUI node and returns the prompt_id.
+    """
+    comfy_payload, endpoint_url = create_svd_payload_from_api_json(init_image_bytes, content_type)
+    if not comfy_payload or not comfy_payload.get("prompt"):
+         raise ValueError("Failed to create valid ComfyUI payload. Check logs and workflow configuration.")
+
+    comfy_client = get_client('comfyui')
+    log.info(f"Queueing ComfyUI video prompt: {comfy_client.url('/prompt')}")
+    # The uploaded image only exists on the node that received it
+    response = comfy_client.post("/prompt", json=comfy_payload, endpoint_url=endpoint_url); response.raise_for_status()
+    response_data = response.json(); prompt_id = response_data.get('prompt_id')
+    log.debug("ComfyUI Video Queue Response: %s", response_data)
+    if not prompt_id:
+        log.error(f"ComfyUI API call succeeded but did not return a prompt_id. Response: {response_data}")
+        raise ValueError("Error: Video job submitted but could not get Job ID from ComfyUI.")
+    # /history and /view for this prompt must be read from the same node (see video_tracker.track_prompt)
+    comfy_client.router.bind(f"prompt:{prompt_id}", response.endpoint_url)
+    log.info(f"Video job {prompt_id} submitted to {response.endpoint_url}.")
+    return prompt_id
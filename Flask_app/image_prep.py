@@ -0,0 +1,73 @@
+# flask_app/image_prep.py
+
+# Resizes and re-encodes init images before they are sent to a GPU backend.
+# Uploads arrive at whatever size and format the user picked (often multi-megapixel phone
+# photos), while img2img works at 512x512 and SVD at 1024x576: anything bigger is upload
+# bandwidth and backend decode/resize time spent on pixels the model throws away. Images are
+# decoded straight from the media store file (JPEGs at a reduced scale via draft mode),
+# center-cropped to the target aspect ratio, resized and re-encoded as JPEG (PNG if they have
+# transparency). Results are cached in memory by (media id, target); media ids are content
+# hashes, so entries never go stale.
+#   IMAGE_PREP_JPEG_QUALITY      JPEG quality of prepared images (92)
+#   IMAGE_PREP_CACHE_MAX_BYTES   memory for prepared images (64 MB)
+
+import io
+import os
+import base64
+import logging
+from PIL import Image, ImageOps, UnidentifiedImageError
+from .caching import LRUCache
+from .media import open_media
+
+log = logging.getLogger(__name__)
+
+# --- Targets ---
+# name -> (width, height) the model works at
+IMAGE_TARGETS = {
+    "sd": (512, 512), # A1111 img2img, see generation.build_a1111_payload
+    "svd": (1024, 576), # Stable Video Diffusion
+}
+IMAGE_PREP_JPEG_QUALITY = int(os.environ.get('IMAGE_PREP_JPEG_QUALITY', 92))
+
+prepared_cache = LRUCache(max_entries=256, max_bytes=int(os.environ.get('IMAGE_PREP_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+                          sizeof=lambda prepared: len(prepared[0]))
+
+
+def _has_alpha(image):
+    return image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+
+def prepare_image(media_id, target):
+    """
+    Returns (bytes, content_type) of a stored image cropped and resized to IMAGE_TARGETS[target].
+    Raises ValueError for unknown media ids and files that aren't readable images.
+    """
+    cache_key = (media_id, target)
+    cached = prepared_cache.get(cache_key)
+    if cached: return cached
+    size = IMAGE_TARGETS[target]
+
+    with open_media(media_id) as f:
+        try:
+            image = Image.open(f)
+            original_size = image.size
+            image.draft('RGB', size) # JPEG only: decode at 1/2, 1/4 or 1/8 scale while still >= size
+            image = ImageOps.exif_transpose(image) # Phone photos are often stored rotated
+            image = ImageOps.fit(image, size, method=Image.LANCZOS)
+        except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+            raise ValueError(f"The selected image could not be read: {e}")
+
+    output = io.BytesIO()
+    if _has_alpha(image):
+        image.convert('RGBA').save(output, format='PNG', compress_level=6)
+        content_type = 'image/png'
+    else:
+        image.convert('RGB').save(output, format='JPEG', quality=IMAGE_PREP_JPEG_QUALITY, optimize=True)
+        content_type = 'image/jpeg'
+    prepared = (output.getvalue(), content_type)
+    log.debug(f"Prepared image {media_id[:12]} for {target}: {original_size[0]}x{original_size[1]} -> {size[0]}x{size[1]} {content_type}, {len(prepared[0])} bytes.")
+    prepared_cache.set(cache_key, prepared)
+    return prepared
+
+def prepare_image_base64(media_id, target):
+    """prepare_image() as base64, for JSON APIs such as A1111's init_images."""
+    return base64.b64encode(prepare_image(media_id, target)[0]).decode('utf-8')
@@ -0,0 +1,177 @@
+# flask_app/instrumentation.py
+
+# Logging setup and latency metrics.
+# configure_logging() replaces the old print-based output with the standard logging module:
+#   LOG_LEVEL     DEBUG, INFO, WARNING or ERROR (INFO). DEBUG adds per-call timing lines.
+#   LOG_FORMAT    "text" or "json" (one JSON object per line, for log shippers) (text)
+# span() times one outbound backend call; BackendClient wraps every request in one, so
+# refinement (Ollama), diffusion (A1111), TTS (XTTS) and ComfyUI upload/queue calls are all
+# covered. MongoCommandMetrics times every Mongo command and init_app() times every route.
+# Everything is exported in Prometheus text format at GET /metrics:
+#   METRICS_TOKEN  bearer token scrapers send ("Authorization: Bearer <token>"); without it /metrics answers 403
+#   METRICS_PUBLIC "true" serves /metrics without a token, e.g. behind a private network (false)
+
+import os
+import re
+import json
+import time
+import logging
+from threading import Lock
+from contextlib import contextmanager
+from flask import Blueprint, Response, request, g, abort
+from pymongo import monitoring
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+log = logging.getLogger(__name__)
+
+metrics = Blueprint('metrics', __name__)
+
+# --- Constants ---
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_PUBLIC = os.environ.get('METRICS_PUBLIC', 'false').lower() in ('1', 'true', 'yes')
+# Backend calls range from milliseconds (Ollama /api/tags) to minutes (A1111 batches, long TTS)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+MONGO_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+# Path segments that are ids (ComfyUI prompt ids, ObjectIds, hashes) collapse into one label value
+ID_SEGMENT = re.compile(r"/(?=[0-9a-fA-F-]*\d)[0-9a-fA-F-]{16,}(?=/|$)")
+# Connection handshakes and auth, not application queries
+IGNORED_MONGO_COMMANDS = frozenset(["hello", "ismaster", "isMaster", "ping", "saslStart", "saslContinue", "endSessions", "buildInfo"])
+
+BACKEND_LATENCY = Histogram('marketmind_backend_request_seconds', 'Outbound backend call latency (until response headers).',
+                            ['backend', 'operation', 'outcome'], buckets=LATENCY_BUCKETS)
+BACKEND_ERRORS = Counter('marketmind_backend_errors_total', 'Failed outbound backend calls.', ['backend', 'operation', 'error'])
+BACKEND_IN_FLIGHT = Gauge('marketmind_backend_in_flight', 'Outbound backend calls in progress.', ['backend'])
+FAIR_QUEUE_WAIT = Histogram('marketmind_fair_queue_wait_seconds', 'Time backend calls waited for a fair-share slot (see scheduling.py).',
+                            ['backend'], buckets=LATENCY_BUCKETS)
+HTTP_LATENCY = Histogram('marketmind_http_request_seconds', 'Route latency (until the response is returned; SSE streams end earlier).',
+                         ['route', 'method', 'status'], buckets=LATENCY_BUCKETS)
+HTTP_ERRORS = Counter('marketmind_http_errors_total', 'Requests answered with a 5xx status or an unhandled exception.', ['route', 'method'])
+HTTP_IN_FLIGHT = Gauge('marketmind_http_in_flight', 'Requests being handled.')
+MONGO_LATENCY = Histogram('marketmind_mongo_command_seconds', 'Mongo command latency.', ['command', 'collection'], buckets=MONGO_LATENCY_BUCKETS)
+MONGO_ERRORS = Counter('marketmind_mongo_errors_total', 'Failed Mongo commands.', ['command', 'collection'])
+
+
+# --- Logging ---
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"ts": self.formatTime(record), "level": record.levelname, "logger": record.name, "msg": record.getMessage()}
+        if record.exc_info: entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def configure_logging():
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(message)s"))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    # Per-connection chatter from the HTTP and Mongo drivers only at DEBUG
+    for noisy in ("urllib3", "pymongo"): logging.getLogger(noisy).setLevel(max(logging.WARNING, root.level))
+
+
+# --- Backend Call Spans ---
+def operation_name(path):
+    """Metric label for a backend path: no query string, ids replaced (/history/<id> -> /history/:id)."""
+    return ID_SEGMENT.sub("/:id", path.split('?', 1)[0])
+
+class Span:
+    def __init__(self):
+        self.error = None
+
+    def fail(self, error):
+        """Marks the call as failed without an exception (e.g. a 5xx response)."""
+        self.error = error
+
+@contextmanager
+def span(backend, operation):
+    """Times one outbound call. Exceptions count as errors and propagate."""
+    current = Span()
+    in_flight = BACKEND_IN_FLIGHT.labels(backend)
+    in_flight.inc()
+    start = time.perf_counter()
+    try:
+        yield current
+    except Exception as e:
+        current.fail(type(e).__name__)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        in_flight.dec()
+        BACKEND_LATENCY.labels(backend, operation, "error" if current.error else "ok").observe(elapsed)
+        if current.error: BACKEND_ERRORS.labels(backend, operation, current.error).inc()
+        log.debug("span backend=%s operation=%s duration_ms=%.1f error=%s", backend, operation, elapsed * 1000, current.error)
+
+
+# --- Mongo Commands ---
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every command the app's MongoClient sends. Register before the client is created."""
+
+    def __init__(self):
+        self._collections = {} # request_id -> collection, from started to succeeded/failed
+        self._lock = Lock()
+
+    def started(self, event):
+        if event.command_name in IGNORED_MONGO_COMMANDS: return
+        collection = event.command.get(event.command_name)
+        with self._lock:
+            self._collections[event.request_id] = collection if isinstance(collection, str) else ""
+
+    def _pop(self, event):
+        with self._lock:
+            return self._collections.pop(event.request_id, None)
+
+    def succeeded(self, event):
+        collection = self._pop(event)
+        if collection is None: return
+        MONGO_LATENCY.labels(event.command_name, collection).observe(event.duration_micros / 1e6)
+        log.debug("mongo command=%s collection=%s duration_ms=%.1f", event.command_name, collection, event.duration_micros / 1000)
+
+    def failed(self, event):
+        collection = self._pop(event)
+        if collection is None: return
+        MONGO_LATENCY.labels(event.command_name, collection).observe(event.duration_micros / 1e6)
+        MONGO_ERRORS.labels(event.command_name, collection).inc()
+
+
+_mongo_listener = None
+
+def register_mongo_listener():
+    """Registers MongoCommandMetrics once; only clients created afterwards report to it."""
+    global _mongo_listener
+    if _mongo_listener is None:
+        _mongo_listener = MongoCommandMetrics()
+        monitoring.register(_mongo_listener)
+
+
+# --- Routes ---
+def init_app(app):
+    """Times every request by route template (url_rule), not by concrete URL."""
+    @app.before_request
+    def _start_timer():
+        g._request_started = time.perf_counter()
+        HTTP_IN_FLIGHT.inc()
+
+    @app.after_request
+    def _record_status(response):
+        g._response_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def _observe(exc):
+        started = g.pop('_request_started', None)
+        if started is None: return
+        HTTP_IN_FLIGHT.dec()
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        if route == "/metrics": return
+        status = g.pop('_response_status', 500 if exc else 200)
+        HTTP_LATENCY.labels(route, request.method, str(status)).observe(time.perf_counter() - started)
+        if status >= 500: HTTP_ERRORS.labels(route, request.method).inc()
+
+@metrics.route('/metrics')
+def prometheus_metrics():
+    """Prometheus scrape endpoint for this process."""
+    if not METRICS_PUBLIC:
+        if not METRICS_TOKEN: abort(403) # Per-route and per-backend traffic isn't public by default
+        if request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}": abort(401)
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
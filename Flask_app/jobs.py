@@ -0,0 +1,242 @@
+# flask_app/jobs.py
+
+# Background job queue for the GPU-backed generators.
+# Image (A1111), audio (XTTS) and video (ComfyUI) requests are stored in mongo.db.jobs and
+# executed by a bounded worker pool per backend, so the web request returns a job id right
+# away and the browser polls /jobs/<job_id> for the result instead of holding a WSGI worker
+# for the whole inference. Queued jobs are started in fair-share order across users (see
+# scheduling.py) and submissions spend the user's rate-limit tokens (see rate_limit.py).
+
+import logging
+import os
+import math
+import requests
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from datetime import datetime, timedelta
+from flask import Blueprint, request, jsonify, url_for, current_app
+from flask_login import login_required, current_user
+from bson.objectid import ObjectId
+from . import mongo
+from .generation import (refine_image_prompt, generate_image_base64, parse_seed,
+                         generate_image_variants, IMAGE_MAX_VARIANTS, IMAGE_MAX_PER_VARIANT,
+                         queue_svd_video)
+from .speakers import get_available_speakers
+from .speech import synthesize_long_form
+from .audio_delivery import deliver_audio, audio_filename
+from .media import is_valid_media_id, store_media_base64, media_url
+from .image_prep import prepare_image, prepare_image_base64
+from .video_tracker import track_prompt
+from .scheduling import FairQueue, tenant_scope, backend_concurrency
+from .rate_limit import check_rate_limit, RateLimited
+
+log = logging.getLogger(__name__)
+
+jobs = Blueprint('jobs', __name__)
+
+# --- Constants ---
+# Which backend (and therefore which worker pool) each job kind runs on
+JOB_KIND_BACKENDS = {"image": "a1111", "image_batch": "a1111", "audio": "xtts", "video": "comfyui"}
+# Rate-limit bucket each job kind spends from
+JOB_KIND_RATE_BUCKETS = {"image": "image", "image_batch": "image", "audio": "audio", "video": "video"}
+# Jobs allowed to wait per backend on top of the running ones before submissions are rejected
+JOB_MAX_QUEUED = int(os.environ.get('JOB_MAX_QUEUED', 50))
+# A queued/running job not updated for this long is reported as failed (e.g. after a restart)
+JOB_STALE_SECONDS = int(os.environ.get('JOB_STALE_SECONDS', 900))
+JOB_ACTIVE_STATUSES = ("queued", "running")
+
+
+class JobQueueFull(Exception):
+    """Raised when a backend already has its maximum number of queued jobs."""
+
+
+class BackendPool:
+    """
+    A fixed-size thread pool for one backend with a cap on how many jobs may wait. Waiting
+    jobs are started in FairQueue order, so one user's burst doesn't hold up everyone else.
+    """
+
+    def __init__(self, backend, max_workers, max_queued):
+        self.backend = backend
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"job-{backend}")
+        self._slots = BoundedSemaphore(max_workers + max_queued)
+        self._queue = FairQueue()
+        self._queue_lock = Lock()
+
+    def submit(self, fn, *args, tenant=None, cost=1):
+        """Queues fn(*args) for `tenant` (a user id), weighted by `cost`."""
+        if not self._slots.acquire(blocking=False):
+            raise JobQueueFull(f"The {self.backend} queue is full. Please try again in a moment.")
+        with self._queue_lock: self._queue.push(tenant, (tenant, fn, args), cost)
+        # Each executor task runs whichever queued job is due next, not necessarily this one
+        future = self._executor.submit(self._run_next)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _run_next(self):
+        with self._queue_lock: tenant, fn, args = self._queue.pop()
+        with tenant_scope(tenant): fn(*args)
+
+
+_pools = {}
+_pools_lock = Lock()
+
+def get_backend_pool(backend):
+    """Returns the process-wide pool for a backend, creating it on first use."""
+    with _pools_lock:
+        if backend not in _pools:
+            max_workers = backend_concurrency(backend)
+            _pools[backend] = BackendPool(backend, max_workers, JOB_MAX_QUEUED)
+            log.info(f"Started {backend} job pool with {max_workers} worker(s).")
+        return _pools[backend]
+
+
+# --- Job Handlers (run on the worker threads; return the JSON-serializable result) ---
+def _run_image_job(params):
+    refined_prompt = refine_image_prompt(params['prompt'])
+    init_image_b64 = prepare_image_base64(params['init_image_id'], 'sd') if params.get('init_image_id') else None
+    image_b64 = generate_image_base64(refined_prompt, init_image_b64, params.get('seed', -1))
+    image_id = store_media_base64(image_b64, 'image/png', params.get('user_id'))
+    return {"refined_prompt": refined_prompt, "image_id": image_id}
+
+def _run_image_batch_job(params):
+    init_image_b64 = prepare_image_base64(params['init_image_id'], 'sd') if params.get('init_image_id') else None
+    gallery = generate_image_variants(params['prompt'], params['variants'], params['images_per_variant'], init_image_b64, params.get('seed', -1))
+    return {"images": [{"prompt": item['prompt'], "image_id": store_media_base64(item['image_base64'], 'image/png', params.get('user_id'))} for item in gallery]}
+
+def _run_audio_job(params):
+    wav_bytes = synthesize_long_form(params['text'], params['language_code'], params['speaker_id'])
+    audio_id, content_type = deliver_audio(wav_bytes, params.get('user_id'))
+    return {"audio_id": audio_id, "audio_filename": audio_filename(f"generated_audio_{audio_id[:12]}", content_type)}
+
+def _run_video_job(params):
+    prompt_id = queue_svd_video(*prepare_image(params['init_image_id'], 'svd'))
+    track_prompt(prompt_id, params.get('user_id'))
+    return {"prompt_id": prompt_id, "status_message": f"Video generation job submitted (ID: {prompt_id}). It will appear here when rendering finishes."}
+
+JOB_HANDLERS = {"image": _run_image_job, "image_batch": _run_image_batch_job, "audio": _run_audio_job, "video": _run_video_job}
+
+
+# --- Job Lifecycle ---
+def ensure_job_indexes():
+    mongo.db.jobs.create_index([("user_id", 1), ("created_at", -1)])
+
+def job_cost(kind, params):
+    """Relative GPU work of a job: images for batches, 1 otherwise."""
+    if kind == "image_batch": return params['variants'] * params['images_per_variant']
+    return 1
+
+def submit_job(kind, user_id_obj, params):
+    """
+    Records a queued job and hands it to the backend's pool. `params` are stored on the
+    job document, so large inputs are passed by media id. Returns the job's ObjectId.
+    """
+    backend = JOB_KIND_BACKENDS[kind]
+    now = datetime.utcnow()
+    job_doc = {"user_id": user_id_obj, "kind": kind, "backend": backend, "status": "queued",
+               "params": params, "result": None, "error": None,
+               "created_at": now, "updated_at": now, "started_at": None, "finished_at": None}
+    job_id = mongo.db.jobs.insert_one(job_doc).inserted_id
+    app = current_app._get_current_object()
+    try:
+        get_backend_pool(backend).submit(_execute_job, app, job_id, kind, {**params, "user_id": user_id_obj}, tenant=user_id_obj, cost=job_cost(kind, params))
+    except JobQueueFull as e:
+        _finish_job(job_id, error=str(e))
+        raise
+    log.info(f"Queued {kind} job {job_id} on {backend}.")
+    return job_id
+
+def _finish_job(job_id, result=None, error=None):
+    now = datetime.utcnow()
+    mongo.db.jobs.update_one({"_id": job_id}, {"$set": {"status": "failed" if error else "succeeded", "result": result, "error": error, "updated_at": now, "finished_at": now}})
+
+def _execute_job(app, job_id, kind, params):
+    with app.app_context():
+        now = datetime.utcnow()
+        mongo.db.jobs.update_one({"_id": job_id}, {"$set": {"status": "running", "started_at": now, "updated_at": now}})
+        try:
+            _finish_job(job_id, result=JOB_HANDLERS[kind](params))
+            log.info(f"{kind} job {job_id} succeeded.")
+        except requests.exceptions.Timeout: log.error(f"Timeout in {kind} job {job_id}."); _finish_job(job_id, error=f"Error: The request to the {kind} generation service timed out.")
+        except requests.exceptions.RequestException as e: log.error(f"RequestException in {kind} job {job_id}: {e}"); _finish_job(job_id, error=f"Error connecting to {kind} generation service: {e}")
+        except ValueError as e: log.error(f"ValueError in {kind} job {job_id}: {e}"); _finish_job(job_id, error=str(e))
+        except Exception as e: log.error(f"Unexpected error in {kind} job {job_id}: {type(e).__name__} - {e}\n{traceback.format_exc()}"); _finish_job(job_id, error=f"An unexpected error occurred: {e}")
+
+def serialize_job(job_doc):
+    """JSON view of a job document; stale queued/running jobs are reported (and stored) as failed."""
+    if job_doc['status'] in JOB_ACTIVE_STATUSES and datetime.utcnow() - job_doc['updated_at'] > timedelta(seconds=JOB_STALE_SECONDS):
+        job_doc['status'], job_doc['error'] = "failed", "Job was interrupted before it finished. Please try again."
+        _finish_job(job_doc['_id'], error=job_doc['error'])
+    result = job_doc.get('result')
+    if result and result.get('image_id'): result = {**result, "image_url": media_url(result['image_id'])}
+    if result and result.get('audio_id'): result = {**result, "audio_url": media_url(result['audio_id'])}
+    if result and result.get('images'): result = {**result, "images": [{**img, "image_url": media_url(img['image_id'])} for img in result['images']]}
+    if result and result.get('prompt_id'): result = {**result, "video_status_url": url_for('videos.video_status', prompt_id=result['prompt_id'])}
+    return {"job_id": str(job_doc['_id']), "kind": job_doc['kind'], "status": job_doc['status'],
+            "params": job_doc.get('params', {}), "result": result, "error": job_doc.get('error'),
+            "created_at": job_doc['created_at'].isoformat() + "Z",
+            "finished_at": job_doc['finished_at'].isoformat() + "Z" if job_doc.get('finished_at') else None}
+
+
+# --- Routes ---
+def _parse_count(value, maximum, label):
+    try: count = int(value or 1)
+    except ValueError: raise ValueError(f"{label} must be a whole number.")
+    if not 1 <= count <= maximum: raise ValueError(f"{label} must be between 1 and {maximum}.")
+    return count
+
+@jobs.route('/jobs/<kind>', methods=['POST'])
+@login_required
+def submit_generation_job(kind):
+    """Validates a dashboard form submission and queues it. Responds 202 with the job id."""
+    from .views import SUPPORTED_LANGUAGES # views owns the language list shown in the dashboard
+    if kind not in JOB_KIND_BACKENDS: return jsonify({"error": f"Unknown job type: {kind}"}), 404
+    if mongo.db is None: return jsonify({"error": "Database unavailable."}), 503
+
+    conversation_id_str = request.form.get('conversation_id')
+    init_image_id = request.form.get('last_init_image_id')
+    if not is_valid_media_id(init_image_id): init_image_id = None
+    params = {"conversation_id": conversation_id_str}
+
+    try:
+        if not conversation_id_str or not ObjectId.is_valid(conversation_id_str): raise ValueError(f"Cannot generate {kind} without an active conversation.")
+        if kind in ("image", "image_batch"):
+            params['prompt'] = request.form.get('image_prompt', '').strip()
+            if not params['prompt']: raise ValueError("Image prompt cannot be empty.")
+            params['seed'] = parse_seed(request.form.get('image_seed'))
+            params['init_image_id'] = init_image_id
+            if kind == "image_batch":
+                params['variants'] = _parse_count(request.form.get('image_variants'), IMAGE_MAX_VARIANTS, "Prompt variants")
+                params['images_per_variant'] = _parse_count(request.form.get('images_per_variant'), IMAGE_MAX_PER_VARIANT, "Images per variant")
+        elif kind == "audio":
+            params['text'] = request.form.get('audio_text', '').strip()
+            params['language_code'] = request.form.get('language_code', 'en')
+            if not params['text']: raise ValueError("Text for audio generation cannot be empty.")
+            if params['language_code'] not in SUPPORTED_LANGUAGES: raise ValueError(f"Invalid language code selected: {params['language_code']}")
+            available_speakers = get_available_speakers(wait_timeout=15)
+            if not available_speakers: raise ValueError("No speakers are available/loaded from the TTS service.")
+            speaker_id = request.form.get('speaker_id')
+            params['speaker_id'] = speaker_id if speaker_id in available_speakers else available_speakers[0]
+        elif kind == "video":
+            params['video_prompt'] = request.form.get('video_prompt', '').strip()
+            if not init_image_id: raise ValueError("Input image required for video generation. Upload/generate one first.")
+            params['init_image_id'] = init_image_id
+
+        check_rate_limit(JOB_KIND_RATE_BUCKETS[kind], current_user.id, job_cost(kind, params))
+        job_id = submit_job(kind, ObjectId(current_user.id), params)
+    except ValueError as e: return jsonify({"error": str(e)}), 400
+    except RateLimited as e: return jsonify({"error": str(e), "retry_after": math.ceil(e.retry_after)}), 429, {"Retry-After": str(math.ceil(e.retry_after))}
+    except JobQueueFull as e: return jsonify({"error": str(e)}), 503
+
+    return jsonify({"job_id": str(job_id), "status": "queued", "status_url": url_for('jobs.job_status', job_id=str(job_id))}), 202
+
+@jobs.route('/jobs/<job_id>', methods=['GET'])
+@login_required
+def job_status(job_id):
+    """Polling endpoint: status, and the result once the job has succeeded."""
+    if not ObjectId.is_valid(job_id): return jsonify({"error": "Invalid job id."}), 404
+    job_doc = mongo.db.jobs.find_one({"_id": ObjectId(job_id), "user_id": ObjectId(current_user.id)})
+    if not job_doc: return jsonify({"error": "Job not found."}), 404
+    return jsonify(serialize_job(job_doc))
@@ -0,0 +1,94 @@
+# flask_app/media.py
+
+# Content-addressed media store for generated and uploaded images.
+# Blobs are written once under MEDIA_DIR, named by the SHA-256 of their bytes, with their
+# content type recorded in mongo.db.media. Pages and forms only carry the 64-char id and the
+# browser fetches the bytes from /media/<id>, which supports ETag/If-None-Match and Range.
+
+import logging
+import os
+import re
+import base64
+import hashlib
+from datetime import datetime
+from flask import Blueprint, request, jsonify, url_for, send_file, abort
+from flask_login import login_required, current_user
+from bson.objectid import ObjectId
+from . import mongo
+
+log = logging.getLogger(__name__)
+
+media = Blueprint('media', __name__)
+
+MEDIA_DIR = os.environ.get('MEDIA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'media'))
+MEDIA_ID_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+ALLOWED_UPLOAD_TYPES = {"image/png", "image/jpeg", "image/webp"}
+MEDIA_MAX_AGE = 365 * 24 * 3600 # Content never changes for a given id
+
+
+def is_valid_media_id(media_id):
+    return bool(media_id) and bool(MEDIA_ID_PATTERN.match(media_id))
+
+def _media_path(media_id):
+    return os.path.join(MEDIA_DIR, media_id[:2], media_id)
+
+def store_media(data, content_type, user_id_obj=None):
+    """Stores bytes (deduplicated by content hash) and returns the media id."""
+    media_id = hashlib.sha256(data).hexdigest()
+    path = _media_path(media_id)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f: f.write(data)
+        os.replace(tmp_path, path)
+    mongo.db.media.update_one({"_id": media_id},
+                              {"$setOnInsert": {"content_type": content_type, "size": len(data), "created_at": datetime.utcnow(), "created_by": user_id_obj}},
+                              upsert=True)
+    return media_id
+
+def store_media_base64(data_b64, content_type, user_id_obj=None):
+    return store_media(base64.b64decode(data_b64), content_type, user_id_obj)
+
+def open_media(media_id):
+    """Opens the stored blob for reading (binary). Raises ValueError for unknown ids."""
+    if not is_valid_media_id(media_id): raise ValueError(f"Invalid media id: {media_id}")
+    try:
+        return open(_media_path(media_id), 'rb')
+    except FileNotFoundError:
+        raise ValueError("The selected image is no longer available. Please upload or generate it again.")
+
+def load_media_bytes(media_id):
+    """Returns the stored bytes. Raises ValueError for unknown ids."""
+    with open_media(media_id) as f: return f.read()
+
+def load_media_base64(media_id):
+    return base64.b64encode(load_media_bytes(media_id)).decode('utf-8')
+
+def media_url(media_id):
+    return url_for('media.serve_media', media_id=media_id)
+
+
+# --- Routes ---
+@media.route('/media/<media_id>', methods=['GET'])
+@login_required
+def serve_media(media_id):
+    """Streams a blob with a strong ETag (its hash), long-lived caching and Range support. ?download=<name> saves it as a file."""
+    if not is_valid_media_id(media_id): abort(404)
+    path = _media_path(media_id)
+    if not os.path.exists(path): abort(404)
+    media_doc = mongo.db.media.find_one({"_id": media_id}, {"content_type": 1}) or {}
+    download_name = request.args.get('download')
+    response = send_file(path, mimetype=media_doc.get('content_type', 'application/octet-stream'), as_attachment=bool(download_name),
+                         download_name=download_name or None, conditional=True, etag=media_id, max_age=MEDIA_MAX_AGE)
+    response.headers['Cache-Control'] = f"private, max-age={MEDIA_MAX_AGE}, immutable"
+    return response
+
+@media.route('/media', methods=['POST'])
+@login_required
+def upload_media():
+    """Accepts an image upload from the dashboard and returns its media id."""
+    upload = request.files.get('file')
+    if not upload or not upload.filename: return jsonify({"error": "No file uploaded."}), 400
+    if upload.mimetype not in ALLOWED_UPLOAD_TYPES: return jsonify({"error": "Invalid file type. Please upload PNG, JPEG, or WEBP."}), 400
+    media_id = store_media(upload.read(), upload.mimetype, ObjectId(current_user.id))
+    return jsonify({"media_id": media_id, "url": media_url(media_id)}), 201
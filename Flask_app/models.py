@@ -1,10 +1,30 @@
-from flask_login import UserMixin
+import logging
+import os
 from bson.objectid import ObjectId
 from datetime import datetime
 from werkzeug.security import generate_password_hash
 from . import mongo
+from .caching import LRUCache
+
+log = logging.getLogger(__name__)
+
+# Users loaded for the session (login_manager.user_loader) are cached in-process, so
+# authenticated requests don't each start with a Mongo lookup. Entries expire after
+# USER_CACHE_TTL seconds, which bounds how stale another process's cached copy can get;
+# code that changes or deletes an account calls User.invalidate to drop this process's copy.
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 60)) # seconds
+USER_CACHE_MAX_ENTRIES = int(os.environ.get('USER_CACHE_MAX_ENTRIES', 10000))
+
+user_cache = LRUCache(max_entries=USER_CACHE_MAX_ENTRIES, ttl=USER_CACHE_TTL)
+
+class User:
+    # The interface Flask-Login expects (as in UserMixin, which has no __slots__)
+    __slots__ = ('id', 'email', 'password', 'first_name', 'created_at')
+    __hash__ = object.__hash__
+    is_active = True
+    is_authenticated = True
+    is_anonymous = False
 
-class User(UserMixin):
     def __init__(self, user_data):
         self.id = str(user_data.get('_id', ''))
         self.email = user_data.get('email', 'Unknown')
@@ -12,13 +32,20 @@ class User(UserMixin):
         self.first_name = user_data.get('first_name', 'Unknown')
         self.created_at = user_data.get('created_at', datetime.utcnow())
 
+    def get_id(self):
+        return self.id
+
+    def __eq__(self, other):
+        if isinstance(other, User): return self.id == other.id
+        return NotImplemented
+
     @staticmethod
     def get_by_email(email):
         try:
             user_data = mongo.db.users.find_one({"email": email.lower().strip()})
             return User(user_data) if user_data else None
         except Exception as e:
-            print(f"Error in get_by_email: {e}")
+            log.error(f"Error in get_by_email: {e}")
             return None
 
     @staticmethod
@@ -35,17 +62,42 @@ class User(UserMixin):
             result = mongo.db.users.insert_one(user_data)
             return User.get_by_id(str(result.inserted_id))
         except Exception as e:
-            print(f"Error in create: {e}")
+            log.error(f"Error in create: {e}")
             return None
 
     @staticmethod
     def get_by_id(user_id):
         if not ObjectId.is_valid(user_id):
-            print(f"Invalid ObjectId: {user_id}")
+            log.warning(f"Invalid ObjectId: {user_id}")
             return None
         try:
             user_data = mongo.db.users.find_one({"_id": ObjectId(user_id)})
             return User(user_data) if user_data else None
         except Exception as e:
-            print(f"Error in get_by_id: {e}")
-            return None
\ No newline at end of file
+            log.error(f"Error in get_by_id: {e}")
+            return None
+
+    @staticmethod
+    def load_cached(user_id):
+        """
+        The session user, from the cache when possible. The cached object is shared between
+        requests and has no password hash; use get_by_id/get_by_email to check passwords.
+        """
+        user = user_cache.get(user_id)
+        if user is not None: return user
+        if not ObjectId.is_valid(user_id):
+            log.warning(f"Invalid ObjectId in session: {user_id}")
+            return None
+        if mongo.db is None:
+            log.warning("mongo.db is None, cannot load the session user.")
+            return None
+        user_data = mongo.db.users.find_one({"_id": ObjectId(user_id)}, {"password": 0})
+        if not user_data: return None # Not cached: a deleted account stays logged out
+        user = User(user_data)
+        user_cache.set(user_id, user)
+        return user
+
+    @staticmethod
+    def invalidate(user_id):
+        """Drops the cached session user, e.g. after its profile or password changed or it was deleted."""
+        user_cache.pop(str(user_id))
@@ -0,0 +1,136 @@
+# flask_app/ollama_models.py
+
+# Which Ollama model serves each kind of request, how long Ollama keeps it loaded, and
+# keeping it loaded. Ollama unloads an idle model after its keep_alive (5 minutes by
+# default), and the next request then pays the full load before its first token.
+# ModelWarmer loads every configured model on every Ollama node at startup and re-pings
+# them every OLLAMA_PING_INTERVAL seconds so they stay resident.
+#   OLLAMA_MODEL              chat and campaign copy
+#   OLLAMA_REFINE_MODEL       image prompt refinement (OLLAMA_MODEL); a small model cuts refinement time
+#   OLLAMA_SUMMARY_MODEL      conversation summaries (OLLAMA_REFINE_MODEL)
+#   OLLAMA_<CLASS>_KEEP_ALIVE per request class: a Go duration (2h, 1h30m), seconds (300) or -1 (never unload)
+#   OLLAMA_WARMUP             "false" disables the warm-up and the pings (true)
+#   OLLAMA_PING_INTERVAL      seconds between keep-resident pings (240)
+
+import logging
+import os
+import re
+import time
+import requests
+from threading import Lock, Thread
+from .clients import get_client, get_config_or_raise
+
+log = logging.getLogger(__name__)
+
+# --- Request Classes ---
+# class -> (env var naming its model, class whose model it falls back to, default keep_alive)
+REQUEST_CLASSES = {
+    "chat": ("OLLAMA_MODEL", None, "30m"),
+    "copy": ("OLLAMA_MODEL", None, "30m"),
+    "refine": ("OLLAMA_REFINE_MODEL", "chat", "30m"),
+    "summary": ("OLLAMA_SUMMARY_MODEL", "refine", "10m"),
+}
+OLLAMA_WARMUP = os.environ.get('OLLAMA_WARMUP', 'true').lower() not in ('0', 'false', 'no')
+OLLAMA_PING_INTERVAL = float(os.environ.get('OLLAMA_PING_INTERVAL', 240))
+MODEL_LOAD_TIMEOUT = 600 # seconds; a cold load of a large model from disk can take minutes
+DURATION_UNITS = {"ns": 1e-9, "us": 1e-6, "µs": 1e-6, "ms": 1e-3, "s": 1, "m": 60, "h": 3600}
+_DURATION_PART = r"(\d+\.?\d*|\.\d+)(ns|us|µs|ms|s|m|h)"
+
+
+def model_for(request_class):
+    """The model name for a request class. Raises ValueError if no model is configured."""
+    model_config_key, fallback_class, _ = REQUEST_CLASSES[request_class]
+    if os.environ.get(model_config_key): return os.environ[model_config_key]
+    return model_for(fallback_class) if fallback_class else get_config_or_raise(model_config_key)
+
+def parse_keep_alive(value):
+    """
+    (seconds, value to send) for a keep_alive setting. Ollama reads strings with Go's
+    time.ParseDuration, so unitless and negative values are sent as JSON numbers (seconds;
+    negative means never unload) and anything else must be a Go duration ("30m", "1h30m").
+    Raises ValueError for anything else.
+    """
+    text = str(value).strip()
+    if re.fullmatch(r"[+-]?(\d+\.?\d*|\.\d+)", text):
+        number = float(text)
+        if number < 0: return float('inf'), -1
+        return number, int(number) if number.is_integer() else number
+    match = re.fullmatch(rf"([+-]?)((?:{_DURATION_PART})+)", text)
+    if not match: raise ValueError(f"Invalid keep_alive duration: {value!r} (expected e.g. 30m, 1h30m, 300 or -1)")
+    seconds = sum(float(number) * DURATION_UNITS[unit] for number, unit in re.findall(_DURATION_PART, match.group(2)))
+    if match.group(1) == "-" and seconds > 0: return float('inf'), -1
+    return seconds, text
+
+# Parsed once, so a bad value fails at startup rather than on every request
+KEEP_ALIVE = {request_class: parse_keep_alive(os.environ.get(f"OLLAMA_{request_class.upper()}_KEEP_ALIVE", default_keep_alive))
+              for request_class, (_, _, default_keep_alive) in REQUEST_CLASSES.items()}
+
+def keep_alive_for(request_class):
+    """
+    The keep_alive to send. Every request resets the model's unload timer to its own value,
+    so classes sharing a model all send the longest one; otherwise a summary call would cut
+    the chat model's residency short.
+    """
+    model = model_for(request_class)
+    sharing = [c for c in REQUEST_CLASSES if model_for(c) == model]
+    return max((KEEP_ALIVE[c] for c in sharing), key=lambda keep_alive: keep_alive[0])[1]
+
+def ollama_payload(request_class, **fields):
+    """/api/chat payload fields for a request class: its model and keep_alive, plus `fields`."""
+    return {"model": model_for(request_class), "keep_alive": keep_alive_for(request_class), **fields}
+
+def configured_models():
+    """{model: keep_alive} for every model some request class uses."""
+    models = {}
+    for request_class in REQUEST_CLASSES:
+        try: models[model_for(request_class)] = keep_alive_for(request_class)
+        except ValueError: continue
+    return models
+
+
+class ModelWarmer:
+    """Loads the configured models on every Ollama node, then pings them on a daemon thread."""
+
+    def __init__(self, interval_seconds):
+        self.interval = interval_seconds
+        self._thread = None
+        self._lock = Lock()
+
+    def start(self):
+        """Starts warm-up and pings in the background (idempotent); app startup doesn't wait for loads."""
+        with self._lock:
+            if self._thread is not None: return
+            self._thread = Thread(target=self._loop, name="ollama-warmer", daemon=True)
+            self._thread.start()
+        log.info(f"Ollama model warmer started (ping interval {self.interval}s).")
+
+    def warm_once(self):
+        """
+        Sends an empty /api/generate prompt for each model to each node: Ollama loads the
+        model (if needed) and resets its keep_alive without generating anything.
+        Returns the number of model loads that succeeded.
+        """
+        ollama_client = get_client('ollama')
+        warmed = 0
+        for model, keep_alive in configured_models().items():
+            for endpoint in ollama_client.router.endpoints:
+                try:
+                    response = ollama_client.post("/api/generate", json={"model": model, "prompt": "", "keep_alive": keep_alive, "stream": False},
+                                                  timeout=(ollama_client.timeout[0], MODEL_LOAD_TIMEOUT), endpoint_url=endpoint.url)
+                    response.raise_for_status()
+                    load_seconds = (response.json().get('load_duration') or 0) / 1e9
+                    if load_seconds > 1: log.info(f"Loaded Ollama model {model} on {endpoint.url} in {load_seconds:.1f}s (keep_alive {keep_alive}).")
+                    warmed += 1
+                except requests.exceptions.RequestException as e:
+                    log.warning(f"Could not warm Ollama model {model} on {endpoint.url}: {e}")
+        return warmed
+
+    def _loop(self):
+        while True:
+            try: self.warm_once()
+            except ValueError as e: log.warning(f"Ollama warm-up skipped: {e}")
+            except Exception as e: log.exception(f"Ollama warm-up failed: {type(e).__name__} - {e}")
+            time.sleep(self.interval)
+
+
+ollama_warmer = ModelWarmer(OLLAMA_PING_INTERVAL)
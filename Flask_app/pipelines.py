@@ -0,0 +1,346 @@
+# flask_app/pipelines.py
+
+# Campaign pipelines: one brief in, ad copy + visual + voice-over + video out.
+# A run is a small dependency graph (see PIPELINE_STAGES). Each stage executes on its
+# backend's job pool from jobs.py, so pipelines share the same GPU concurrency limits as
+# dashboard jobs, and stages without a dependency between them (the voice-over of the copy
+# and the image diffusion) run at the same time. Every stage result is written to the run
+# document in mongo.db.pipeline_runs as soon as it is ready, so resuming a failed run only
+# repeats the stages that did not finish. Runs are admitted PIPELINE_MAX_ACTIVE_RUNS at a
+# time, which lets a CSV with hundreds of briefs drain overnight without flooding the queues;
+# users without an active run are admitted first.
+# Several processes can run engines against the same collection (gunicorn workers, a
+# `flask run-csv --wait`): a run is claimed by one engine, which renews its lease (the run's
+# updated_at) on every tick. Runs whose lease is older than PIPELINE_LEASE_SECONDS belonged
+# to an engine that stopped, and go back to the queue.
+#   PIPELINE_MAX_ACTIVE_RUNS   runs one engine executes at a time (4)
+#   PIPELINE_MAX_CSV_ROWS      briefs accepted per CSV (1000)
+#   PIPELINE_LEASE_SECONDS     how long a run survives without its engine's heartbeat (60)
+
+import logging
+import io
+import os
+import math
+import csv
+import time
+import uuid
+import socket
+import click
+import traceback
+import requests
+from threading import Thread, Lock
+from datetime import datetime, timedelta
+from flask import Blueprint, request, jsonify, url_for, current_app
+from flask_login import login_required, current_user
+from bson.objectid import ObjectId
+from . import mongo
+from .clients import get_client
+from .ollama_models import ollama_payload
+from .generation import refine_image_prompt, generate_image_base64, queue_svd_video
+from .speech import synthesize_long_form
+from .audio_delivery import deliver_audio
+from .speakers import get_available_speakers
+from .media import store_media_base64, media_url
+from .image_prep import prepare_image
+from .video_tracker import track_prompt
+from .jobs import get_backend_pool, JobQueueFull
+from .rate_limit import check_rate_limit, RateLimited
+
+log = logging.getLogger(__name__)
+
+pipelines = Blueprint('pipelines', __name__)
+
+# --- Constants ---
+PIPELINE_MAX_ACTIVE_RUNS = int(os.environ.get('PIPELINE_MAX_ACTIVE_RUNS', 4))
+PIPELINE_MAX_CSV_ROWS = int(os.environ.get('PIPELINE_MAX_CSV_ROWS', 1000))
+PIPELINE_LEASE_SECONDS = float(os.environ.get('PIPELINE_LEASE_SECONDS', 60))
+PIPELINE_TICK_SECONDS = 1.0
+PIPELINE_COPY_SYSTEM_PROMPT = """
+You are MarketMind, an AI marketing assistant for small business owners.
+Write a short, upbeat voice-over script (two or three sentences, under 60 words) for a video ad based on the brief.
+Output only the script text, with no titles, stage directions or quotation marks.
+"""
+
+
+# --- Stage Handlers (run on backend pool threads; return the JSON-serializable stage result) ---
+def _stage_copy(run_doc, results):
+    ollama_client = get_client('ollama')
+    payload = ollama_payload("copy", stream=False,
+                             messages=[{"role": "system", "content": PIPELINE_COPY_SYSTEM_PROMPT.strip()}, {"role": "user", "content": run_doc['brief']}])
+    response = ollama_client.post("/api/chat", json=payload); response.raise_for_status()
+    text = response.json().get('message', {}).get('content', '').strip()
+    if not text: raise ValueError("The AI text service returned empty ad copy.")
+    return {"text": text}
+
+def _stage_image(run_doc, results):
+    refined_prompt = refine_image_prompt(run_doc['brief'])
+    image_b64 = generate_image_base64(refined_prompt, None, run_doc.get('seed', -1))
+    return {"refined_prompt": refined_prompt, "image_id": store_media_base64(image_b64, 'image/png', run_doc['user_id'])}
+
+def _stage_voiceover(run_doc, results):
+    available_speakers = get_available_speakers(wait_timeout=15)
+    if not available_speakers: raise ValueError("No speakers are available/loaded from the TTS service.")
+    speaker_id = run_doc.get('speaker_id') if run_doc.get('speaker_id') in available_speakers else available_speakers[0]
+    wav_bytes = synthesize_long_form(results['copy']['text'], run_doc.get('language_code', 'en'), speaker_id)
+    audio_id, content_type = deliver_audio(wav_bytes, run_doc['user_id'])
+    return {"speaker_id": speaker_id, "audio_id": audio_id, "content_type": content_type}
+
+def _stage_video(run_doc, results):
+    prompt_id = queue_svd_video(*prepare_image(results['image']['image_id'], 'svd'))
+    track_prompt(prompt_id, run_doc['user_id']) # The finished render is delivered by video_tracker
+    return {"prompt_id": prompt_id}
+
+# name -> (backend pool, dependencies, handler). Order is the display order.
+PIPELINE_STAGES = {
+    "copy": ("ollama", (), _stage_copy),
+    "image": ("a1111", (), _stage_image),
+    "voiceover": ("xtts", ("copy",), _stage_voiceover),
+    "video": ("comfyui", ("image",), _stage_video),
+}
+
+
+# --- Run Documents ---
+def ensure_pipeline_indexes():
+    mongo.db.pipeline_runs.create_index([("status", 1), ("created_at", 1)])
+    mongo.db.pipeline_runs.create_index([("user_id", 1), ("batch_id", 1)])
+    mongo.db.pipeline_runs.create_index([("status", 1), ("updated_at", 1)])
+
+def create_run(user_id_obj, brief, product=None, language_code='en', speaker_id=None, seed=-1, batch_id=None):
+    now = datetime.utcnow()
+    run_doc = {"user_id": user_id_obj, "batch_id": batch_id, "product": product, "brief": brief,
+               "language_code": language_code, "speaker_id": speaker_id, "seed": seed, "status": "queued", "owner": None,
+               "stages": {name: {"status": "pending", "result": None, "error": None, "attempts": 0, "started_at": None, "finished_at": None} for name in PIPELINE_STAGES},
+               "created_at": now, "updated_at": now, "finished_at": None}
+    return mongo.db.pipeline_runs.insert_one(run_doc).inserted_id
+
+def parse_briefs_csv(text):
+    """Rows from a CSV with a 'brief' column (and optional product, language_code, speaker_id)."""
+    rows = []
+    for line_number, row in enumerate(csv.DictReader(io.StringIO(text)), start=2):
+        brief = (row.get('brief') or '').strip()
+        if not brief: raise ValueError(f"CSV line {line_number}: 'brief' is empty.")
+        rows.append({"brief": brief, "product": (row.get('product') or '').strip() or None,
+                     "language_code": (row.get('language_code') or 'en').strip(), "speaker_id": (row.get('speaker_id') or '').strip() or None})
+        if len(rows) > PIPELINE_MAX_CSV_ROWS: raise ValueError(f"CSV has more than {PIPELINE_MAX_CSV_ROWS} briefs.")
+    if not rows: raise ValueError("CSV contains no briefs. Expected a header row with a 'brief' column.")
+    return rows
+
+def resume_run(run_id):
+    """Re-queues a failed run; stages that already succeeded keep their results."""
+    run_doc = mongo.db.pipeline_runs.find_one({"_id": run_id}, {"stages": 1, "status": 1})
+    if not run_doc or run_doc['status'] != "failed": return False
+    reset = {f"stages.{name}.status": "pending" for name, stage in run_doc['stages'].items() if stage['status'] != "succeeded"}
+    mongo.db.pipeline_runs.update_one({"_id": run_id, "status": "failed"}, {"$set": {**reset, "status": "queued", "updated_at": datetime.utcnow(), "finished_at": None}})
+    return True
+
+
+# --- Engine ---
+class PipelineEngine:
+    """
+    Admits queued runs and dispatches their ready stages to the backend pools. All scheduling
+    happens on one thread; stage threads only write their own stage's outcome.
+    Claimed runs carry this engine's owner id and are kept alive by its heartbeat.
+    """
+
+    def __init__(self, max_active_runs, lease_seconds):
+        self.max_active_runs = max_active_runs
+        self.lease_seconds = lease_seconds
+        self.owner_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.batch_id = None # Set: only runs of this batch are claimed (CLI processes)
+        self._in_flight = set() # (run_id, stage) submitted to a pool and not yet finished
+        self._active_runs = {} # run_id -> user_id
+        self._lock = Lock()
+        self._thread = None
+
+    def start(self, app, batch_id=None):
+        with self._lock:
+            if self._thread is not None: return
+            self.batch_id = batch_id
+            self._thread = Thread(target=self._loop, args=(app,), name="pipeline-engine", daemon=True)
+            self._thread.start()
+        log.info(f"Pipeline engine {self.owner_id} started (max {self.max_active_runs} active run(s){f', batch {batch_id} only' if batch_id else ''}).")
+
+    def _recover(self):
+        """Runs whose engine stopped renewing the lease go back to the queue."""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.lease_seconds)
+        for run_doc in mongo.db.pipeline_runs.find({"status": "running", "updated_at": {"$lt": cutoff}}, {"stages": 1, "owner": 1}):
+            reset = {f"stages.{name}.status": "pending" for name, stage in run_doc['stages'].items() if stage['status'] == "running"}
+            # Only if the lease is still expired, in case its engine renewed it in the meantime
+            result = mongo.db.pipeline_runs.update_one({"_id": run_doc['_id'], "status": "running", "updated_at": {"$lt": cutoff}},
+                                                       {"$set": {**reset, "status": "queued", "owner": None, "updated_at": datetime.utcnow()}})
+            if result.modified_count: log.warning(f"Pipeline run {run_doc['_id']} lost its engine ({run_doc.get('owner')}), re-queued.")
+
+    def _loop(self, app):
+        while True:
+            try:
+                with app.app_context(): self.tick(app)
+            except Exception as e: log.error(f"Pipeline engine tick failed: {type(e).__name__} - {e}\n{traceback.format_exc()}")
+            time.sleep(PIPELINE_TICK_SECONDS)
+
+    def has_work(self):
+        with self._lock: return bool(self._active_runs or self._in_flight)
+
+    def tick(self, app):
+        self._recover()
+        # Renew the lease on this engine's runs
+        if self._active_runs:
+            mongo.db.pipeline_runs.update_many({"_id": {"$in": list(self._active_runs)}, "owner": self.owner_id}, {"$set": {"updated_at": datetime.utcnow()}})
+        # Admit queued runs (claimed atomically, oldest first) while there is capacity, users
+        # without an active run first, so one user's CSV doesn't take every slot
+        while len(self._active_runs) < self.max_active_runs:
+            run_doc = None
+            queued = {"status": "queued", **({"batch_id": self.batch_id} if self.batch_id else {})}
+            for run_filter in ({**queued, "user_id": {"$nin": list(set(self._active_runs.values()))}}, queued):
+                run_doc = mongo.db.pipeline_runs.find_one_and_update(run_filter, {"$set": {"status": "running", "owner": self.owner_id, "updated_at": datetime.utcnow()}},
+                                                                     sort=[("created_at", 1)], projection={"_id": 1, "user_id": 1})
+                if run_doc: break
+            if not run_doc: break
+            self._active_runs[run_doc['_id']] = run_doc.get('user_id')
+
+        for run_id in list(self._active_runs):
+            # Snapshot in-flight stages before reading statuses: a stage that finishes in between
+            # then still counts as in flight, rather than showing as pending and being resubmitted
+            with self._lock: in_flight = {stage for rid, stage in self._in_flight if rid == run_id}
+            run_doc = mongo.db.pipeline_runs.find_one({"_id": run_id})
+            if not run_doc or run_doc['status'] != "running" or run_doc.get('owner') != self.owner_id:
+                log.warning(f"Pipeline run {run_id} is no longer owned by this engine, dropping it.")
+                self._active_runs.pop(run_id, None); continue
+            stages = run_doc['stages']
+            statuses = {name: stage['status'] for name, stage in stages.items()}
+            if all(status == "succeeded" for status in statuses.values()):
+                self._finish_run(run_id, "succeeded"); continue
+            if not in_flight and "failed" in statuses.values():
+                self._finish_run(run_id, "failed"); continue
+            results = {name: stage['result'] for name, stage in stages.items() if stage['status'] == "succeeded"}
+            for name, (backend, deps, handler) in PIPELINE_STAGES.items():
+                if statuses[name] != "pending" or name in in_flight or not all(statuses[d] == "succeeded" for d in deps): continue
+                try:
+                    with self._lock: self._in_flight.add((run_id, name))
+                    get_backend_pool(backend).submit(self._execute_stage, app, run_doc, name, results, tenant=run_doc['user_id'])
+                except JobQueueFull:
+                    with self._lock: self._in_flight.discard((run_id, name))
+                    # Backend is saturated; try again next tick
+
+    def _finish_run(self, run_id, status):
+        mongo.db.pipeline_runs.update_one({"_id": run_id, "owner": self.owner_id}, {"$set": {"status": status, "owner": None, "updated_at": datetime.utcnow(), "finished_at": datetime.utcnow()}})
+        self._active_runs.pop(run_id, None)
+        log.info(f"Pipeline run {run_id} {status}.")
+
+    def _execute_stage(self, app, run_doc, name, results):
+        run_id, prefix = run_doc['_id'], f"stages.{name}"
+        try:
+            with app.app_context():
+                now = datetime.utcnow()
+                mongo.db.pipeline_runs.update_one({"_id": run_id}, {"$set": {f"{prefix}.status": "running", f"{prefix}.started_at": now, f"{prefix}.error": None, "updated_at": now}, "$inc": {f"{prefix}.attempts": 1}})
+                error, result = None, None
+                try: result = PIPELINE_STAGES[name][2](run_doc, results)
+                except requests.exceptions.Timeout: error = f"The {name} stage timed out."
+                except requests.exceptions.RequestException as e: error = f"Error connecting to the service for the {name} stage: {e}"
+                except ValueError as e: error = str(e)
+                except Exception as e: log.error(f"Unexpected error in pipeline stage {name} of run {run_id}: {type(e).__name__} - {e}\n{traceback.format_exc()}"); error = f"An unexpected error occurred: {e}"
+                now = datetime.utcnow()
+                mongo.db.pipeline_runs.update_one({"_id": run_id}, {"$set": {f"{prefix}.status": "failed" if error else "succeeded", f"{prefix}.result": result,
+                                                                             f"{prefix}.error": error, f"{prefix}.finished_at": now, "updated_at": now}})
+                log.log(logging.ERROR if error else logging.INFO, f"Pipeline run {run_id} stage {name} {'failed: ' + error if error else 'succeeded'}.")
+        finally:
+            with self._lock: self._in_flight.discard((run_id, name))
+
+
+pipeline_engine = PipelineEngine(PIPELINE_MAX_ACTIVE_RUNS, PIPELINE_LEASE_SECONDS)
+
+
+# --- Serialization ---
+def serialize_run(run_doc):
+    stages = {}
+    for name, stage in run_doc['stages'].items():
+        result = dict(stage['result'] or {})
+        if result.get('image_id'): result['image_url'] = media_url(result['image_id'])
+        if result.get('audio_id'): result['audio_url'] = media_url(result['audio_id'])
+        if result.get('prompt_id'): result['video_status_url'] = url_for('videos.video_status', prompt_id=result['prompt_id'])
+        duration = (stage['finished_at'] - stage['started_at']).total_seconds() if stage.get('finished_at') and stage.get('started_at') else None
+        stages[name] = {"status": stage['status'], "result": result or None, "error": stage['error'], "attempts": stage['attempts'], "seconds": duration}
+    return {"run_id": str(run_doc['_id']), "batch_id": run_doc.get('batch_id'), "product": run_doc.get('product'), "brief": run_doc['brief'],
+            "status": run_doc['status'], "stages": stages, "created_at": run_doc['created_at'].isoformat() + "Z",
+            "finished_at": run_doc['finished_at'].isoformat() + "Z" if run_doc.get('finished_at') else None}
+
+
+# --- Routes ---
+@pipelines.route('/pipelines', methods=['POST'])
+@login_required
+def submit_pipeline():
+    """Queues one run per brief: form field 'brief', or a CSV upload in 'briefs_csv'. Responds 202."""
+    if mongo.db is None: return jsonify({"error": "Database unavailable."}), 503
+    user_id_obj = ObjectId(current_user.id)
+    try:
+        upload = request.files.get('briefs_csv')
+        if upload and upload.filename:
+            rows = parse_briefs_csv(upload.read().decode('utf-8-sig'))
+        else:
+            brief = request.form.get('brief', '').strip()
+            if not brief: raise ValueError("Campaign brief cannot be empty.")
+            rows = [{"brief": brief, "product": request.form.get('product') or None,
+                     "language_code": request.form.get('language_code', 'en'), "speaker_id": request.form.get('speaker_id') or None}]
+        check_rate_limit("pipeline", current_user.id, len(rows))
+    except (ValueError, UnicodeDecodeError, csv.Error) as e: return jsonify({"error": str(e)}), 400
+    except RateLimited as e: return jsonify({"error": str(e), "retry_after": math.ceil(e.retry_after)}), 429, {"Retry-After": str(math.ceil(e.retry_after))}
+
+    batch_id = str(ObjectId())
+    run_ids = [str(create_run(user_id_obj, batch_id=batch_id, **row)) for row in rows]
+    pipeline_engine.start(current_app._get_current_object())
+    log.info(f"Queued {len(run_ids)} pipeline run(s) in batch {batch_id}.")
+    return jsonify({"batch_id": batch_id, "run_ids": run_ids, "status_url": url_for('pipelines.batch_status', batch_id=batch_id)}), 202
+
+@pipelines.route('/pipelines/<run_id>', methods=['GET'])
+@login_required
+def run_status(run_id):
+    if not ObjectId.is_valid(run_id): return jsonify({"error": "Invalid run id."}), 404
+    run_doc = mongo.db.pipeline_runs.find_one({"_id": ObjectId(run_id), "user_id": ObjectId(current_user.id)})
+    if not run_doc: return jsonify({"error": "Pipeline run not found."}), 404
+    return jsonify(serialize_run(run_doc))
+
+@pipelines.route('/pipelines/<run_id>/resume', methods=['POST'])
+@login_required
+def resume_pipeline(run_id):
+    """Retries the unfinished stages of a failed run."""
+    if not ObjectId.is_valid(run_id) or not mongo.db.pipeline_runs.count_documents({"_id": ObjectId(run_id), "user_id": ObjectId(current_user.id)}, limit=1):
+        return jsonify({"error": "Pipeline run not found."}), 404
+    if not resume_run(ObjectId(run_id)): return jsonify({"error": "Only failed runs can be resumed."}), 409
+    pipeline_engine.start(current_app._get_current_object())
+    return jsonify({"run_id": run_id, "status": "queued"}), 202
+
+@pipelines.route('/pipelines/batches/<batch_id>', methods=['GET'])
+@login_required
+def batch_status(batch_id):
+    """Progress of a CSV batch: run counts by status plus a compact per-run view."""
+    runs = list(mongo.db.pipeline_runs.find({"user_id": ObjectId(current_user.id), "batch_id": batch_id}, {"brief": 0}).sort("created_at", 1))
+    if not runs: return jsonify({"error": "Batch not found."}), 404
+    counts = {}
+    for run_doc in runs: counts[run_doc['status']] = counts.get(run_doc['status'], 0) + 1
+    return jsonify({"batch_id": batch_id, "total": len(runs), "counts": counts,
+                    "runs": [{"run_id": str(r['_id']), "product": r.get('product'), "status": r['status'],
+                              "status_url": url_for('pipelines.run_status', run_id=str(r['_id']))} for r in runs]})
+
+
+# --- CLI ---
+@pipelines.cli.command('run-csv')
+@click.argument('csv_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--email', required=True, help='Account that owns the generated assets.')
+@click.option('--wait/--no-wait', default=True, help='Process the runs in this process until the batch is done.')
+def run_csv_command(csv_path, email, wait):
+    """Queues a pipeline run for every brief in CSV_PATH (columns: brief, product, language_code, speaker_id)."""
+    from .models import User
+    user = User.get_by_email(email)
+    if not user: raise click.ClickException(f"No user with email {email}.")
+    with open(csv_path, 'r', encoding='utf-8-sig') as f:
+        try: rows = parse_briefs_csv(f.read())
+        except ValueError as e: raise click.ClickException(str(e))
+    ensure_pipeline_indexes()
+    batch_id = str(ObjectId())
+    for row in rows: create_run(ObjectId(user.id), batch_id=batch_id, **row)
+    click.echo(f"Queued {len(rows)} run(s) in batch {batch_id}.")
+    if not wait: return
+    pipeline_engine.start(current_app._get_current_object(), batch_id=batch_id) # Runs queued by others are left to the server
+    while mongo.db.pipeline_runs.count_documents({"batch_id": batch_id, "status": {"$in": ["queued", "running"]}}) or pipeline_engine.has_work():
+        time.sleep(5)
+    counts = {status: mongo.db.pipeline_runs.count_documents({"batch_id": batch_id, "status": status}) for status in ("succeeded", "failed")}
+    click.echo(f"Batch {batch_id} done: {counts['succeeded']} succeeded, {counts['failed']} failed.")
@@ -0,0 +1,165 @@
+# flask_app/rate_limit.py
+
+# Per-user rate limits for the GPU-backed routes.
+# Every (user, bucket) pair has a token bucket that holds up to <requests> tokens and refills
+# at <requests>/<seconds>, so short bursts are allowed but the sustained rate is capped.
+# A request spends `cost` tokens (e.g. one per image of a batch); when the bucket is short the
+# route answers 429 with Retry-After (JSON routes) or flashes an error (dashboard forms).
+#   RATE_LIMIT_<BUCKET>   "<requests>/<seconds>", e.g. RATE_LIMIT_IMAGE=20/60; "off" disables it
+#   RATE_LIMIT_ENABLED    "false" disables every limit (true)
+#   RATE_LIMIT_DB         SQLite file shared by the app processes on this host. Without it each
+#                         process keeps its own buckets, so N workers allow N times the rate.
+
+import logging
+import os
+import math
+import time
+import sqlite3
+from functools import wraps
+from threading import Lock
+from flask import request, jsonify, flash, redirect, url_for
+from flask_login import current_user
+from .caching import LRUCache
+
+log = logging.getLogger(__name__)
+
+# --- Constants ---
+# bucket -> default "<requests>/<seconds>"
+RATE_LIMIT_DEFAULTS = {
+    "chat": "30/60",
+    "image": "20/60", # Counted per image, so a 4x4 batch spends 16
+    "audio": "20/60",
+    "video": "4/60",
+    "pipeline": "20/3600", # Counted per run (one per CSV row)
+}
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+RATE_LIMIT_DB = os.environ.get('RATE_LIMIT_DB')
+
+
+def parse_rate(value):
+    """'20/60' -> (capacity 20, refill 1/3 token per second); 'off' -> None."""
+    if str(value).strip().lower() in ('off', '0', 'none', ''): return None
+    try:
+        requests_allowed, _, seconds = str(value).partition('/')
+        capacity, period = float(requests_allowed), float(seconds or 1)
+        if capacity <= 0 or period <= 0: raise ValueError
+    except ValueError:
+        raise ValueError(f"Invalid rate limit '{value}', expected '<requests>/<seconds>'.")
+    return capacity, capacity / period
+
+def bucket_rate(bucket):
+    return parse_rate(os.environ.get(f"RATE_LIMIT_{bucket.upper()}", RATE_LIMIT_DEFAULTS[bucket]))
+
+
+# --- Bucket Stores ---
+def _refill(tokens, updated_at, capacity, refill_per_second, now):
+    return min(capacity, tokens + (now - updated_at) * refill_per_second)
+
+def _spend(tokens, capacity, refill_per_second, cost):
+    """(tokens left, seconds to wait). A cost above capacity is charged as a full bucket."""
+    cost = min(cost, capacity)
+    if tokens >= cost: return tokens - cost, 0.0
+    return tokens, (cost - tokens) / refill_per_second
+
+
+class MemoryBucketStore:
+    """Buckets in this process. Idle buckets may be evicted, which just refills them."""
+
+    def __init__(self, max_entries=100000):
+        self._buckets = LRUCache(max_entries=max_entries)
+        self._lock = Lock()
+
+    def take(self, key, capacity, refill_per_second, cost):
+        with self._lock:
+            now = time.monotonic()
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+            tokens, retry_after = _spend(_refill(tokens, updated_at, capacity, refill_per_second, now), capacity, refill_per_second, cost)
+            self._buckets.set(key, (tokens, now))
+            return retry_after
+
+
+class SqliteBucketStore:
+    """Buckets in a SQLite file, so every process on the host draws from the same buckets."""
+
+    def __init__(self, path):
+        self.path = path
+        self._initialized = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        if not self._initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)")
+            self._initialized = True
+        return conn
+
+    def take(self, key, capacity, refill_per_second, cost):
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE") # Read-modify-write under the file's write lock
+            now = time.time() # Wall clock: monotonic clocks aren't comparable across processes
+            row = conn.execute("SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens = _refill(*row, capacity, refill_per_second, now) if row else capacity
+            tokens, retry_after = _spend(tokens, capacity, refill_per_second, cost)
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)", (key, tokens, now))
+            conn.execute("COMMIT")
+            return retry_after
+        except sqlite3.Error:
+            if conn.in_transaction: conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+
+bucket_store = SqliteBucketStore(RATE_LIMIT_DB) if RATE_LIMIT_DB else MemoryBucketStore()
+
+
+# --- Limiter ---
+class RateLimited(Exception):
+    def __init__(self, bucket, retry_after):
+        self.bucket = bucket
+        self.retry_after = retry_after
+        super().__init__(f"Too many {bucket} requests. Please wait {math.ceil(retry_after)} seconds and try again.")
+
+def check_rate_limit(bucket, user_id, cost=1):
+    """Spends `cost` tokens from the user's bucket. Raises RateLimited if there aren't enough."""
+    if not RATE_LIMIT_ENABLED: return
+    rate = bucket_rate(bucket)
+    if rate is None or cost <= 0: return
+    try:
+        retry_after = bucket_store.take(f"{bucket}:{user_id}", rate[0], rate[1], cost)
+    except sqlite3.Error as e:
+        log.warning(f"Rate limit store unavailable, allowing the request: {e}") # Fail open: the limiter must not take the app down
+        return
+    if retry_after > 0:
+        log.info(f"Rate limited user {user_id} on {bucket} (retry in {retry_after:.1f}s).")
+        raise RateLimited(bucket, retry_after)
+
+def rate_limited(bucket, cost=None):
+    """
+    Route decorator (below @login_required) that limits the current user on `bucket`.
+    `cost` is an optional callable returning the request's token cost (default 1).
+    JSON routes get a 429; dashboard form posts get a flashed error and a redirect back.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                request_cost = 1
+                if cost is not None:
+                    try: request_cost = cost(*args, **kwargs)
+                    except ValueError: pass # Invalid input: the route reports it, at the base cost
+                check_rate_limit(bucket, current_user.id, request_cost)
+            except RateLimited as e:
+                retry_after = str(math.ceil(e.retry_after))
+                if request.blueprint == 'views' and request.accept_mimetypes.best not in ('application/json', 'text/event-stream'):
+                    flash(str(e), category='error')
+                    response = redirect(url_for('views.dashboard', conversation_id=request.form.get('conversation_id') or None))
+                else:
+                    response = jsonify({"error": str(e), "retry_after": int(retry_after)})
+                    response.status_code = 429
+                response.headers['Retry-After'] = retry_after
+                return response
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
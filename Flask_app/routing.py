@@ -0,0 +1,162 @@
+# flask_app/routing.py
+
+# Spreads calls for one backend service across several inference nodes.
+# Each service URL variable (OLLAMA_ENDPOINT, IMAGE_API_URL, XTTS_API_URL, VIDEO_API_URL)
+# may hold a comma-separated list of base URLs. For every call the router picks the
+# available endpoint with the fewest requests in flight (least outstanding requests), unless
+# the call carries an affinity key that is already bound to a node, e.g. a ComfyUI upload
+# and the /prompt that references it, or the turns of one chat (Ollama reuses its KV cache).
+# A circuit breaker stops sending traffic to a node after repeated failures, and a background
+# probe per service marks nodes up or down between calls.
+#   BACKEND_FAILURE_THRESHOLD   consecutive failures that open a node's circuit (5)
+#   BACKEND_CIRCUIT_RESET       seconds before an open circuit lets a trial call through (30)
+#   BACKEND_HEALTH_INTERVAL     seconds between health probes (15)
+#   BACKEND_AFFINITY_TTL        seconds an affinity key stays bound to its node (3600)
+
+import logging
+import os
+import time
+import random
+import requests
+from threading import Lock, Thread
+from .caching import LRUCache
+
+log = logging.getLogger(__name__)
+
+FAILURE_THRESHOLD = int(os.environ.get('BACKEND_FAILURE_THRESHOLD', 5))
+CIRCUIT_RESET_SECONDS = float(os.environ.get('BACKEND_CIRCUIT_RESET', 30))
+HEALTH_INTERVAL_SECONDS = float(os.environ.get('BACKEND_HEALTH_INTERVAL', 15))
+HEALTH_TIMEOUT_SECONDS = 5
+AFFINITY_TTL_SECONDS = float(os.environ.get('BACKEND_AFFINITY_TTL', 3600))
+# Cheap read-only endpoint per service that answers quickly when the node is usable
+HEALTH_PROBE_PATHS = {"ollama": "/api/tags", "a1111": "/sdapi/v1/progress?skip_current_image=true", "xtts": "/speakers_list", "comfyui": "/queue"}
+
+
+class NoHealthyEndpoint(requests.exceptions.ConnectionError):
+    """Every node of a service is down or has an open circuit."""
+
+
+class Endpoint:
+    """One node: its base URL, in-flight count and circuit state (closed / open / half_open)."""
+
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.circuit = "closed"
+        self.opened_at = 0.0
+        self.healthy = True # Last probe result; optimistic until the first probe
+        self.requests = 0
+        self.failures = 0
+
+    def available(self, now):
+        if not self.healthy: return False
+        if self.circuit == "open" and now - self.opened_at >= CIRCUIT_RESET_SECONDS:
+            self.circuit = "half_open" # Let one trial call through
+            return True
+        return self.circuit == "closed" or (self.circuit == "half_open" and self.outstanding == 0)
+
+
+class EndpointRouter:
+    """Least-outstanding-requests balancing with circuit breaking and affinity for one service."""
+
+    def __init__(self, name, urls):
+        self.name = name
+        self.endpoints = [Endpoint(url.rstrip('/')) for url in urls]
+        self._by_url = {e.url: e for e in self.endpoints}
+        self._affinity = LRUCache(max_entries=10000, ttl=AFFINITY_TTL_SECONDS)
+        self._lock = Lock()
+
+    def acquire(self, affinity=None, endpoint_url=None, exclude=()):
+        """
+        Picks a node and counts the call as outstanding; pair with release(). `endpoint_url`
+        pins the call to a specific node; `affinity` prefers the node the key is bound to and
+        binds it to the chosen node otherwise.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if endpoint_url:
+                endpoint = self._by_url.get(endpoint_url.rstrip('/'))
+                if endpoint is None: raise NoHealthyEndpoint(f"{endpoint_url} is not a configured {self.name} endpoint.")
+            else:
+                bound = self._by_url.get(self._affinity.get(affinity)) if affinity else None
+                if bound is not None and bound.url not in exclude and bound.available(now):
+                    endpoint = bound
+                else:
+                    candidates = [e for e in self.endpoints if e.url not in exclude and e.available(now)]
+                    if not candidates: raise NoHealthyEndpoint(f"No healthy {self.name} endpoint is available.")
+                    fewest = min(e.outstanding for e in candidates)
+                    endpoint = random.choice([e for e in candidates if e.outstanding == fewest])
+                if affinity: self._affinity.set(affinity, endpoint.url)
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint, success):
+        with self._lock:
+            endpoint.outstanding -= 1
+            if success:
+                endpoint.consecutive_failures = 0
+                if endpoint.circuit != "closed": log.info(f"{self.name} endpoint {endpoint.url} recovered, closing circuit.")
+                endpoint.circuit = "closed"
+                return
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            if endpoint.circuit == "half_open" or endpoint.consecutive_failures >= FAILURE_THRESHOLD:
+                if endpoint.circuit != "open": log.warning(f"Opening circuit for {self.name} endpoint {endpoint.url} after {endpoint.consecutive_failures} failure(s).")
+                endpoint.circuit, endpoint.opened_at = "open", time.monotonic()
+
+    def bind(self, affinity, endpoint_url):
+        """Binds an affinity key to a node, e.g. a ComfyUI prompt id to the node that queued it."""
+        self._affinity.set(affinity, endpoint_url)
+
+    def bound_endpoint(self, affinity):
+        return self._affinity.get(affinity)
+
+    def is_up(self, endpoint_url):
+        """Whether a node passed its last probe and its circuit isn't open (no half-open trial is used up)."""
+        with self._lock:
+            endpoint = self._by_url.get(endpoint_url)
+            return endpoint is not None and endpoint.healthy and endpoint.circuit != "open"
+
+    def probe(self, session):
+        """Runs the health probe against every node and updates their `healthy` flags."""
+        probe_path = HEALTH_PROBE_PATHS.get(self.name)
+        if not probe_path: return
+        for endpoint in self.endpoints:
+            try:
+                healthy = session.get(f"{endpoint.url}{probe_path}", timeout=HEALTH_TIMEOUT_SECONDS).status_code < 500
+            except requests.exceptions.RequestException:
+                healthy = False
+            if healthy != endpoint.healthy: log.log(logging.INFO if healthy else logging.WARNING, f"{self.name} endpoint {endpoint.url} is {'up' if healthy else 'down'}.")
+            with self._lock:
+                endpoint.healthy = healthy
+                if healthy and endpoint.circuit == "open": endpoint.circuit = "half_open"
+
+    def stats(self):
+        with self._lock:
+            return [{"url": e.url, "healthy": e.healthy, "circuit": e.circuit, "outstanding": e.outstanding,
+                     "requests": e.requests, "failures": e.failures} for e in self.endpoints]
+
+
+_prober = None
+_prober_lock = Lock()
+
+def start_health_probes(get_routers):
+    """
+    Starts the background prober (idempotent). `get_routers` is called on every round, so
+    routers rebuilt after a URL change are probed too.
+    """
+    global _prober
+    with _prober_lock:
+        if _prober is not None: return
+        session = requests.Session()
+        def _loop():
+            while True:
+                try:
+                    for router in get_routers(): router.probe(session)
+                except Exception as e: log.error(f"Backend health probe round failed: {type(e).__name__} - {e}")
+                time.sleep(HEALTH_INTERVAL_SECONDS)
+        _prober = Thread(target=_loop, name="backend-health", daemon=True)
+        _prober.start()
+    log.info(f"Backend health probes started for {', '.join(r.name for r in get_routers())} (interval {HEALTH_INTERVAL_SECONDS}s).")
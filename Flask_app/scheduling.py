@@ -0,0 +1,178 @@
+# flask_app/scheduling.py
+
+# Weighted fair sharing of the GPU backends between users.
+# Calls used to reach a backend first come, first served, so one user's burst (a 16-image
+# batch, a CSV of campaign briefs) made everyone queued behind it wait for all of it. Now
+# every backend in FAIR_SHARE_BACKENDS has a gate with as many slots as it can run at once,
+# and callers wait for a slot in a start-time fair queue: each user's calls get virtual start
+# tags that advance by cost / weight, and the lowest tag goes next. A light user waits for
+# roughly one call per busy user instead of for every call queued before theirs. The job
+# pools (jobs.py) order their queued jobs with the same FairQueue.
+# The user is taken from the session for web requests (init_app) and set with tenant_scope()
+# on worker threads; calls without a user (health probes, warm-ups, pollers) skip the gate.
+#   FAIR_SHARE_BACKENDS     backends to gate, comma-separated (a1111,xtts). Ollama batches
+#                           parallel requests itself and ComfyUI queues renders server-side.
+#   FAIR_SHARE_WEIGHTS      per-user weights, e.g. "<user_id>=2,<user_id>=0.5" (everyone else 1)
+#   FAIR_SHARE_MAX_WAIT     seconds a call may wait for a slot before it fails as a timeout (300)
+#   <BACKEND>_MAX_CONCURRENCY  calls one node runs at once, e.g. A1111_MAX_CONCURRENCY=1
+
+import logging
+import os
+import time
+import heapq
+import itertools
+import contextvars
+from threading import Condition, Lock
+from contextlib import contextmanager
+import requests
+from flask import session
+from .instrumentation import FAIR_QUEUE_WAIT
+
+log = logging.getLogger(__name__)
+
+# --- Constants ---
+# Default concurrent calls per node. Also the job pool size per backend (see jobs.py); the
+# ollama pool is only used by pipeline stages.
+BACKEND_CONCURRENCY_DEFAULTS = {"a1111": 1, "xtts": 2, "comfyui": 1, "ollama": 2}
+FAIR_SHARE_BACKENDS = frozenset(b.strip() for b in os.environ.get('FAIR_SHARE_BACKENDS', 'a1111,xtts').split(',') if b.strip())
+FAIR_SHARE_MAX_WAIT = float(os.environ.get('FAIR_SHARE_MAX_WAIT', 300))
+SYSTEM_TENANT = "" # Work not attributable to a user (e.g. jobs submitted without one)
+
+
+def backend_concurrency(backend):
+    return max(1, int(os.environ.get(f"{backend.upper()}_MAX_CONCURRENCY", BACKEND_CONCURRENCY_DEFAULTS[backend])))
+
+def _parse_weights(value):
+    weights = {}
+    for item in filter(None, (value or "").split(",")):
+        tenant, _, weight = item.partition("=")
+        try: weights[tenant.strip()] = max(0.01, float(weight))
+        except ValueError: log.warning(f"Ignoring invalid FAIR_SHARE_WEIGHTS entry '{item}'.")
+    return weights
+
+FAIR_SHARE_WEIGHTS = _parse_weights(os.environ.get('FAIR_SHARE_WEIGHTS'))
+
+def tenant_weight(tenant):
+    return FAIR_SHARE_WEIGHTS.get(tenant, 1.0)
+
+
+# --- Fair Queue ---
+class FairQueue:
+    """
+    Start-time fair queue. pop() returns the item with the lowest virtual start tag; a tenant's
+    next item starts where its previous one finished (start + cost / weight), or at the current
+    virtual time if it has been idle. Not thread-safe: callers hold their own lock.
+    """
+
+    def __init__(self):
+        self._heap = [] # (start tag, sequence, item)
+        self._finish_tags = {} # tenant -> finish tag of its last pushed item
+        self._virtual_time = 0.0
+        self._sequence = itertools.count() # FIFO between equal tags
+
+    def push(self, tenant, item, cost=1):
+        tenant = SYSTEM_TENANT if tenant is None else str(tenant)
+        start = max(self._virtual_time, self._finish_tags.get(tenant, 0.0))
+        self._finish_tags[tenant] = start + cost / tenant_weight(tenant)
+        heapq.heappush(self._heap, (start, next(self._sequence), item))
+
+    def pop(self):
+        start, _, item = heapq.heappop(self._heap)
+        self._virtual_time = start
+        if not self._heap: self._finish_tags.clear() # Idle: nobody is behind anybody any more
+        return item
+
+    def __len__(self):
+        return len(self._heap)
+
+
+# --- Backend Gates ---
+class FairShareTimeout(requests.exceptions.Timeout):
+    """No slot freed up within FAIR_SHARE_MAX_WAIT; reported like a backend timeout."""
+
+
+class _Waiter:
+    def __init__(self):
+        self.granted = False
+        self.cancelled = False
+
+
+class BackendGate:
+    """At most `slots` calls in flight to one backend; waiting calls are admitted in FairQueue order."""
+
+    def __init__(self, backend, slots):
+        self.backend = backend
+        self.slots = slots
+        self._in_use = 0
+        self._queue = FairQueue()
+        self._cond = Condition()
+
+    def acquire(self, tenant, cost=1, timeout=FAIR_SHARE_MAX_WAIT):
+        started = time.monotonic()
+        waiter = _Waiter()
+        with self._cond:
+            # Uncontended calls go through the queue too, so a burst is tagged as a burst
+            self._queue.push(tenant, waiter, cost)
+            self._dispatch()
+            while not waiter.granted:
+                remaining = started + timeout - time.monotonic()
+                if remaining <= 0:
+                    waiter.cancelled = True
+                    raise FairShareTimeout(f"Timed out after {timeout:.0f}s waiting for a free {self.backend} slot.")
+                self._cond.wait(remaining)
+        FAIR_QUEUE_WAIT.labels(self.backend).observe(time.monotonic() - started)
+
+    def release(self):
+        with self._cond:
+            self._in_use -= 1
+            self._dispatch()
+
+    def _dispatch(self):
+        while self._in_use < self.slots and self._queue:
+            waiter = self._queue.pop()
+            if waiter.cancelled: continue
+            waiter.granted = True
+            self._in_use += 1
+        self._cond.notify_all()
+
+    def stats(self):
+        with self._cond: return {"slots": self.slots, "in_use": self._in_use, "waiting": len(self._queue)}
+
+
+_gates = {}
+_gates_lock = Lock()
+
+def get_backend_gate(backend, node_count):
+    """The gate for a backend (slots = per-node concurrency x nodes), or None if it isn't gated."""
+    if backend not in FAIR_SHARE_BACKENDS: return None
+    with _gates_lock:
+        slots = backend_concurrency(backend) * max(1, node_count)
+        if backend not in _gates or _gates[backend].slots != slots:
+            _gates[backend] = BackendGate(backend, slots)
+            log.info(f"Fair-share gate for {backend}: {slots} slot(s).")
+        return _gates[backend]
+
+
+# --- Tenants ---
+_current_tenant = contextvars.ContextVar('fair_share_tenant', default=None)
+
+def current_tenant():
+    return _current_tenant.get()
+
+@contextmanager
+def tenant_scope(tenant):
+    """Attributes backend calls made inside the block (on this thread) to `tenant`."""
+    token = _current_tenant.set(SYSTEM_TENANT if tenant is None else str(tenant))
+    try: yield
+    finally: _current_tenant.reset(token)
+
+def init_app(app):
+    """Attributes each request's backend calls to the logged-in user (read from the session, no DB lookup)."""
+    @app.before_request
+    def _set_tenant():
+        user_id = session.get('_user_id')
+        _current_tenant.set(str(user_id) if user_id else None)
+
+    @app.teardown_request
+    def _clear_tenant(exc):
+        _current_tenant.set(None) # Server threads are reused across requests
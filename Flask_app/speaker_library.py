@@ -0,0 +1,245 @@
+# flask_app/speaker_library.py
+
+# Speaker library: ingestion of XTTS reference clips.
+# XTTS conditions every request on the speaker's reference WAV, so the clip's length and
+# format are paid for on each synthesis: the hand-copied references were 48 kHz stereo or
+# 32-bit float, with leading/trailing silence, and the same voices sat in both folders.
+# Uploaded (or imported) clips are now decoded with ffmpeg, downmixed to mono, trimmed of
+# silence at both ends, loudness-normalized, capped at SPEAKER_MAX_SECONDS and stored as
+# 16-bit WAV at XTTS's conditioning rate in the XTTS speaker folder. Each clip is recorded in
+# mongo.db.speakers with a hash of its normalized PCM and a coarse energy-envelope fingerprint;
+# an upload that matches an existing voice returns that speaker instead of storing a copy.
+# xtts-api-server keeps the conditioning latents it computes for a speaker in memory, so new
+# speakers (and, at startup, the whole library) are primed with a one-word request per node
+# and users' first requests don't pay for the conditioning.
+#   SPEAKER_LIBRARY_DIR   the XTTS server's speaker folder, as mounted here (needed for uploads)
+#   SPEAKER_SAMPLE_RATE   rate references are stored at (22050, what XTTS conditions on)
+#   SPEAKER_MIN_SECONDS   shortest usable reference after trimming (2)
+#   SPEAKER_MAX_SECONDS   references are cut to this length (12)
+#   SPEAKER_WARMUP        "false" disables priming the library at startup (true)
+
+import io
+import os
+import re
+import wave
+import hashlib
+import logging
+import tempfile
+import subprocess
+from array import array
+from datetime import datetime
+from threading import Thread
+import click
+import requests
+from flask import Blueprint, request, jsonify
+from flask_login import login_required, current_user
+from bson.objectid import ObjectId
+from . import mongo
+from .clients import get_client
+from .speakers import speaker_cache
+from .audio_delivery import ffmpeg_command
+
+log = logging.getLogger(__name__)
+
+speaker_library = Blueprint('speaker_library', __name__, cli_group='speakers')
+
+# --- Constants ---
+SPEAKER_LIBRARY_DIR = os.environ.get('SPEAKER_LIBRARY_DIR')
+SPEAKER_SAMPLE_RATE = int(os.environ.get('SPEAKER_SAMPLE_RATE', 22050))
+SPEAKER_MIN_SECONDS = float(os.environ.get('SPEAKER_MIN_SECONDS', 2))
+SPEAKER_MAX_SECONDS = float(os.environ.get('SPEAKER_MAX_SECONDS', 12))
+SPEAKER_WARMUP = os.environ.get('SPEAKER_WARMUP', 'true').lower() not in ('0', 'false', 'no')
+SPEAKER_MAX_INPUT_SECONDS = 120 # Only the start of longer uploads is decoded
+SPEAKER_NAME_PATTERN = re.compile(r'[^A-Za-z0-9_-]+')
+SPEAKER_FILE_EXTENSIONS = ('.wav', '.mp3', '.m4a', '.ogg', '.opus', '.flac', '.webm')
+SPEAKER_PRIME_TEXT = "Hello."
+FFMPEG_TIMEOUT = 60 # seconds
+# Silence below -45 dBFS is trimmed from both ends (the filter only trims the start, hence areverse)
+_TRIM_SILENCE = "silenceremove=start_periods=1:start_threshold=-45dB:start_silence=0.1"
+SPEAKER_FILTERS = f"{_TRIM_SILENCE},areverse,{_TRIM_SILENCE},areverse,loudnorm=I=-20:TP=-2:LRA=11"
+# Fingerprints: one bit per 50 ms frame, set when the frame is louder than the one before.
+# Two clips are the same voice recording if their durations are within FINGERPRINT_MAX_DURATION_DELTA
+# seconds and at most FINGERPRINT_MAX_DISTANCE of their bits differ (survives re-encoding and resampling).
+FINGERPRINT_FRAME_SECONDS = 0.05
+FINGERPRINT_MAX_DISTANCE = 0.12
+FINGERPRINT_MAX_DURATION_DELTA = 0.5
+
+
+def speaker_name(value):
+    """Speaker ids are file names in the XTTS speaker folder: letters, digits, '_' and '-'."""
+    name = (value or '').strip()
+    if name.lower().endswith(SPEAKER_FILE_EXTENSIONS): name = os.path.splitext(name)[0]
+    name = SPEAKER_NAME_PATTERN.sub('_', name).strip('_')[:64]
+    if not name: raise ValueError("Please give the speaker a name (letters, digits, '_' or '-').")
+    return name
+
+
+# --- Normalization ---
+def normalize_reference(path):
+    """Decodes any audio file to trimmed, loudness-normalized mono 16-bit PCM at SPEAKER_SAMPLE_RATE."""
+    command = ffmpeg_command("-t", str(SPEAKER_MAX_INPUT_SECONDS), "-i", path, "-vn", "-ac", "1", "-af", SPEAKER_FILTERS,
+                             "-ar", str(SPEAKER_SAMPLE_RATE), "-t", str(SPEAKER_MAX_SECONDS), "-f", "s16le", "-acodec", "pcm_s16le", "pipe:1")
+    try:
+        result = subprocess.run(command, capture_output=True, timeout=FFMPEG_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        raise ValueError("Processing the clip took too long.")
+    if result.returncode != 0:
+        log.warning(f"ffmpeg could not normalize {path}: {result.stderr.decode('utf-8', 'replace').strip()[-300:]}")
+        raise ValueError("The clip could not be decoded as audio.")
+    pcm = result.stdout[:len(result.stdout) // 2 * 2]
+    duration = len(pcm) / 2 / SPEAKER_SAMPLE_RATE
+    if duration < SPEAKER_MIN_SECONDS:
+        raise ValueError(f"The clip has {duration:.1f}s of speech after trimming silence; at least {SPEAKER_MIN_SECONDS:.0f}s are needed.")
+    return pcm
+
+def pcm_to_wav(pcm):
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1); wav.setsampwidth(2); wav.setframerate(SPEAKER_SAMPLE_RATE)
+        wav.writeframes(pcm)
+    return buffer.getvalue()
+
+
+# --- Fingerprints ---
+def fingerprint(pcm):
+    """(hex bit string, bit count) of the clip's frame-to-frame energy changes."""
+    samples = array('h', pcm)
+    frame = max(1, int(SPEAKER_SAMPLE_RATE * FINGERPRINT_FRAME_SECONDS))
+    energies = [sum(s * s for s in samples[i:i + frame]) for i in range(0, len(samples) - frame + 1, frame)]
+    bits = 0
+    for previous, current in zip(energies, energies[1:]):
+        bits = (bits << 1) | (current > previous)
+    return format(bits, 'x'), max(0, len(energies) - 1)
+
+def fingerprint_distance(a, a_bits, b, b_bits):
+    """Fraction of differing bits over the shorter fingerprint (1.0 if either is empty)."""
+    compared = min(a_bits, b_bits)
+    if compared == 0: return 1.0
+    a_value, b_value = int(a, 16) >> (a_bits - compared), int(b, 16) >> (b_bits - compared)
+    return bin(a_value ^ b_value).count('1') / compared
+
+def find_duplicate(pcm_sha256, fingerprint_hex, fingerprint_bits, duration):
+    """The library entry holding the same recording, or None."""
+    exact = mongo.db.speakers.find_one({"sha256": pcm_sha256})
+    if exact: return exact
+    candidates = mongo.db.speakers.find({"duration": {"$gte": duration - FINGERPRINT_MAX_DURATION_DELTA, "$lte": duration + FINGERPRINT_MAX_DURATION_DELTA}})
+    for candidate in candidates:
+        if fingerprint_distance(fingerprint_hex, fingerprint_bits, candidate['fingerprint'], candidate['fingerprint_bits']) <= FINGERPRINT_MAX_DISTANCE:
+            return candidate
+    return None
+
+
+# --- Ingestion ---
+def ingest_speaker(path, name, user_id_obj=None, overwrite=False):
+    """
+    Normalizes the clip at `path` into the library as `name`.
+    Returns (speaker doc, created); created is False if the recording was already in the
+    library, in which case the existing speaker is returned. Raises ValueError for unusable clips.
+    """
+    if not SPEAKER_LIBRARY_DIR: raise ValueError("Speaker uploads are not configured (SPEAKER_LIBRARY_DIR).")
+    name = speaker_name(name)
+    pcm = normalize_reference(path)
+    pcm_sha256 = hashlib.sha256(pcm).hexdigest()
+    fingerprint_hex, fingerprint_bits = fingerprint(pcm)
+    duration = round(len(pcm) / 2 / SPEAKER_SAMPLE_RATE, 2)
+
+    duplicate = find_duplicate(pcm_sha256, fingerprint_hex, fingerprint_bits, duration)
+    if duplicate:
+        log.info(f"Speaker clip '{name}' matches library speaker '{duplicate['_id']}', not storing a copy.")
+        return duplicate, False
+    target = os.path.join(SPEAKER_LIBRARY_DIR, f"{name}.wav")
+    if not overwrite and (os.path.exists(target) or mongo.db.speakers.find_one({"_id": name}, {"_id": 1})):
+        raise ValueError(f"A speaker named '{name}' already exists.")
+
+    wav_bytes = pcm_to_wav(pcm)
+    os.makedirs(SPEAKER_LIBRARY_DIR, exist_ok=True)
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f: f.write(wav_bytes)
+    os.replace(tmp_path, target)
+    speaker_doc = {"_id": name, "sha256": pcm_sha256, "fingerprint": fingerprint_hex, "fingerprint_bits": fingerprint_bits,
+                   "duration": duration, "sample_rate": SPEAKER_SAMPLE_RATE, "size": len(wav_bytes),
+                   "created_by": user_id_obj, "created_at": datetime.utcnow()}
+    mongo.db.speakers.replace_one({"_id": name}, speaker_doc, upsert=True)
+    log.info(f"Added speaker '{name}' ({duration:.1f}s, {len(wav_bytes)} bytes).")
+    speaker_cache.invalidate() # XTTS lists the folder, so the new file shows up on the next refresh
+    return speaker_doc, True
+
+def ensure_speaker_indexes():
+    mongo.db.speakers.create_index("sha256")
+    mongo.db.speakers.create_index("duration")
+
+
+# --- Conditioning Warm-up ---
+def prime_speaker(speaker_id):
+    """
+    Sends a one-word request for the speaker to every XTTS node, so each computes and caches
+    its conditioning latents now instead of on a user's first request. Returns nodes primed.
+    """
+    xtts_client = get_client('xtts')
+    primed = 0
+    for endpoint in xtts_client.router.endpoints:
+        try:
+            xtts_client.post("/tts_to_audio", json={"text": SPEAKER_PRIME_TEXT, "language": "en", "speaker_wav": speaker_id, "options": {}},
+                             endpoint_url=endpoint.url).raise_for_status()
+            primed += 1
+        except requests.exceptions.RequestException as e:
+            log.warning(f"Could not prime speaker '{speaker_id}' on {endpoint.url}: {e}")
+    return primed
+
+def start_priming(speaker_ids=None):
+    """Primes the given speakers (default: the whole library) on a background thread."""
+    def _prime():
+        try:
+            ids = speaker_ids if speaker_ids is not None else [doc['_id'] for doc in mongo.db.speakers.find({}, {"_id": 1})]
+            for speaker_id in ids: prime_speaker(speaker_id)
+            if ids: log.info(f"Primed XTTS conditioning for {len(ids)} speaker(s).")
+        except Exception as e:
+            log.exception(f"Speaker priming failed: {type(e).__name__} - {e}")
+    Thread(target=_prime, name="speaker-primer", daemon=True).start()
+
+
+# --- Routes ---
+@speaker_library.route('/speakers', methods=['POST'])
+@login_required
+def upload_speaker():
+    """Adds an uploaded reference clip to the speaker library."""
+    if mongo.db is None: return jsonify({"error": "Database unavailable."}), 503
+    upload = request.files.get('file')
+    if not upload or not upload.filename: return jsonify({"error": "No file uploaded."}), 400
+    if not upload.mimetype.startswith('audio/') and not upload.filename.lower().endswith(SPEAKER_FILE_EXTENSIONS):
+        return jsonify({"error": "Please upload an audio file (WAV, MP3, M4A, OGG, FLAC or WEBM)."}), 400
+    # ffmpeg reads from a file: several containers (e.g. M4A) can't be decoded from a pipe
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(upload.filename)[1].lower()) as tmp:
+        upload.save(tmp); tmp.flush()
+        try: speaker_doc, created = ingest_speaker(tmp.name, request.form.get('name') or upload.filename, ObjectId(current_user.id))
+        except ValueError as e: return jsonify({"error": str(e)}), 400
+    if created: start_priming([speaker_doc['_id']])
+    return jsonify({"speaker_id": speaker_doc['_id'], "duration": speaker_doc['duration'], "duplicate": not created}), (201 if created else 200)
+
+@speaker_library.route('/speakers/library', methods=['GET'])
+@login_required
+def list_speaker_library():
+    if mongo.db is None: return jsonify({"error": "Database unavailable."}), 503
+    speakers = [{"speaker_id": doc['_id'], "duration": doc['duration'], "created_at": doc['created_at'].isoformat()}
+                for doc in mongo.db.speakers.find({}, {"duration": 1, "created_at": 1}).sort("_id", 1)]
+    return jsonify({"speakers": speakers})
+
+
+# --- CLI ---
+@speaker_library.cli.command('import')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--overwrite', is_flag=True, help='Replace library files of the same name (e.g. to normalize the existing references in place).')
+def import_command(directory, overwrite):
+    """Adds every audio file in DIRECTORY to the speaker library, named after the file."""
+    added = []
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.lower().endswith(SPEAKER_FILE_EXTENSIONS): continue
+        try:
+            speaker_doc, created = ingest_speaker(os.path.join(directory, file_name), file_name, overwrite=overwrite)
+        except ValueError as e:
+            click.echo(f"{file_name}: skipped, {e}"); continue
+        if created: added.append(speaker_doc['_id'])
+        click.echo(f"{file_name}: {'added as' if created else 'duplicate of'} '{speaker_doc['_id']}' ({speaker_doc['duration']:.1f}s)")
+    click.echo(f"Added {len(added)} speaker(s).")
+    if os.environ.get('XTTS_API_URL'):
+        for speaker_id in added: prime_speaker(speaker_id) # In the foreground: the CLI process exits when done
@@ -0,0 +1,95 @@
+# flask_app/speakers.py
+
+# Process-wide cache of the XTTS speaker list.
+# Page renders read the cached list and never wait on XTTS. A daemon thread refreshes it
+# every SPEAKER_REFRESH_INTERVAL seconds, entries older than SPEAKER_CACHE_TTL trigger a
+# background refresh on read (stale-while-revalidate), and a failed refresh keeps serving
+# the last good list until XTTS is reachable again.
+
+import logging
+import os
+import time
+from threading import Lock, Event, Thread
+from .generation import fetch_speakers
+
+log = logging.getLogger(__name__)
+
+SPEAKER_CACHE_TTL = int(os.environ.get('SPEAKER_CACHE_TTL', 300)) # seconds
+SPEAKER_REFRESH_INTERVAL = int(os.environ.get('SPEAKER_REFRESH_INTERVAL', 120)) # seconds
+SPEAKER_RETRY_AFTER_FAILURE = 30 # seconds between refresh attempts while XTTS is failing
+
+
+class SpeakerCache:
+    """TTL cache for one list, refreshed in the background with single-flight fetches."""
+
+    def __init__(self, fetch_fn, ttl_seconds, refresh_interval_seconds):
+        self._fetch_fn = fetch_fn
+        self.ttl = ttl_seconds
+        self.refresh_interval = refresh_interval_seconds
+        self._speakers = []
+        self._fetched_at = None # monotonic time of the last successful fetch
+        self._retry_after = 0.0 # monotonic time before which failed fetches are not retried
+        self._lock = Lock()
+        self._refresh_lock = Lock() # held while a fetch is in flight
+        self._first_attempt_done = Event()
+        self._refresher = None
+
+    def get(self, wait_timeout=0):
+        """
+        Returns the cached speakers without blocking on XTTS. If nothing was fetched yet,
+        waits up to `wait_timeout` seconds for the first fetch (0 = don't wait).
+        """
+        with self._lock:
+            fetched_at, speakers = self._fetched_at, self._speakers
+        now = time.monotonic()
+        if (fetched_at is None or now - fetched_at > self.ttl) and now >= self._retry_after:
+            self.refresh_async()
+        if fetched_at is None and wait_timeout:
+            self._first_attempt_done.wait(wait_timeout)
+            with self._lock: speakers = self._speakers
+        return list(speakers)
+
+    def refresh(self):
+        """Fetches now unless a fetch is already running. Returns True if the list was updated."""
+        if not self._refresh_lock.acquire(blocking=False):
+            return False
+        try:
+            speakers = self._fetch_fn()
+            with self._lock:
+                self._speakers, self._fetched_at = speakers, time.monotonic()
+            return True
+        except Exception as e:
+            self._retry_after = time.monotonic() + SPEAKER_RETRY_AFTER_FAILURE
+            log.warning(f"Speaker refresh failed, serving {len(self._speakers)} cached speaker(s): {type(e).__name__} - {e}")
+            return False
+        finally:
+            self._refresh_lock.release()
+            self._first_attempt_done.set()
+
+    def refresh_async(self):
+        if not self._refresh_lock.locked():
+            Thread(target=self.refresh, name="speaker-refresh", daemon=True).start()
+
+    def invalidate(self):
+        """Marks the list stale so the next read refetches. The old list is kept as a fallback."""
+        with self._lock:
+            self._fetched_at = None
+        self._retry_after = 0.0
+
+    def start_background_refresh(self):
+        """Starts the periodic refresher thread (idempotent)."""
+        if self._refresher is not None: return
+        def _loop():
+            while True:
+                self.refresh()
+                time.sleep(self.refresh_interval)
+        self._refresher = Thread(target=_loop, name="speaker-refresher", daemon=True)
+        self._refresher.start()
+        log.info(f"Speaker cache refresher started (interval {self.refresh_interval}s, TTL {self.ttl}s).")
+
+
+speaker_cache = SpeakerCache(fetch_speakers, SPEAKER_CACHE_TTL, SPEAKER_REFRESH_INTERVAL)
+
+def get_available_speakers(wait_timeout=0):
+    """Cached XTTS speaker names. Pass wait_timeout when the caller needs a list (e.g. synthesis)."""
+    return speaker_cache.get(wait_timeout=wait_timeout)
@@ -0,0 +1,284 @@
+# flask_app/speech.py
+
+# Long-form text-to-speech.
+# XTTS synthesizes a whole request before answering, and its quality drops on inputs longer
+# than its per-language character limit, so a script sent in one call is slow to start and
+# may come back garbled. Here the text is split into sentences (terminators and limits per
+# language code), packed into chunks under the limit, and the chunks are synthesized
+# concurrently across the available XTTS capacity (per-node concurrency x nodes, shared
+# fairly with other users, see scheduling.py). The PCM is stitched back together in order
+# with a short crossfade at each seam.
+# POST /generate-audio/stream registers a script and returns a URL; GET on that URL streams
+# the WAV as chunks finish, so playback starts after the first sentence instead of after the
+# whole script. Chunks go through the audio cache, so replays and downloads are cheap.
+#   TTS_CROSSFADE_MS          crossfade between chunks in milliseconds (30)
+#   AUDIO_STREAM_TTL          seconds a registered script stays playable (86400)
+
+import io
+import re
+import os
+import math
+import wave
+import struct
+import logging
+import requests
+import contextvars
+from array import array
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from flask import Blueprint, request, jsonify, url_for, redirect, Response, stream_with_context
+from flask_login import login_required, current_user
+from bson.objectid import ObjectId
+from . import mongo
+from .clients import get_client
+from .generation import synthesize_speech
+from .scheduling import backend_concurrency
+from .speakers import get_available_speakers
+from .rate_limit import check_rate_limit, RateLimited
+from .audio_delivery import deliver_audio, audio_filename
+
+log = logging.getLogger(__name__)
+
+speech = Blueprint('speech', __name__)
+
+# --- Constants ---
+# XTTS v2 per-language character limits (its tokenizer warns and degrades above these)
+XTTS_CHAR_LIMITS = {
+    "en": 250, "de": 253, "fr": 273, "es": 239, "it": 213, "pt": 203, "pl": 224, "tr": 226,
+    "ru": 182, "nl": 251, "cs": 186, "ar": 166, "zh-cn": 82, "hu": 224, "ko": 95, "ja": 71,
+}
+DEFAULT_CHAR_LIMIT = 200
+# Languages written without spaces between sentences
+NO_SPACE_LANGUAGES = frozenset(["zh-cn", "ja"])
+SENTENCE_TERMINATORS = {
+    "default": ".!?…",
+    "ar": ".!?…؟۔",
+    "zh-cn": "。！？!?…",
+    "ja": "。！？!?…",
+}
+CLAUSE_SEPARATORS = ",;:—–،、，；："
+# Words that end with a period without ending the sentence
+ABBREVIATIONS = {
+    "en": {"mr", "mrs", "ms", "dr", "prof", "st", "vs", "etc", "e.g", "i.e", "inc", "ltd", "jr", "sr", "no"},
+    "fr": {"m", "mme", "mlle", "dr", "st", "etc", "p.ex", "cf"},
+    "de": {"dr", "prof", "nr", "bzw", "usw", "z.b", "d.h", "ca", "str"},
+    "es": {"sr", "sra", "srta", "dr", "dra", "etc", "p.ej", "ud", "uds"},
+    "it": {"sig", "sig.ra", "dott", "prof", "ecc"},
+    "pt": {"sr", "sra", "dr", "dra", "etc"},
+    "nl": {"dhr", "mevr", "dr", "bijv", "enz"},
+}
+TTS_CROSSFADE_MS = int(os.environ.get('TTS_CROSSFADE_MS', 30))
+AUDIO_STREAM_TTL = int(os.environ.get('AUDIO_STREAM_TTL', 86400))
+STREAMED_WAV_SIZE = 0xFFFFFFFF # RIFF/data size for a stream of unknown length; browsers play until EOF
+
+
+# --- Text Splitting ---
+def split_sentences(text, language_code):
+    """Splits text into sentences using the language's terminators; newlines always end one."""
+    terminators = re.escape(SENTENCE_TERMINATORS.get(language_code, SENTENCE_TERMINATORS["default"]))
+    closing = "\"'”’»)\\]」』"
+    gap = r"\s*" if language_code in NO_SPACE_LANGUAGES else r"\s+"
+    boundary = re.compile(rf"[{terminators}]+[{closing}]*(?={gap}\S)|\n+")
+    abbreviations = ABBREVIATIONS.get(language_code, set())
+    sentences, start = [], 0
+    for match in boundary.finditer(text):
+        end = match.end()
+        candidate = text[start:end].strip()
+        last_word = candidate.rsplit(None, 1)[-1].rstrip('.').lower() if candidate and match.group().startswith('.') else ""
+        if last_word in abbreviations or (len(last_word) == 1 and last_word.isalpha() and language_code not in NO_SPACE_LANGUAGES):
+            continue # "Dr. Smith", "J. Doe"
+        if candidate: sentences.append(candidate)
+        start = end
+    if text[start:].strip(): sentences.append(text[start:].strip())
+    return sentences
+
+def _split_long(sentence, limit, language_code):
+    """Breaks a sentence over the limit at clause separators, then between words (or characters)."""
+    pieces, rest = [], sentence
+    while len(rest) > limit:
+        window = rest[:limit]
+        cut = max(window.rfind(c) for c in CLAUSE_SEPARATORS) + 1
+        if cut <= limit // 3 and language_code not in NO_SPACE_LANGUAGES: cut = window.rfind(' ')
+        if cut <= limit // 3: cut = limit
+        pieces.append(rest[:cut].strip()); rest = rest[cut:].strip()
+    if rest: pieces.append(rest)
+    return pieces
+
+def chunk_text(text, language_code):
+    """
+    Sentences packed into chunks under the language's XTTS limit. The first chunk is a single
+    sentence so the first audio arrives as early as possible.
+    """
+    limit = XTTS_CHAR_LIMITS.get(language_code, DEFAULT_CHAR_LIMIT)
+    joiner = "" if language_code in NO_SPACE_LANGUAGES else " "
+    chunks = []
+    for sentence in split_sentences(text, language_code):
+        for piece in _split_long(sentence, limit, language_code):
+            if len(chunks) > 1 and len(chunks[-1]) + len(joiner) + len(piece) <= limit: chunks[-1] += joiner + piece
+            else: chunks.append(piece)
+    return chunks
+
+
+# --- PCM Stitching ---
+def read_wav(wav_bytes):
+    """(params, PCM samples as array('h')) of a 16-bit WAV."""
+    with wave.open(io.BytesIO(wav_bytes), 'rb') as wav:
+        params = (wav.getnchannels(), wav.getsampwidth(), wav.getframerate())
+        frames = wav.readframes(wav.getnframes())
+    if params[1] != 2: raise ValueError(f"Unsupported XTTS sample width: {params[1] * 8} bits.")
+    samples = array('h'); samples.frombytes(frames)
+    return params, samples
+
+def wav_header(channels, sample_width, sample_rate, data_size=None):
+    """RIFF header; without data_size the stream is marked as open-ended."""
+    riff_size = STREAMED_WAV_SIZE if data_size is None else 36 + data_size
+    data_size = STREAMED_WAV_SIZE if data_size is None else data_size
+    byte_rate = sample_rate * channels * sample_width
+    return (b"RIFF" + struct.pack("<I", riff_size) + b"WAVE"
+            + b"fmt " + struct.pack("<IHHIIHH", 16, 1, channels, sample_rate, byte_rate, channels * sample_width, sample_width * 8)
+            + b"data" + struct.pack("<I", data_size))
+
+def _crossfade(tail, head):
+    """Mixes the end of one chunk into the start of the next with linear fades."""
+    count = min(len(tail), len(head))
+    mixed = array('h', head)
+    for i in range(count):
+        fade_in = (i + 1) / (count + 1)
+        mixed[i] = max(-32768, min(32767, int(tail[i] * (1 - fade_in) + head[i] * fade_in)))
+    return mixed
+
+def stitch_pcm(wavs):
+    """
+    Joins WAV chunks (an iterable, consumed lazily) into one PCM stream with crossfades.
+    Yields the WAV params first, then PCM bytes as soon as they are final.
+    """
+    params, held = None, None
+    for wav_bytes in wavs:
+        chunk_params, samples = read_wav(wav_bytes)
+        if params is None:
+            params = chunk_params
+            yield params
+        elif chunk_params != params:
+            raise ValueError(f"XTTS returned chunks in different formats ({chunk_params} vs {params}).")
+        fade = math.ceil(params[2] * TTS_CROSSFADE_MS / 1000) * params[0]
+        fade -= fade % params[0] # Whole frames only
+        if held is not None:
+            fade = min(fade, len(held), len(samples))
+            samples = _crossfade(held[len(held) - fade:], samples[:fade]) + samples[fade:] if fade else samples
+            held_out = held[:len(held) - fade]
+            if held_out: yield held_out.tobytes()
+        # Keep the end back until the next chunk arrives to fade it out
+        split = max(0, len(samples) - fade)
+        yield samples[:split].tobytes()
+        held = samples[split:]
+    if held: yield held.tobytes()
+
+
+# --- Synthesis ---
+def synthesis_capacity():
+    """XTTS calls that can run at once across all nodes."""
+    return backend_concurrency('xtts') * len(get_client('xtts').router.endpoints)
+
+def synthesize_chunks(chunks, language_code, speaker_id):
+    """
+    Yields the WAV of each chunk in order while later chunks are still being synthesized.
+    Closing the generator early (e.g. the listener went away) cancels chunks not yet started.
+    """
+    executor = ThreadPoolExecutor(max_workers=max(1, min(synthesis_capacity(), len(chunks))), thread_name_prefix="tts-chunk")
+    try:
+        # Each chunk runs in a copy of this context so it is queued for the same user (see scheduling.py)
+        futures = [executor.submit(contextvars.copy_context().run, synthesize_speech, chunk, language_code, speaker_id) for chunk in chunks]
+        for future in futures: yield future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def synthesize_long_form(text, language_code, speaker_id):
+    """Chunked, concurrent synthesis of `text`; returns one WAV. Short texts are a single XTTS call."""
+    chunks = chunk_text(text, language_code)
+    if len(chunks) <= 1: return synthesize_speech(text, language_code, speaker_id)
+    parts = stitch_pcm(synthesize_chunks(chunks, language_code, speaker_id))
+    channels, sample_width, sample_rate = next(parts)
+    pcm = b"".join(parts)
+    log.info(f"Synthesized {len(text)} characters in {len(chunks)} chunks ({len(pcm) / (sample_rate * channels * sample_width):.1f}s of audio).")
+    return wav_header(channels, sample_width, sample_rate, len(pcm)) + pcm
+
+def stream_long_form(text, language_code, speaker_id):
+    """
+    Starts a chunked synthesis and waits for the first chunk, so failures before any audio is
+    ready can still be reported as an error. Returns a generator of WAV bytes (open-ended header,
+    then PCM) that must be consumed or closed.
+    """
+    chunks = chunk_text(text, language_code)
+    parts = stitch_pcm(synthesize_chunks(chunks, language_code, speaker_id))
+    try: params = next(parts)
+    except BaseException: parts.close(); raise
+
+    def generate():
+        try:
+            yield wav_header(*params)
+            yield from parts
+            log.info(f"Streamed {len(text)} characters of speech in {len(chunks)} chunk(s).")
+        finally:
+            parts.close()
+    return generate()
+
+
+# --- Routes ---
+def ensure_audio_stream_indexes():
+    mongo.db.audio_streams.create_index("created_at", expireAfterSeconds=AUDIO_STREAM_TTL)
+
+@speech.route('/generate-audio/stream', methods=['POST'])
+@login_required
+def register_audio_stream():
+    """Validates an audio form submission and returns the URL that streams its speech."""
+    from .views import SUPPORTED_LANGUAGES # views owns the language list shown in the dashboard
+    if mongo.db is None: return jsonify({"error": "Database unavailable."}), 503
+    text = request.form.get('audio_text', '').strip()
+    language_code = request.form.get('language_code', 'en')
+    try:
+        if not text: raise ValueError("Text for audio generation cannot be empty.")
+        if language_code not in SUPPORTED_LANGUAGES: raise ValueError(f"Invalid language code selected: {language_code}")
+        available_speakers = get_available_speakers(wait_timeout=15)
+        if not available_speakers: raise ValueError("No speakers are available/loaded from the TTS service.")
+        speaker_id = request.form.get('speaker_id')
+        if speaker_id not in available_speakers: speaker_id = available_speakers[0]
+        chunk_count = len(chunk_text(text, language_code))
+        check_rate_limit("audio", current_user.id, chunk_count)
+    except ValueError as e: return jsonify({"error": str(e)}), 400
+    except RateLimited as e: return jsonify({"error": str(e), "retry_after": math.ceil(e.retry_after)}), 429, {"Retry-After": str(math.ceil(e.retry_after))}
+
+    stream_id = mongo.db.audio_streams.insert_one({"user_id": ObjectId(current_user.id), "text": text, "language_code": language_code,
+                                                   "speaker_id": speaker_id, "chunks": chunk_count, "created_at": datetime.utcnow()}).inserted_id
+    return jsonify({"stream_id": str(stream_id), "chunks": chunk_count, "speaker_id": speaker_id,
+                    "stream_url": url_for('speech.audio_stream', stream_id=str(stream_id)),
+                    "download_url": url_for('speech.audio_stream', stream_id=str(stream_id), download=1)}), 201
+
+@speech.route('/audio-streams/<stream_id>', methods=['GET'])
+@login_required
+def audio_stream(stream_id):
+    """Streams the registered script as WAV (chunked); ?download=1 redirects to one compressed file instead."""
+    if not ObjectId.is_valid(stream_id): return jsonify({"error": "Invalid audio stream id."}), 404
+    stream_doc = mongo.db.audio_streams.find_one({"_id": ObjectId(stream_id), "user_id": ObjectId(current_user.id)})
+    if not stream_doc: return jsonify({"error": "Audio stream not found or expired."}), 404
+    text, language_code, speaker_id = stream_doc['text'], stream_doc['language_code'], stream_doc['speaker_id']
+
+    try:
+        if request.args.get('download'):
+            audio_id, content_type = deliver_audio(synthesize_long_form(text, language_code, speaker_id), ObjectId(current_user.id))
+            return redirect(url_for('media.serve_media', media_id=audio_id, download=audio_filename(f"speech_{stream_id}", content_type)))
+        wav_stream = stream_long_form(text, language_code, speaker_id)
+    except requests.exceptions.Timeout: log.error(f"Timeout synthesizing audio stream {stream_id}."); return jsonify({"error": "The request to the audio generation service timed out."}), 504
+    except requests.exceptions.RequestException as e: log.error(f"RequestException synthesizing audio stream {stream_id}: {e}"); return jsonify({"error": f"Error connecting to audio generation service: {e}"}), 502
+    except ValueError as e: log.error(f"ValueError synthesizing audio stream {stream_id}: {e}"); return jsonify({"error": str(e)}), 502
+
+    def generate():
+        try:
+            yield from wav_stream
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # Headers are already sent; the player sees the audio end early
+            log.error(f"Audio stream {stream_id} interrupted: {type(e).__name__} - {e}")
+        finally:
+            wav_stream.close()
+
+    headers = {'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'} # Disable proxy buffering so audio flushes per chunk
+    return Response(stream_with_context(generate()), mimetype='audio/wav', headers=headers)
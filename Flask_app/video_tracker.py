@@ -0,0 +1,170 @@
+# flask_app/video_tracker.py
+
+# Follows queued ComfyUI prompts until their video is ready.
+# Every prompt we queue gets a document in mongo.db.video_renders. A daemon thread polls
+# ComfyUI's /queue (queued vs. running) and /history/<prompt_id> (finished), records the
+# timestamps of each transition so queue wait and render time are visible per job, and
+# copies the finished VHS_VideoCombine output from /view into the media store. The browser
+# polls /videos/<prompt_id> and gets a playable media URL instead of a folder to check.
+# With several ComfyUI nodes each render records the node that queued it, and is polled there.
+
+import logging
+import os
+import time
+import mimetypes
+import traceback
+import requests
+from threading import Thread, Lock
+from datetime import datetime, timedelta
+from flask import Blueprint, jsonify
+from flask_login import login_required, current_user
+from bson.objectid import ObjectId
+from . import mongo
+from .clients import get_client
+from .media import store_media, media_url
+
+log = logging.getLogger(__name__)
+
+videos = Blueprint('videos', __name__)
+
+# --- Constants ---
+VIDEO_POLL_INTERVAL = float(os.environ.get('VIDEO_POLL_INTERVAL', 2)) # seconds between ComfyUI polls
+VIDEO_RENDER_TIMEOUT = int(os.environ.get('VIDEO_RENDER_TIMEOUT', 1800)) # give up on a prompt after this many seconds
+VIDEO_ACTIVE_STATUSES = ("queued", "running")
+# ComfyUI output keys to collect, in order of preference (VHS_VideoCombine reports its files under "gifs")
+COMFY_OUTPUT_KEYS = ("gifs", "videos", "images")
+
+
+def ensure_video_indexes():
+    mongo.db.video_renders.create_index([("status", 1), ("queued_at", 1)])
+
+def track_prompt(prompt_id, user_id_obj):
+    """Registers a freshly queued ComfyUI prompt with the tracker."""
+    now = datetime.utcnow()
+    endpoint_url = get_client('comfyui').router.bound_endpoint(f"prompt:{prompt_id}") # Bound by queue_svd_video
+    mongo.db.video_renders.insert_one({"_id": prompt_id, "user_id": user_id_obj, "endpoint": endpoint_url, "status": "queued", "queue_position": None,
+                                       "queued_at": now, "started_at": None, "finished_at": None, "updated_at": now,
+                                       "outputs": [], "error": None})
+
+
+# --- Polling ---
+def _seconds_between(start, end):
+    return round((end - start).total_seconds(), 1) if start and end else None
+
+def _finish(render_doc, outputs=None, error=None):
+    now = datetime.utcnow()
+    started_at = render_doc.get('started_at')
+    update = {"status": "failed" if error else "succeeded", "outputs": outputs or [], "error": error,
+              "finished_at": now, "updated_at": now, "queue_position": None,
+              "run_seconds": _seconds_between(started_at, now), "total_seconds": _seconds_between(render_doc['queued_at'], now)}
+    # Conditional so that two app processes polling the same prompt don't both finish it
+    mongo.db.video_renders.update_one({"_id": render_doc['_id'], "status": {"$in": list(VIDEO_ACTIVE_STATUSES)}}, {"$set": update})
+    log.info(f"Video render {render_doc['_id']} {update['status']} after {update['total_seconds']}s{f': {error}' if error else ''}.")
+
+def _fetch_outputs(comfy_client, endpoint_url, history_entry, user_id_obj):
+    """Downloads the prompt's output files through the node's /view and stores them as media."""
+    outputs = []
+    for node_id, node_output in (history_entry.get('outputs') or {}).items():
+        for key in COMFY_OUTPUT_KEYS:
+            for file_info in node_output.get(key, []):
+                if file_info.get('type') == 'temp': continue # Previews, not results
+                params = {"filename": file_info['filename'], "subfolder": file_info.get('subfolder', ''), "type": file_info.get('type', 'output')}
+                response = comfy_client.get("/view", params=params, timeout=(comfy_client.timeout[0], 120), endpoint_url=endpoint_url); response.raise_for_status()
+                content_type = mimetypes.guess_type(file_info['filename'])[0] or response.headers.get('Content-Type', 'application/octet-stream')
+                outputs.append({"media_id": store_media(response.content, content_type, user_id_obj), "filename": file_info['filename'],
+                                "content_type": content_type, "node_id": node_id})
+    return outputs
+
+def poll_once():
+    """One pass over all active renders. Returns the number still active."""
+    active = list(mongo.db.video_renders.find({"status": {"$in": list(VIDEO_ACTIVE_STATUSES)}}))
+    if not active: return 0
+    comfy_client = get_client('comfyui')
+    configured = {e.url for e in comfy_client.router.endpoints}
+    by_endpoint = {}
+    for render_doc in active:
+        # Renders queued before multi-node routing (or on a node since removed) are polled on any node
+        endpoint_url = render_doc.get('endpoint') if render_doc.get('endpoint') in configured else None
+        by_endpoint.setdefault(endpoint_url, []).append(render_doc)
+    for endpoint_url, render_docs in by_endpoint.items():
+        try:
+            _poll_endpoint(comfy_client, endpoint_url, render_docs)
+        except requests.exceptions.RequestException as e:
+            log.warning(f"Could not reach ComfyUI node {endpoint_url or comfy_client.base_url}: {e}")
+    return len(active)
+
+def _poll_endpoint(comfy_client, endpoint_url, render_docs):
+    queue = comfy_client.get("/queue", timeout=(comfy_client.timeout[0], 10), endpoint_url=endpoint_url).json()
+    running_ids = {item[1] for item in queue.get('queue_running', [])}
+    pending_ids = [item[1] for item in sorted(queue.get('queue_pending', []), key=lambda item: item[0])]
+    now = datetime.utcnow()
+
+    for render_doc in render_docs:
+        prompt_id = render_doc['_id']
+        try:
+            if prompt_id in running_ids:
+                if render_doc['status'] != "running":
+                    mongo.db.video_renders.update_one({"_id": prompt_id}, {"$set": {"status": "running", "queue_position": None, "started_at": now, "updated_at": now,
+                                                                                    "queue_wait_seconds": _seconds_between(render_doc['queued_at'], now)}})
+                continue
+            if prompt_id in pending_ids:
+                mongo.db.video_renders.update_one({"_id": prompt_id}, {"$set": {"queue_position": pending_ids.index(prompt_id) + 1, "updated_at": now}})
+                continue
+            # Not in the queue any more: either finished (history entry) or lost (e.g. ComfyUI restarted)
+            history_entry = comfy_client.get(f"/history/{prompt_id}", timeout=(comfy_client.timeout[0], 10), endpoint_url=endpoint_url).json().get(prompt_id)
+            if history_entry:
+                status = history_entry.get('status') or {}
+                if status.get('status_str') == 'error':
+                    errors = [m[1].get('exception_message') for m in status.get('messages', []) if m[0] == 'execution_error']
+                    _finish(render_doc, error=f"ComfyUI failed to render the video: {errors[0] if errors else 'unknown error'}")
+                    continue
+                outputs = _fetch_outputs(comfy_client, endpoint_url, history_entry, render_doc.get('user_id'))
+                if outputs: _finish(render_doc, outputs=outputs)
+                else: _finish(render_doc, error="ComfyUI finished without producing a video. Check the workflow's VHS_VideoCombine node.")
+            elif now - render_doc['queued_at'] > timedelta(seconds=VIDEO_RENDER_TIMEOUT):
+                _finish(render_doc, error="The video render did not finish in time.")
+        except requests.exceptions.RequestException as e:
+            log.warning(f"Could not check video render {prompt_id}: {e}")
+
+class VideoTracker:
+    """Runs poll_once on a daemon thread inside the app context."""
+
+    def __init__(self, interval_seconds):
+        self.interval = interval_seconds
+        self._thread = None
+        self._lock = Lock()
+
+    def start(self, app):
+        """Starts the polling thread (idempotent). Renders left active by a restart are picked up again."""
+        with self._lock:
+            if self._thread is not None: return
+            self._thread = Thread(target=self._loop, args=(app,), name="video-tracker", daemon=True)
+            self._thread.start()
+        log.info(f"Video tracker started (interval {self.interval}s).")
+
+    def _loop(self, app):
+        while True:
+            try:
+                with app.app_context(): poll_once()
+            except requests.exceptions.RequestException as e: log.warning(f"Video tracker could not reach ComfyUI: {e}")
+            except Exception as e: log.error(f"Video tracker poll failed: {type(e).__name__} - {e}\n{traceback.format_exc()}")
+            time.sleep(self.interval)
+
+
+video_tracker = VideoTracker(VIDEO_POLL_INTERVAL)
+
+
+# --- Routes ---
+def serialize_render(render_doc):
+    return {"prompt_id": render_doc['_id'], "status": render_doc['status'], "queue_position": render_doc.get('queue_position'),
+            "queue_wait_seconds": render_doc.get('queue_wait_seconds'), "run_seconds": render_doc.get('run_seconds'),
+            "total_seconds": render_doc.get('total_seconds'), "error": render_doc.get('error'),
+            "outputs": [{**o, "url": media_url(o['media_id'])} for o in render_doc.get('outputs', [])]}
+
+@videos.route('/videos/<prompt_id>', methods=['GET'])
+@login_required
+def video_status(prompt_id):
+    """Polling endpoint for a queued video: progress, latency breakdown and output URLs."""
+    render_doc = mongo.db.video_renders.find_one({"_id": prompt_id, "user_id": ObjectId(current_user.id)})
+    if not render_doc: return jsonify({"error": "Video job not found."}), 404
+    return jsonify(serialize_render(render_doc))
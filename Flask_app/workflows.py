@@ -0,0 +1,158 @@
+# flask_app/workflows.py
+
+# Registry of ComfyUI workflow templates.
+# Every *.json under WORKFLOW_TEMPLATES_DIR is parsed and validated once, at startup, and
+# kept in memory. Nodes are found by role (via their class_type) rather than by fixed ids,
+# so a template re-exported from ComfyUI with renumbered nodes keeps working. The directory
+# is re-checked for changed mtimes at most every WORKFLOW_RELOAD_INTERVAL seconds; a template
+# that fails validation on reload is reported and the last good version stays in service.
+# Requests get a WorkflowInstance that copies only the nodes it modifies.
+
+import logging
+import os
+import json
+import time
+from threading import Lock
+from types import MappingProxyType
+
+log = logging.getLogger(__name__)
+
+WORKFLOW_TEMPLATES_DIR = os.environ.get('WORKFLOW_TEMPLATES_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'workflow_templates'))
+WORKFLOW_RELOAD_INTERVAL = float(os.environ.get('WORKFLOW_RELOAD_INTERVAL', 5)) # seconds between mtime checks
+# Node roles: role -> class_types that can fill it. Each template must resolve every role it
+# uses to exactly one node.
+NODE_ROLES = {
+    "load_image": ("LoadImage",),
+    "video_output": ("VHS_VideoCombine", "SaveAnimatedWEBP", "SaveAnimatedPNG"),
+}
+
+
+class WorkflowError(ValueError):
+    """A template is missing, is not in ComfyUI API format, or fails validation."""
+
+
+class WorkflowTemplate:
+    """One validated API-format workflow. Treat `nodes` as read-only; use instantiate()."""
+
+    def __init__(self, name, path, mtime, nodes):
+        self.name = name
+        self.path = path
+        self.mtime = mtime
+        self.nodes = MappingProxyType(nodes)
+        self.roles = resolve_roles(name, nodes)
+
+    def instantiate(self):
+        return WorkflowInstance(self)
+
+
+class WorkflowInstance:
+    """Copy-on-write view of a template: unchanged nodes are shared with the template."""
+
+    def __init__(self, template):
+        self.template = template
+        self._overrides = {}
+
+    def set_input(self, role, input_name, value):
+        node_id = self.template.roles.get(role)
+        if node_id is None: raise WorkflowError(f"Workflow '{self.template.name}' has no '{role}' node.")
+        if node_id not in self._overrides:
+            node = self.template.nodes[node_id]
+            self._overrides[node_id] = {**node, "inputs": dict(node["inputs"])}
+        if input_name not in self._overrides[node_id]["inputs"]:
+            raise WorkflowError(f"Node {node_id} ({self._overrides[node_id]['class_type']}) in workflow '{self.template.name}' has no input '{input_name}'.")
+        self._overrides[node_id]["inputs"][input_name] = value
+        return self
+
+    def to_prompt(self):
+        """The `prompt` value for ComfyUI's /prompt endpoint."""
+        return {node_id: self._overrides.get(node_id, node) for node_id, node in self.template.nodes.items()}
+
+
+# --- Validation ---
+def validate_nodes(name, data):
+    """Checks that `data` is an API-format workflow ({node_id: {class_type, inputs}}) with intact links."""
+    if not isinstance(data, dict) or not data: raise WorkflowError(f"Workflow '{name}' is empty or not a JSON object.")
+    if "nodes" in data and "links" in data:
+        raise WorkflowError(f"Workflow '{name}' is a ComfyUI UI export. Re-export it with 'Save (API Format)'.")
+    for node_id, node in data.items():
+        if not isinstance(node, dict) or not isinstance(node.get("class_type"), str) or not isinstance(node.get("inputs"), dict):
+            raise WorkflowError(f"Workflow '{name}': node {node_id} needs a 'class_type' string and an 'inputs' object.")
+        for input_name, value in node["inputs"].items():
+            # Links are [source_node_id, output_index]
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[1], int) and str(value[0]) not in data:
+                raise WorkflowError(f"Workflow '{name}': input '{input_name}' of node {node_id} links to missing node {value[0]}.")
+    return data
+
+def resolve_roles(name, nodes):
+    """Maps each role to the id of the single node whose class_type fills it."""
+    roles = {}
+    for role, class_types in NODE_ROLES.items():
+        matches = [node_id for node_id, node in nodes.items() if node["class_type"] in class_types]
+        if len(matches) > 1: raise WorkflowError(f"Workflow '{name}' has several '{role}' nodes ({', '.join(matches)}).")
+        if matches: roles[role] = matches[0]
+    return roles
+
+def load_template(path):
+    name = os.path.splitext(os.path.basename(path))[0]
+    mtime = os.path.getmtime(path)
+    try:
+        with open(path, "r") as f: data = json.load(f)
+    except json.JSONDecodeError as e:
+        raise WorkflowError(f"Workflow '{name}' is not valid JSON: {e}")
+    return WorkflowTemplate(name, path, mtime, validate_nodes(name, data))
+
+
+class WorkflowRegistry:
+    """Templates by name (file name without .json), reloaded when their files change."""
+
+    def __init__(self, directory, reload_interval):
+        self.directory = directory
+        self.reload_interval = reload_interval
+        self._templates = {}
+        self._errors = {} # name -> last validation error, for templates that never loaded or failed a reload
+        self._mtimes = {} # path -> mtime last attempted, so a broken file isn't re-parsed every check
+        self._checked_at = 0.0
+        self._lock = Lock()
+
+    def load_all(self):
+        """Loads every template now. Returns {name: error} for the ones that failed."""
+        with self._lock:
+            self._scan()
+        log.info(f"Loaded {len(self._templates)} workflow template(s) from {self.directory}: {', '.join(sorted(self._templates)) or 'none'}.")
+        return dict(self._errors)
+
+    def get(self, name):
+        """Returns the current template. Raises WorkflowError if it is missing or invalid."""
+        if time.monotonic() - self._checked_at > self.reload_interval:
+            with self._lock:
+                if time.monotonic() - self._checked_at > self.reload_interval: self._scan()
+        template = self._templates.get(name)
+        if template is None:
+            raise WorkflowError(self._errors.get(name) or f"Workflow template '{name}' not found in {self.directory}.")
+        return template
+
+    def _scan(self):
+        self._checked_at = time.monotonic()
+        try:
+            paths = {os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith('.json')}
+        except FileNotFoundError:
+            paths = set()
+        for path in paths:
+            mtime = os.path.getmtime(path)
+            if self._mtimes.get(path) == mtime: continue
+            self._mtimes[path] = mtime
+            name = os.path.splitext(os.path.basename(path))[0]
+            try:
+                self._templates[name] = load_template(path)
+                self._errors.pop(name, None)
+                log.info(f"Workflow template '{name}' loaded (roles: {self._templates[name].roles}).")
+            except (WorkflowError, OSError) as e:
+                self._errors[name] = str(e)
+                log.error(f"{e}{' Keeping the previously loaded version.' if name in self._templates else ''}")
+        for path in set(self._mtimes) - paths: # Deleted files
+            name = os.path.splitext(os.path.basename(path))[0]
+            self._mtimes.pop(path); self._templates.pop(name, None); self._errors.pop(name, None)
+            log.info(f"Workflow template '{name}' removed.")
+
+
+workflow_registry = WorkflowRegistry(WORKFLOW_TEMPLATES_DIR, WORKFLOW_RELOAD_INTERVAL)
@@ -0,0 +1,247 @@
+# benchmarks/run.py
+
+# Load test for the Flask app against local stub backends (see stubs.py): no GPU, no network.
+# Starts the stubs, points the app's backend URLs at them, builds the app with create_app()
+# and drives its routes from concurrent logged-in test clients. Reports per route: requests,
+# errors, throughput and p50/p95/p99 latency.
+#
+#   python -m benchmarks.run                                   # all routes, mongomock
+#   python -m benchmarks.run --routes chat,image --concurrency 16 --requests 200
+#   python -m benchmarks.run --latency a1111=2.0,ollama=0.05 --payload-kb a1111=1024
+#   python -m benchmarks.run --mongo mongodb://localhost:27017/marketmind_bench --json out.json
+#
+# Exits with status 1 if any route's error rate exceeds --max-error-rate (for CI).
+
+import io
+import os
+import sys
+import math
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path: sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.stubs import DEFAULT_PROFILES, start_stubs, make_png
+
+# Minimal API-format SVD workflow, so the run doesn't depend on the bundled template's model files
+BENCH_WORKFLOW = {
+    "1": {"class_type": "LoadImage", "inputs": {"image": "placeholder.png"}},
+    "2": {"class_type": "VHS_VideoCombine", "inputs": {"images": ["1", 0], "frame_rate": 8, "filename_prefix": "bench"}},
+}
+DRAIN_TIMEOUT = 60 # seconds to wait for background work after the run
+
+
+# --- Scenarios ---
+# name -> (method, path builder(i, state), form builder(i, state) or None, response check)
+# Failures surface the way the dashboard shows them: flashed messages, error values in the
+# redirect's query string, or a re-rendered dashboard without the generated result.
+def _chat_form(i, state):
+    # Half the turns continue one conversation so history loading is exercised
+    return {"topic": f"Benchmark topic {i}", "conversation_id": state["conversation_id"] if i % 2 else ""}
+
+def _status(expected):
+    return lambda response, flashes: response.status_code == expected
+
+def _renders(marker):
+    return lambda response, flashes: response.status_code == 200 and marker in response.data
+
+def _redirect_without(*error_params, require=None):
+    def check(response, flashes):
+        query = parse_qs(urlparse(response.headers.get("Location", "")).query)
+        return (response.status_code == 302 and not any(category == 'error' for category, _ in flashes)
+                and not any(param in query for param in error_params) and (require is None or require in query))
+    return check
+
+SCENARIOS = {
+    "dashboard": ("GET", lambda i, state: f"/dashboard?conversation_id={state['conversation_id']}", None, _status(200)),
+    "conversations": ("GET", lambda i, state: "/conversations", None, _status(200)),
+    "chat": ("POST", lambda i, state: "/generate_text_prompt", _chat_form, _redirect_without()),
+    "chat_stream": ("POST", lambda i, state: "/generate_text_prompt/stream", _chat_form,
+                    lambda response, flashes: response.status_code == 200 and b"event: error" not in response.data),
+    "image": ("POST", lambda i, state: "/generate-image",
+              lambda i, state: {"image_prompt": f"Benchmark product shot {i}", "conversation_id": state["conversation_id"]},
+              _renders(b'alt="Generated Image"')),
+    "audio": ("POST", lambda i, state: "/generate-audio",
+              lambda i, state: {"audio_text": f"Benchmark voice-over line number {i}.", "language_code": "en",
+                                "speaker_id": "stub_female", "conversation_id": state["conversation_id"]},
+              _renders(b'title="Download audio file"')),
+    "video": ("POST", lambda i, state: "/generate-video",
+              lambda i, state: {"last_init_image_id": state["image_id"], "conversation_id": state["conversation_id"]},
+              _redirect_without(require="video_prompt_id")),
+}
+
+def parse_overrides(value, cast):
+    """'a1111=2.0,ollama=0.1' -> {'a1111': 2.0, 'ollama': 0.1}"""
+    overrides = {}
+    for item in filter(None, (value or "").split(",")):
+        service, _, amount = item.partition("=")
+        if service not in DEFAULT_PROFILES: raise SystemExit(f"Unknown service '{service}' (choose from {', '.join(DEFAULT_PROFILES)}).")
+        overrides[service] = cast(amount)
+    return overrides
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values: return None
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def configure_environment(args, stubs, workdir):
+    """Points the app at the stubs and at throwaway storage. Must run before the app is imported."""
+    templates_dir = os.path.join(workdir, "workflow_templates")
+    os.makedirs(templates_dir)
+    with open(os.path.join(templates_dir, "workflow_animated.json"), "w") as f: json.dump(BENCH_WORKFLOW, f)
+    os.environ.update({
+        "OLLAMA_ENDPOINT": stubs["ollama"].url, "IMAGE_API_URL": stubs["a1111"].url,
+        "XTTS_API_URL": stubs["xtts"].url, "VIDEO_API_URL": stubs["comfyui"].url,
+        "OLLAMA_MODEL": "stub:latest", "FLASK_SECRET_KEY": "benchmark",
+        "MONGO_URL": args.mongo if args.mongo != "mongomock" else "mongodb://localhost:27017/marketmind_bench",
+        "MEDIA_DIR": os.path.join(workdir, "media"), "AUDIO_CACHE_DIR": os.path.join(workdir, "audio_cache"),
+        "WORKFLOW_TEMPLATES_DIR": templates_dir, "VIDEO_POLL_INTERVAL": "0.5", "LOG_LEVEL": args.log_level,
+        "RATE_LIMIT_ENABLED": "false", # One benchmark user sends far more than any per-user limit allows
+    })
+    if args.mongo == "mongomock":
+        import mongomock
+        import flask_pymongo
+        flask_pymongo.MongoClient = mongomock.MongoClient # Flask-PyMongo creates its client through this name
+
+def build_app():
+    from Flask_app import create_app, mongo
+    from Flask_app.models import User
+    app = create_app()
+    app.config['TESTING'] = True
+    with app.app_context():
+        email = f"bench-{random.getrandbits(32):08x}@example.com"
+        user = User.create(email, "Bench", "benchmark-password")
+    return app, mongo, user
+
+def login(app, user):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = user.id; session['_fresh'] = True
+    return client
+
+def setup_state(app, user):
+    """A conversation and an uploaded init image shared by the scenarios."""
+    client = login(app, user)
+    response = client.post("/generate_text_prompt", data={"topic": "Benchmark warm-up"})
+    conversation_id = response.headers.get("Location", "").split("conversation_id=")[-1].split("&")[0]
+    upload = client.post("/media", data={"file": (io.BytesIO(make_png(64 * 1024)), "init.png", "image/png")}, content_type="multipart/form-data")
+    if upload.status_code >= 400: raise SystemExit(f"Could not upload the benchmark init image: {upload.status_code} {upload.get_data(as_text=True)[:200]}")
+    return {"conversation_id": conversation_id, "image_id": upload.get_json()["media_id"]}
+
+
+def run_one(app, user, local, state, name, i):
+    method, path_for, form_for, check = SCENARIOS[name]
+    client = getattr(local, "client", None)
+    if client is None: client = local.client = login(app, user)
+    start = time.perf_counter()
+    response = client.open(path_for(i, state), method=method, data=form_for(i, state) if form_for else None)
+    response.get_data() # Drains streamed responses (SSE) so the full generation is timed
+    elapsed = time.perf_counter() - start
+    flashes = []
+    if method == "POST":
+        with client.session_transaction() as session: flashes = session.pop('_flashes', [])
+    return name, elapsed, check(response, flashes)
+
+def run_benchmark(app, user, state, routes, requests_per_route, concurrency, warmup):
+    local = threading.local()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for name in routes: list(pool.map(lambda i: run_one(app, user, local, state, name, i), range(-warmup, 0)))
+        work = [(name, i) for name in routes for i in range(requests_per_route)]
+        random.shuffle(work) # Interleave routes, as real traffic would
+        started = time.perf_counter()
+        results = list(pool.map(lambda item: run_one(app, user, local, state, *item), work))
+        wall = time.perf_counter() - started
+
+    report = {}
+    for name in routes:
+        latencies = sorted(elapsed for route, elapsed, ok in results if route == name)
+        errors = sum(1 for route, _, ok in results if route == name and not ok)
+        report[name] = {"requests": len(latencies), "errors": errors, "throughput_rps": round(len(latencies) / wall, 2),
+                        **{f"p{p}_ms": round(percentile(latencies, p) * 1000, 1) for p in (50, 95, 99)}}
+    return {"wall_seconds": round(wall, 2), "concurrency": concurrency, "routes": report}
+
+def drain_background_work(app, mongo, timeout=DRAIN_TIMEOUT):
+    """
+    Waits for the app's background work that writes into the workdir: renders the video
+    tracker is still fetching and queued conversation summaries. Returns False on timeout.
+    """
+    from Flask_app.video_tracker import VIDEO_ACTIVE_STATUSES
+    from Flask_app.chat_context import _summary_executor
+    deadline = time.monotonic() + timeout
+    with app.app_context():
+        while mongo.db.video_renders.count_documents({"status": {"$in": list(VIDEO_ACTIVE_STATUSES)}}):
+            if time.monotonic() > deadline: return False
+            time.sleep(0.25)
+    try: _summary_executor.submit(lambda: None).result(timeout=max(0, deadline - time.monotonic())) # Single worker: runs after queued folds
+    except Exception: return False
+    return True
+
+def print_report(result):
+    print(f"\n{'route':<14}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, row in result["routes"].items():
+        print(f"{name:<14}{row['requests']:>9}{row['errors']:>8}{row['throughput_rps']:>9}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}")
+    print(f"\n{sum(r['requests'] for r in result['routes'].values())} requests in {result['wall_seconds']}s at concurrency {result['concurrency']}.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the app's routes against local stub backends.")
+    parser.add_argument("--routes", default=",".join(SCENARIOS), help=f"Comma-separated scenarios ({', '.join(SCENARIOS)}).")
+    parser.add_argument("--requests", type=int, default=50, help="Measured requests per route.")
+    parser.add_argument("--warmup", type=int, default=3, help="Unmeasured requests per route before the run.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients.")
+    parser.add_argument("--latency", help="Stub latency overrides in seconds, e.g. a1111=2.0,ollama=0.05.")
+    parser.add_argument("--payload-kb", help="Stub payload size overrides in KiB, e.g. a1111=1024,xtts=512.")
+    parser.add_argument("--mongo", default="mongomock", help="'mongomock' or a MongoDB URI (e.g. a local mongod).")
+    parser.add_argument("--json", help="Also write the report to this file.")
+    parser.add_argument("--max-error-rate", type=float, default=0.0, help="Fail if any route's error rate is above this (0-1).")
+    parser.add_argument("--log-level", default="WARNING", help="App LOG_LEVEL during the run.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for latency jitter and request order.")
+    args = parser.parse_args(argv)
+
+    routes = [r for r in args.routes.split(",") if r]
+    unknown = [r for r in routes if r not in SCENARIOS]
+    if unknown: parser.error(f"Unknown route(s): {', '.join(unknown)}")
+    random.seed(args.seed)
+    latency, payload_kb = parse_overrides(args.latency, float), parse_overrides(args.payload_kb, int)
+    profiles = {service: (latency.get(service, default_latency), payload_kb.get(service, default_bytes // 1024) * 1024)
+                for service, (default_latency, default_bytes) in DEFAULT_PROFILES.items()}
+
+    stubs = start_stubs(profiles)
+    # Not TemporaryDirectory: daemon workers may still write into it at exit, and Python 3.9
+    # (CI) has no ignore_cleanup_errors
+    workdir = tempfile.mkdtemp(prefix="marketmind-bench-")
+    try:
+        configure_environment(args, stubs, workdir)
+        app, mongo, user = build_app()
+        if mongo.db is None: raise SystemExit("The app could not connect to MongoDB.")
+        state = setup_state(app, user)
+        print(f"Stubs: {', '.join(f'{s}={p[0]}s/{p[1] // 1024}KiB' for s, p in profiles.items())}")
+        result = run_benchmark(app, user, state, routes, args.requests, args.concurrency, args.warmup)
+        result["profiles"] = {s: {"latency_seconds": p[0], "payload_bytes": p[1]} for s, p in profiles.items()}
+        print_report(result)
+        if args.json:
+            with open(args.json, "w") as f: json.dump(result, f, indent=2)
+        if not drain_background_work(app, mongo): print(f"Background work still running after {DRAIN_TIMEOUT}s, removing the workdir anyway.")
+    finally:
+        for stub in stubs.values(): stub.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    failing = [name for name, row in result["routes"].items() if row["requests"] and row["errors"] / row["requests"] > args.max_error_rate]
+    if failing:
+        print(f"Error rate above {args.max_error_rate:.0%} for: {', '.join(failing)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,223 @@
+# benchmarks/stubs.py
+
+# Local stand-ins for the GPU backends, so the app can be load-tested without a GPU or network.
+# Each stub answers the endpoints the app calls, with the same response shapes, after a
+# configurable latency (plus jitter) and with a configurable payload size:
+#   ollama   POST /api/chat (plain, streamed NDJSON, and format=json variants),
+#            POST /api/generate (empty-prompt model loads), GET /api/tags
+#   a1111    POST /sdapi/v1/txt2img, /sdapi/v1/img2img (batch_size * n_iter PNGs), GET /sdapi/v1/progress
+#   xtts     POST /tts_to_audio (WAV), GET /speakers_list
+#   comfyui  POST /upload/image, POST /prompt, GET /queue, /history/<id>, /view
+
+import io
+import json
+import time
+import uuid
+import wave
+import zlib
+import base64
+import random
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# service -> (latency seconds, payload bytes); latency is per call (per stream for Ollama)
+DEFAULT_PROFILES = {
+    "ollama": (0.2, 2 * 1024),
+    "a1111": (1.0, 512 * 1024),
+    "xtts": (0.5, 256 * 1024),
+    "comfyui": (0.05, 1024 * 1024),
+}
+LATENCY_JITTER = 0.1 # +/- fraction of the configured latency
+STREAM_CHUNKS = 20 # Ollama tokens per streamed answer
+
+
+class StubProfile:
+    def __init__(self, latency, payload_bytes):
+        self.latency = latency
+        self.payload_bytes = payload_bytes
+
+    def sleep(self, fraction=1.0):
+        if self.latency > 0: time.sleep(self.latency * fraction * random.uniform(1 - LATENCY_JITTER, 1 + LATENCY_JITTER))
+
+
+# --- Payload Builders ---
+def make_png(size_bytes):
+    """A valid RGB PNG of roughly `size_bytes` (random pixels do not compress)."""
+    side = max(8, int((size_bytes / 3) ** 0.5))
+    raw = b"".join(b"\x00" + random.getrandbits(side * 24).to_bytes(side * 3, "big") for _ in range(side))
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", side, side, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b""))
+
+def make_wav(size_bytes, sample_rate=24000):
+    """Mono 16-bit WAV (XTTS's output format) with about `size_bytes` of samples."""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1); wav.setsampwidth(2); wav.setframerate(sample_rate)
+        wav.writeframes(bytes(size_bytes - size_bytes % 2))
+    return buffer.getvalue()
+
+
+# --- Handlers ---
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, like the real servers
+    profile = None
+    routes = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _json_body(self):
+        try: return json.loads(self._body() or b"{}")
+        except ValueError: return {}
+
+    def send_bytes(self, data, content_type, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, payload, status=200):
+        self.send_bytes(json.dumps(payload).encode(), "application/json", status)
+
+    def _dispatch(self, method):
+        path = urlparse(self.path).path
+        for (route_method, prefix), handler in self.routes.items():
+            if route_method == method and (path == prefix or (prefix.endswith("/") and path.startswith(prefix))):
+                return handler(self, path)
+        self._body()
+        self.send_json({"error": f"stub has no {method} {path}"}, status=404)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+
+def _ollama_chat(handler, path):
+    payload = handler._json_body()
+    profile = handler.profile
+    words = max(1, profile.payload_bytes // 6)
+    # Echo the user's message so distinct prompts stay distinct downstream (e.g. image cache keys)
+    user_text = next((m.get("content", "") for m in reversed(payload.get("messages", [])) if m.get("role") == "user"), "")
+    if payload.get("format") == "json":
+        profile.sleep()
+        content = json.dumps({"prompts": [f"{user_text}, stub variant {i}, " + "detail " * (words // 4) for i in range(4)]})
+        return handler.send_json({"model": payload.get("model"), "message": {"role": "assistant", "content": content}, "done": True})
+    if not payload.get("stream"):
+        profile.sleep()
+        return handler.send_json({"model": payload.get("model"), "message": {"role": "assistant", "content": f"{user_text}, " + "stub " * words}, "done": True})
+    # NDJSON token stream, latency spread over the chunks
+    handler.send_response(200)
+    handler.send_header("Content-Type", "application/x-ndjson")
+    handler.send_header("Transfer-Encoding", "chunked")
+    handler.end_headers()
+    token = "stub " * max(1, words // STREAM_CHUNKS)
+    for i in range(STREAM_CHUNKS + 1):
+        profile.sleep(1.0 / STREAM_CHUNKS)
+        line = json.dumps({"message": {"role": "assistant", "content": token if i < STREAM_CHUNKS else ""}, "done": i == STREAM_CHUNKS}).encode() + b"\n"
+        handler.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+    handler.wfile.write(b"0\r\n\r\n")
+
+def _ollama_load(handler, path):
+    payload = handler._json_body()
+    handler.send_json({"model": payload.get("model"), "response": "", "done": True, "load_duration": 0})
+
+def _a1111_generate(handler, path):
+    payload = handler._json_body()
+    count = int(payload.get("batch_size", 1)) * int(payload.get("n_iter", 1))
+    handler.profile.sleep()
+    image_b64 = base64.b64encode(handler.server.png).decode()
+    handler.send_json({"images": [image_b64] * count, "parameters": payload, "info": "{}"})
+
+def _xtts_tts(handler, path):
+    handler._body()
+    handler.profile.sleep()
+    handler.send_bytes(handler.server.wav, "audio/wav")
+
+def _comfy_upload(handler, path):
+    handler._body()
+    handler.profile.sleep(0.1)
+    handler.send_json({"name": f"upload_{uuid.uuid4().hex[:8]}.png", "subfolder": "", "type": "input"})
+
+def _comfy_prompt(handler, path):
+    handler._json_body()
+    handler.profile.sleep(0.1)
+    prompt_id = str(uuid.uuid4())
+    # Finished once the render latency has passed
+    with handler.server.lock: handler.server.prompts[prompt_id] = time.monotonic() + handler.profile.latency
+    handler.send_json({"prompt_id": prompt_id, "number": len(handler.server.prompts), "node_errors": {}})
+
+def _comfy_queue(handler, path):
+    now = time.monotonic()
+    with handler.server.lock: running = [[0, pid] for pid, done_at in handler.server.prompts.items() if done_at > now]
+    handler.send_json({"queue_running": running[:1], "queue_pending": running[1:]})
+
+def _comfy_history(handler, path):
+    prompt_id = path.rsplit("/", 1)[-1]
+    with handler.server.lock: done_at = handler.server.prompts.get(prompt_id)
+    if done_at is None or done_at > time.monotonic(): return handler.send_json({})
+    outputs = {"9": {"gifs": [{"filename": f"{prompt_id}.mp4", "subfolder": "", "type": "output"}]}}
+    handler.send_json({prompt_id: {"outputs": outputs, "status": {"status_str": "success", "completed": True, "messages": []}}})
+
+def _comfy_view(handler, path):
+    handler.send_bytes(handler.server.video, "video/mp4")
+
+def _static_json(payload):
+    return lambda handler, path: handler.send_json(payload)
+
+STUB_ROUTES = {
+    "ollama": {("POST", "/api/chat"): _ollama_chat, ("POST", "/api/generate"): _ollama_load, ("GET", "/api/tags"): _static_json({"models": [{"name": "stub:latest"}]})},
+    "a1111": {("POST", "/sdapi/v1/txt2img"): _a1111_generate, ("POST", "/sdapi/v1/img2img"): _a1111_generate,
+              ("GET", "/sdapi/v1/progress"): _static_json({"progress": 0, "state": {}})},
+    "xtts": {("POST", "/tts_to_audio"): _xtts_tts, ("GET", "/speakers_list"): _static_json(["stub_female", "stub_male"])},
+    "comfyui": {("POST", "/upload/image"): _comfy_upload, ("POST", "/prompt"): _comfy_prompt, ("GET", "/queue"): _comfy_queue,
+                ("GET", "/history/"): _comfy_history, ("GET", "/view"): _comfy_view},
+}
+
+
+class QuietThreadingHTTPServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        pass # Clients closing keep-alive connections mid-read is expected under load
+
+
+class StubServer:
+    """One stub backend on 127.0.0.1 with an OS-assigned port, served from a daemon thread."""
+
+    def __init__(self, service, latency, payload_bytes):
+        handler = type(f"{service.title()}StubHandler", (StubHandler,), {"profile": StubProfile(latency, payload_bytes), "routes": STUB_ROUTES[service]})
+        self.service = service
+        self.httpd = QuietThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        self.httpd.lock = threading.Lock()
+        self.httpd.prompts = {}
+        # Payloads built once so the stub's own CPU time doesn't skew the numbers
+        self.httpd.png = make_png(payload_bytes) if service == "a1111" else b""
+        self.httpd.wav = make_wav(payload_bytes) if service == "xtts" else b""
+        self.httpd.video = bytes(payload_bytes) if service == "comfyui" else b""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name=f"stub-{service}", daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown(); self.httpd.server_close()
+
+
+def start_stubs(profiles):
+    """Starts one stub per service. `profiles` is {service: (latency, payload_bytes)}."""
+    return {service: StubServer(service, *profiles[service]).start() for service in STUB_ROUTES}